@@ -0,0 +1,8 @@
+"""
+Benchmarks for the hot paths of the bot
+
+Each module can be run on its own and prints a short report to the console:
+    python -m benchmarks.db_pool
+
+Benchmarks that need external services read the same environment variables as the bot itself.
+"""
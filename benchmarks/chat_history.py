@@ -0,0 +1,68 @@
+"""
+Compares the per-user memory and serialization cost of the chat history
+
+    before  - the former unbounded list of {"role", "content"} dicts, pickled
+    after   - ChatHistory bounded by message count and tokens, in its compact binary format
+
+Usage:
+    python -m benchmarks.chat_history
+"""
+
+import pickle
+import time
+import tracemalloc
+
+from tgbot.services.history import ChatHistory
+
+TURNS: tuple[int, ...] = (10, 100, 1000)
+USER_MESSAGE: str = "How do I start learning about diffusion models as a beginner? " * 2
+ANSWER: str = (
+    "Start with the intuition behind denoising. Then read the DDPM paper and try a small "
+    "implementation on MNIST before moving to latent diffusion. "
+) * 6
+
+
+def build_list(turns: int) -> list[dict[str, str]]:
+    history: list[dict[str, str]] = []
+    for _ in range(turns):
+        history.append({"role": "user", "content": USER_MESSAGE})
+        history.append({"role": "assistant", "content": ANSWER})
+    return history
+
+
+def build_ring(turns: int) -> ChatHistory:
+    history: ChatHistory = ChatHistory()
+    for _ in range(turns):
+        history.append(role="user", content=USER_MESSAGE)
+        history.append(role="assistant", content=ANSWER)
+    return history
+
+
+def measure(build, turns: int, dump, load) -> tuple[int, int, float]:
+    tracemalloc.start()
+    history = build(turns)
+    memory: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    started: float = time.perf_counter()
+    for _ in range(100):
+        data: bytes = dump(history)
+        load(data)
+    elapsed: float = (time.perf_counter() - started) / 100
+    return memory, len(data), elapsed
+
+
+def main() -> None:
+    for turns in TURNS:
+        for name, build, dump, load in (
+            ("before", build_list, pickle.dumps, pickle.loads),
+            ("after", build_ring, ChatHistory.to_bytes, ChatHistory.from_bytes),
+        ):
+            memory, size, elapsed = measure(build, turns, dump, load)
+            print(
+                f"{name:<7} {turns:>5} turns   memory {memory / 1024:>9.1f} KiB   "
+                f"serialized {size / 1024:>8.1f} KiB   round trip {elapsed * 1e6:>9.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the pooled asyncpg data layer with the former per-call psycopg2 functions
+
+Both variants run the same workload: CONCURRENCY simulated handlers, each of them reads the preferences
+of a user REQUESTS times. The report shows queries per second and how long the event loop was stalled.
+
+Usage:
+    DATABASE_URL=postgres://... python -m benchmarks.db_pool
+"""
+
+import asyncio
+import os
+import time
+
+import psycopg2
+
+from benchmarks.loop_lag import LoopLagMonitor
+from tgbot.handlers.db_init import _fetch_user_preferences, init_db, store_user_data
+from tgbot.services.database import db
+
+CONCURRENCY: int = int(os.environ.get("BENCH_CONCURRENCY", 20))
+REQUESTS: int = int(os.environ.get("BENCH_REQUESTS", 50))
+USER_ID: int = 1
+PROFILE: dict = {
+    "NAME": "Bench",
+    "TOPIC": "AI",
+    "DESCRIPTION": "Benchmark profile",
+    "FREQUENCY": "1",
+    "PERSONA": "Male",
+    "LEVEL": "Beginner",
+}
+
+
+def legacy_get_user_preferences(user_id: int) -> tuple | None:
+    """The implementation that was used before the pool: a new TLS connection for every query"""
+    conn = psycopg2.connect(
+        os.environ["DATABASE_URL"],
+        sslmode=os.environ.get("DATABASE_SSLMODE", "require"),
+    )
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT name, topic, description, frequency, persona, level FROM user_data WHERE user_id = %s",
+            (user_id,),
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+async def legacy_handler() -> None:
+    for _ in range(REQUESTS):
+        # blocking, exactly as the handlers used to call it
+        legacy_get_user_preferences(USER_ID)
+        await asyncio.sleep(0)
+
+
+async def pooled_handler() -> None:
+    for _ in range(REQUESTS):
+        # Bypasses preferences_cache, every read is a query on the pool
+        await _fetch_user_preferences(USER_ID)
+
+
+async def measure(name: str, handler) -> None:
+    monitor: LoopLagMonitor = LoopLagMonitor()
+    monitor.start()
+    started: float = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(CONCURRENCY)))
+    elapsed: float = time.perf_counter() - started
+    await monitor.stop()
+    queries: int = CONCURRENCY * REQUESTS
+    print(
+        f"{name:<8} {queries / elapsed:>10.1f} queries/sec   "
+        f"max loop stall {monitor.max_lag * 1000:>8.1f} ms   "
+        f"total loop stall {monitor.total_stall:>7.2f} s"
+    )
+
+
+async def main() -> None:
+    await db.connect()
+    await init_db()
+    await store_user_data(USER_ID, PROFILE)
+    print(f"{CONCURRENCY} concurrent handlers x {REQUESTS} reads")
+    await measure("legacy", legacy_handler)
+    await measure("pooled", pooled_handler)
+    await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Measures the embedding throughput when two overlapping corpora are indexed one after the other
+
+    before  - OpenAIEmbeddings called directly, every chunk is embedded every time
+    after   - EmbeddingService: cached by content, deduplicated, concurrent batches
+
+The embedding model is simulated with a fixed latency per request and per text, so no API key is needed.
+
+Usage:
+    python -m benchmarks.embeddings
+"""
+
+import asyncio
+import random
+import tempfile
+import time
+
+from langchain.embeddings.base import Embeddings
+
+from tgbot.services.embeddings import EmbeddingCache, EmbeddingService
+
+CHUNKS: int = 2000
+OVERLAP: float = 0.8  # share of the second corpus that is already in the first one
+DIMENSION: int = 1536
+REQUEST_LATENCY: float = 0.2  # seconds per request
+TEXT_LATENCY: float = 0.0005  # seconds per text of a request
+
+
+class SimulatedEmbeddings(Embeddings):
+    """Returns random vectors after a latency similar to the one of the API"""
+
+    def __init__(self, chunk_size: int = 1000) -> None:
+        self.chunk_size: int = chunk_size
+        self.texts: int = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors: list[list[float]] = []
+        for start in range(0, len(texts), self.chunk_size):
+            batch: list[str] = texts[start : start + self.chunk_size]
+            time.sleep(REQUEST_LATENCY + TEXT_LATENCY * len(batch))
+            self.texts += len(batch)
+            vectors += [[random.random()] * DIMENSION for _ in batch]
+        return vectors
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(REQUEST_LATENCY + TEXT_LATENCY * len(texts))
+        self.texts += len(texts)
+        return [[random.random()] * DIMENSION for _ in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def corpora() -> tuple[list[str], list[str]]:
+    first: list[str] = [
+        f"chunk {i} " + "lorem ipsum dolor " * 40 for i in range(CHUNKS)
+    ]
+    kept: int = int(CHUNKS * OVERLAP)
+    second: list[str] = first[CHUNKS - kept :] + [
+        f"new chunk {i} " + "sit amet " * 60 for i in range(CHUNKS - kept)
+    ]
+    return first, second
+
+
+async def main() -> None:
+    first, second = corpora()
+    for name in ("before", "after"):
+        client: SimulatedEmbeddings = SimulatedEmbeddings()
+        with tempfile.TemporaryDirectory() as directory:
+            embeddings: Embeddings = client
+            if name == "after":
+                embeddings = EmbeddingService(
+                    client=client,
+                    model="simulated",
+                    cache=EmbeddingCache(directory=directory),
+                    batch_size=256,
+                    batch_tokens=100_000,
+                    concurrency=4,
+                )
+            for corpus_name, corpus in (("first", first), ("second", second)):
+                texts_before: int = client.texts
+                started: float = time.perf_counter()
+                if name == "after":
+                    await embeddings.aembed_documents(corpus)
+                else:
+                    await asyncio.to_thread(embeddings.embed_documents, corpus)
+                elapsed: float = time.perf_counter() - started
+                print(
+                    f"{name:<7} {corpus_name:<7} corpus  {elapsed:>6.2f} s   "
+                    f"{len(corpus) / elapsed:>8.1f} chunks/s   "
+                    f"embedded {client.texts - texts_before:>5} of {len(corpus)}"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
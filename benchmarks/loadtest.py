@@ -0,0 +1,704 @@
+"""
+End-to-end load test of the bot
+
+Starts local stand-ins of the Telegram Bot API, the OpenAI API and the Google Custom Search API, runs the bot
+against them in a child process and drives simulated users through /start, the Add Topic questionnaire, Confirm
+and a chat in the qa_conv state. Reports, per step (named like the handler_latency_seconds labels of the bot):
+
+    command:start            - /start, until the welcome message
+    callback:add_topic       - the Add Topic button, until the first question
+    state:topic              - an answer to the questionnaire, until the next question or the summary
+    callback:confirm_data    - the Confirm button, until the advices are scheduled
+    state:qa_conv (first)    - a chat message, until the first part of the streamed answer is shown
+    state:qa_conv            - a chat message, until the streamed answer is complete
+
+the number of steps, the failures (no answer within --timeout), the throughput and the p50/p95/p99 latency. The
+latency of a step runs from the moment the update is queued on the fake Bot API to the moment the answer arrives
+there, so it includes the long polling and the rate limiter of the bot. The requests received by every fake
+server are reported too, including the scheduled advices the bot generates meanwhile.
+
+Every fake server has a latency and error profile: a request waits the latency with a jitter of ±50% and fails
+with the given probability, with 429 and a retry_after for the Bot API and with 500 for OpenAI and Google.
+
+No request leaves the machine, but two things are needed: a PostgreSQL database in DATABASE_URL, where the bot
+creates its tables and stores the simulated users (use a scratch database), and the cl100k_base encoding of
+tiktoken in its cache (TIKTOKEN_CACHE_DIR), it is downloaded on its first use. The output of the bot is written
+to loadtest_bot.log.
+
+Usage:
+    python -m benchmarks.loadtest --users 100 --qa-messages 3 --openai-latency 0.8 --openai-errors 0.02
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from aiohttp import web
+
+from tgbot.handlers.commands import KEYS, QUESTION_OPTIONS
+from tgbot.services.streaming import CURSOR
+from tgbot.utils.templates import template
+
+ROOT: Path = Path(__file__).resolve().parent.parent
+BOT_LOG: Path = ROOT / "loadtest_bot.log"
+TOKEN: str = "123456:LOAD-TEST"
+BOT_API_PORT: int = 18083
+OPENAI_PORT: int = 18084
+GOOGLE_PORT: int = 18085
+FIRST_USER_ID: int = 7_000_000
+EMBEDDING_DIMENSION: int = 1536
+CHAT_REPLY: str = (
+    "Start with the fundamentals, practice a little every day and review what you have learned at the end "
+    "of each week."
+)
+COMPLETION_REPLY: str = "1. Fundamentals\n2. Tools\n3. Best practices\n4. Case studies"
+# Methods that address a chat and go through the rate limiter of the bot
+SEND_METHODS: frozenset[str] = frozenset(
+    {"sendMessage", "editMessageText", "sendPhoto"}
+)
+STEPS: tuple[str, ...] = (
+    "command:start",
+    "callback:add_topic",
+    "state:topic",
+    "callback:confirm_data",
+    "state:qa_conv (first)",
+    "state:qa_conv",
+)
+
+
+@dataclass
+class Profile:
+    """Latency and error rate of a fake server"""
+
+    latency: float = 0.0
+    error_rate: float = 0.0
+
+    async def wait(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+@dataclass
+class Outgoing:
+    """A message the bot sent or edited"""
+
+    method: str
+    message: dict
+    reply_markup: dict | None
+    at: float
+
+    @property
+    def text(self) -> str:
+        return self.message.get("text", "")
+
+    def has_button(self, callback_data: str) -> bool:
+        rows: list = (self.reply_markup or {}).get("inline_keyboard", [])
+        return any(
+            button.get("callback_data") == callback_data
+            for row in rows
+            for button in row
+        )
+
+
+def error_response(status: int, message: str) -> web.Response:
+    return web.json_response(
+        {"error": {"message": message, "type": "server_error", "code": None}},
+        status=status,
+    )
+
+
+class FakeBotApi:
+    """Queues the updates of the simulated users and collects the messages of the bot by chat"""
+
+    def __init__(self, profile: Profile) -> None:
+        self.profile: Profile = profile
+        self.requests: Counter = Counter()
+        self.errors: int = 0
+        self.polling: asyncio.Event = asyncio.Event()
+        self.inboxes: defaultdict[int, asyncio.Queue[Outgoing]] = defaultdict(
+            asyncio.Queue
+        )
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new: asyncio.Event = asyncio.Event()
+
+    def push(self, update: dict) -> None:
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new.set()
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        self.polling.set()
+        offset: int = int(params.get("offset", 0))
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new.clear()
+            try:
+                await asyncio.wait_for(
+                    self._new.wait(), timeout=float(params.get("timeout", 0))
+                )
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[: int(params.get("limit", 100))]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method: str = request.match_info["method"]
+        params: dict = dict(await request.post())
+        self.requests[method] += 1
+        if method == "getUpdates":
+            result: object = await self._get_updates(params)
+            return web.json_response({"ok": True, "result": result})
+        await self.profile.wait()
+        if method in SEND_METHODS and self.profile.fails():
+            self.errors += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+        if method == "getMe":
+            result = {
+                "id": 123456,
+                "is_bot": True,
+                "first_name": "Load test",
+                "username": "load_test_bot",
+            }
+        elif method in SEND_METHODS:
+            chat_id: int = int(params["chat_id"])
+            result = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text") or params.get("caption", ""),
+            }
+            reply_markup: str | None = params.get("reply_markup")
+            self.inboxes[chat_id].put_nowait(
+                Outgoing(
+                    method=method,
+                    message=result,
+                    reply_markup=json.loads(reply_markup) if reply_markup else None,
+                    at=time.perf_counter(),
+                )
+            )
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeOpenAI:
+    """Answers chat completions (streamed or not), completions and embeddings with fixed texts"""
+
+    def __init__(self, profile: Profile, token_delay: float) -> None:
+        self.profile: Profile = profile
+        self.token_delay: float = token_delay
+        self.requests: Counter = Counter()
+        self.errors: int = 0
+
+    async def _admit(self, endpoint: str) -> web.Response | None:
+        self.requests[endpoint] += 1
+        await self.profile.wait()
+        if self.profile.fails():
+            self.errors += 1
+            return error_response(500, "Injected failure")
+        return None
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body: dict = await request.json()
+        failure: web.Response | None = await self._admit("chat/completions")
+        if failure is not None:
+            return failure
+        chunk: dict = {
+            "id": "chatcmpl-loadtest",
+            "created": int(time.time()),
+            "model": body["model"],
+        }
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    **chunk,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": CHAT_REPLY},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 100,
+                        "completion_tokens": 25,
+                        "total_tokens": 125,
+                    },
+                }
+            )
+        response: web.StreamResponse = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+        tokens: list[str] = CHAT_REPLY.split(" ")
+        deltas: list[dict] = [{"role": "assistant", "content": ""}]
+        deltas += [
+            {"content": token if index == 0 else " " + token}
+            for index, token in enumerate(tokens)
+        ]
+        # The last chunk has an empty delta and the reason the answer ended
+        for delta in deltas + [{}]:
+            choice: dict = {
+                "index": 0,
+                "delta": delta,
+                "finish_reason": None if delta else "stop",
+            }
+            event: dict = {
+                **chunk,
+                "object": "chat.completion.chunk",
+                "choices": [choice],
+            }
+            await response.write(b"data: " + json.dumps(event).encode() + b"\n\n")
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(self, request: web.Request) -> web.Response:
+        await request.read()
+        failure: web.Response | None = await self._admit("completions")
+        if failure is not None:
+            return failure
+        return web.json_response(
+            {
+                "id": "cmpl-loadtest",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "choices": [
+                    {"text": COMPLETION_REPLY, "index": 0, "finish_reason": "stop"}
+                ],
+                "usage": {
+                    "prompt_tokens": 100,
+                    "completion_tokens": 20,
+                    "total_tokens": 120,
+                },
+            }
+        )
+
+    @staticmethod
+    def _embed(item: object) -> list[float]:
+        """A unit vector derived from the input, equal inputs get equal vectors"""
+        seed: bytes = hashlib.sha256(json.dumps(item).encode()).digest()
+        rng: random.Random = random.Random(seed)
+        vector: list[float] = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSION)]
+        norm: float = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector]
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body: dict = await request.json()
+        failure: web.Response | None = await self._admit("embeddings")
+        if failure is not None:
+            return failure
+        inputs: list = (
+            body["input"] if isinstance(body["input"], list) else [body["input"]]
+        )
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body.get("model"),
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": self._embed(item),
+                    }
+                    for index, item in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            }
+        )
+
+
+class FakeGoogle:
+    """Answers Custom Search queries with a page of made-up results"""
+
+    def __init__(self, profile: Profile) -> None:
+        self.profile: Profile = profile
+        self.requests: Counter = Counter()
+        self.errors: int = 0
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests["customsearch/v1"] += 1
+        await self.profile.wait()
+        if self.profile.fails():
+            self.errors += 1
+            return web.json_response(
+                {"error": {"code": 500, "message": "Injected failure"}}, status=500
+            )
+        query: str = request.query.get("q", "")
+        return web.json_response(
+            {
+                "items": [
+                    {
+                        "title": f"Result {index}",
+                        "link": f"https://example.com/{index}",
+                        "snippet": f"Finding {index} on {query}.",
+                    }
+                    for index in range(int(request.query.get("num", 10)))
+                ]
+            }
+        )
+
+
+class StepFailed(Exception):
+    pass
+
+
+@dataclass
+class Stats:
+    samples: defaultdict[str, list[float]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    failures: Counter = field(default_factory=Counter)
+
+
+class SimulatedUser:
+    """Goes through the whole flow of the bot, every step waits for its answer"""
+
+    def __init__(
+        self, api: FakeBotApi, stats: Stats, user_id: int, options: argparse.Namespace
+    ) -> None:
+        self._api: FakeBotApi = api
+        self._stats: Stats = stats
+        self._options: argparse.Namespace = options
+        self._user: dict = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User {user_id}",
+        }
+        self._chat: dict = {"id": user_id, "type": "private"}
+        self._inbox: asyncio.Queue[Outgoing] = api.inboxes[user_id]
+        self._message_ids = itertools.count(1)
+
+    def _message(self, text: str) -> dict:
+        message: dict = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat,
+            "from": self._user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+        return {"message": message}
+
+    def _press(self, button: str, message: dict) -> dict:
+        return {
+            "callback_query": {
+                "id": f"{self._user['id']}-{next(self._message_ids)}",
+                "from": self._user,
+                "chat_instance": str(self._user["id"]),
+                "message": message,
+                "data": button,
+            }
+        }
+
+    async def _wait_for(
+        self, step: str, sent_at: float, expected: Callable[[Outgoing], bool]
+    ) -> Outgoing:
+        """Returns the first message of the bot that answers the step, others, e.g. advices, are skipped"""
+        deadline: float = sent_at + self._options.timeout
+        while True:
+            try:
+                outgoing: Outgoing = await asyncio.wait_for(
+                    self._inbox.get(), timeout=deadline - time.perf_counter()
+                )
+            except asyncio.TimeoutError:
+                self._stats.failures[step] += 1
+                raise StepFailed(step) from None
+            if expected(outgoing):
+                self._stats.samples[step].append(outgoing.at - sent_at)
+                return outgoing
+
+    async def _send(self, update: dict) -> float:
+        """Sends the update after the think time of the user and returns when it was sent"""
+        await asyncio.sleep(self._options.think * random.uniform(0.5, 1.5))
+        self._api.push(update)
+        return time.perf_counter()
+
+    async def _step(
+        self, step: str, update: dict, expected: Callable[[Outgoing], bool]
+    ) -> Outgoing:
+        return await self._wait_for(step, await self._send(update), expected)
+
+    async def run(self) -> None:
+        welcome: Outgoing = await self._step(
+            "command:start",
+            self._message("/start"),
+            lambda out: out.method == "sendMessage" and out.has_button("add_topic"),
+        )
+        await self._step(
+            "callback:add_topic",
+            self._press("add_topic", welcome.message),
+            lambda out: out.text == question(KEYS[0]),
+        )
+        answers: dict[str, str] = {
+            "NAME": self._user["first_name"],
+            "DESCRIPTION": "Getting better at it in my free time",
+            **{
+                key: random.choice([option for row in options for option in row])
+                for key, options in QUESTION_OPTIONS.items()
+            },
+        }
+        summary: Outgoing | None = None
+        for index, key in enumerate(KEYS):
+            last: bool = index + 1 == len(KEYS)
+            summary = await self._step(
+                "state:topic",
+                self._message(answers[key]),
+                (lambda out: out.has_button("confirm_data"))
+                if last
+                else (
+                    lambda out, next_key=KEYS[index + 1]: out.text == question(next_key)
+                ),
+            )
+        scheduled: str = template.render_sync(
+            template_name="advice_scheduled.jinja2",
+            data={"frequency": answers["FREQUENCY"]},
+        )
+        await self._step(
+            "callback:confirm_data",
+            self._press("confirm_data", summary.message),
+            lambda out: out.text == scheduled,
+        )
+        for number in range(self._options.qa_messages):
+            sent_at: float = await self._send(
+                self._message(
+                    f"Question {number} of user {self._user['id']}: how do I get started with "
+                    f"{answers['TOPIC']}?"
+                )
+            )
+            await self._wait_for(
+                "state:qa_conv (first)",
+                sent_at,
+                lambda out: out.method == "sendMessage" and out.text.endswith(CURSOR),
+            )
+            await self._wait_for(
+                "state:qa_conv",
+                sent_at,
+                lambda out: out.method == "editMessageText"
+                and not out.text.endswith(CURSOR),
+            )
+
+
+def question(key: str) -> str:
+    return template.render_sync(template_name="question.jinja2", data={"key": key})
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """Nearest-rank percentile"""
+    ordered: list[float] = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+async def start_server(routes: list[web.RouteDef], port: int) -> web.AppRunner:
+    app: web.Application = web.Application(client_max_size=16 * 1024**2)
+    app.add_routes(routes)
+    runner: web.AppRunner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def report(
+    stats: Stats,
+    elapsed: float,
+    finished: int,
+    options: argparse.Namespace,
+    servers: dict[str, FakeBotApi | FakeOpenAI | FakeGoogle],
+) -> None:
+    print(
+        f"{finished}/{options.users} users finished the flow in {elapsed:.1f} s "
+        f"({sum(map(len, stats.samples.values())) / elapsed:.1f} steps/s)\n"
+    )
+    print(
+        f"{'step':<24} {'count':>6} {'fail':>5} {'per s':>7} {'p50':>8} {'p95':>8} {'p99':>8}"
+    )
+    for step in STEPS:
+        samples: list[float] = stats.samples.get(step, [])
+        latencies: str = (
+            " ".join(f"{percentile(samples, q):>7.3f}s" for q in (50, 95, 99))
+            if samples
+            else f"{'-':>8} {'-':>8} {'-':>8}"
+        )
+        print(
+            f"{step:<24} {len(samples):>6} {stats.failures[step]:>5} "
+            f"{len(samples) / elapsed:>7.1f} {latencies}"
+        )
+    print()
+    for name, server in servers.items():
+        calls: str = ", ".join(
+            f"{endpoint} {count}" for endpoint, count in sorted(server.requests.items())
+        )
+        print(f"{name:<8} {calls or 'no requests'}; injected errors {server.errors}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        prog="python -m benchmarks.loadtest",
+        description="End-to-end load test of the bot against local fake servers",
+    )
+    parser.add_argument("--users", type=int, default=50, help="simulated users")
+    parser.add_argument(
+        "--ramp", type=float, default=10.0, help="seconds over which the users start"
+    )
+    parser.add_argument(
+        "--qa-messages", type=int, default=3, help="chat messages sent by every user"
+    )
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=0.5,
+        help="mean seconds a user waits between steps",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="seconds a step waits for its answer",
+    )
+    for server, latency in (("bot-api", 0.02), ("openai", 0.5), ("google", 0.3)):
+        parser.add_argument(
+            f"--{server}-latency",
+            type=float,
+            default=latency,
+            help=f"mean seconds of a {server} request",
+        )
+        parser.add_argument(
+            f"--{server}-errors",
+            type=float,
+            default=0.0,
+            help=f"share of {server} requests that fail",
+        )
+    parser.add_argument(
+        "--openai-token-delay",
+        type=float,
+        default=0.02,
+        help="seconds between two streamed tokens",
+    )
+    return parser.parse_args()
+
+
+async def main(options: argparse.Namespace) -> None:
+    if "DATABASE_URL" not in os.environ:
+        sys.exit("DATABASE_URL of a scratch PostgreSQL database is required")
+    api: FakeBotApi = FakeBotApi(
+        Profile(options.bot_api_latency, options.bot_api_errors)
+    )
+    openai: FakeOpenAI = FakeOpenAI(
+        Profile(options.openai_latency, options.openai_errors),
+        token_delay=options.openai_token_delay,
+    )
+    google: FakeGoogle = FakeGoogle(
+        Profile(options.google_latency, options.google_errors)
+    )
+    runners: list[web.AppRunner] = [
+        await start_server(
+            [web.post("/bot{token}/{method}", api.handle)], BOT_API_PORT
+        ),
+        await start_server(
+            [
+                web.post("/v1/chat/completions", openai.chat_completions),
+                web.post("/v1/completions", openai.completions),
+                web.post("/v1/engines/{engine}/completions", openai.completions),
+                web.post("/v1/embeddings", openai.embeddings),
+            ],
+            OPENAI_PORT,
+        ),
+        await start_server([web.get("/customsearch/v1", google.search)], GOOGLE_PORT),
+    ]
+    bot_log = open(BOT_LOG, "wb")
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "main.py",
+        cwd=ROOT,
+        env={
+            **os.environ,
+            "BOT_MODE": "polling",
+            "BOT_TOKEN": TOKEN,
+            "BOT_API_URL": f"http://127.0.0.1:{BOT_API_PORT}/bot",
+            "OPENAI_API_KEY": "sk-load-test",
+            "OPENAI_API_BASE": f"http://127.0.0.1:{OPENAI_PORT}/v1",
+            "GOOGLE_API_KEY": "load-test",
+            "GOOGLE_CSE_ID": "load-test",
+            "GOOGLE_API_ENDPOINT": f"http://127.0.0.1:{GOOGLE_PORT}",
+            "DATABASE_SSLMODE": os.environ.get("DATABASE_SSLMODE", "disable"),
+            "ADMINS": "1",
+        },
+        stdout=bot_log,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+    try:
+        started: asyncio.Task = asyncio.create_task(api.polling.wait())
+        exited: asyncio.Task = asyncio.create_task(bot.wait())
+        await asyncio.wait(
+            (started, exited), timeout=120, return_when=asyncio.FIRST_COMPLETED
+        )
+        exited.cancel()
+        if not started.done():
+            started.cancel()
+            sys.exit(f"The bot did not start polling, see {BOT_LOG}")
+
+        stats: Stats = Stats()
+
+        async def simulate(index: int) -> bool:
+            await asyncio.sleep(options.ramp * index / options.users)
+            user: SimulatedUser = SimulatedUser(
+                api, stats, FIRST_USER_ID + index, options
+            )
+            try:
+                await user.run()
+            except StepFailed:
+                return False
+            return True
+
+        began: float = time.perf_counter()
+        results: list[bool] = await asyncio.gather(
+            *(simulate(index) for index in range(options.users))
+        )
+        report(
+            stats,
+            elapsed=time.perf_counter() - began,
+            finished=sum(results),
+            options=options,
+            servers={"bot api": api, "openai": openai, "google": google},
+        )
+    finally:
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGINT)
+            await bot.wait()
+        bot_log.close()
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,38 @@
+"""Measures how long the event loop is stalled while a benchmark is running"""
+
+import asyncio
+import time
+
+
+class LoopLagMonitor:
+    """Wakes up every `interval` seconds and records how late the wake-up was"""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self._interval: float = interval
+        self._task: asyncio.Task | None = None
+        self.lags: list[float] = []
+
+    async def _run(self) -> None:
+        while True:
+            started: float = time.perf_counter()
+            await asyncio.sleep(self._interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self._interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def max_lag(self) -> float:
+        return max(self.lags, default=0.0)
+
+    @property
+    def total_stall(self) -> float:
+        return sum(self.lags)
@@ -0,0 +1,96 @@
+"""
+Compares the memory footprint and the number of wake-ups of the two ways to schedule advices
+
+    legacy  - one never-ending asyncio task per subscriber sleeping for its interval (the former send_advice loop)
+    timer   - a single timer that claims due subscriptions in batches (the AdviceScheduler design)
+
+A day is compressed into DAY seconds so that the run stays short. The timer variant keeps next due times
+in an in-memory heap standing in for the advice_schedule table, so database round-trips are not included.
+
+Usage:
+    python -m benchmarks.scheduler
+"""
+
+import asyncio
+import heapq
+import os
+import random
+import time
+import tracemalloc
+
+from tgbot.config import ADVICE_SCHEDULER_BATCH_SIZE
+
+SUBSCRIBERS: tuple[int, ...] = (10_000, 100_000)
+DAY: float = float(os.environ.get("BENCH_DAY", 8.0))
+WINDOW: float = float(os.environ.get("BENCH_WINDOW", 8.0))
+TICKS_PER_DAY: int = 2880  # a tick every 30 seconds of a real day
+
+
+def intervals(count: int) -> list[float]:
+    rng: random.Random = random.Random(count)
+    return [DAY / rng.randint(1, 4) for _ in range(count)]
+
+
+async def legacy(count: int) -> tuple[int, int]:
+    wakeups: int = 0
+
+    async def loop(interval: float) -> None:
+        nonlocal wakeups
+        while True:
+            await asyncio.sleep(interval)
+            wakeups += 1
+
+    tracemalloc.start()
+    tasks: list[asyncio.Task] = [
+        asyncio.create_task(loop(interval)) for interval in intervals(count)
+    ]
+    await asyncio.sleep(0)
+    memory: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    await asyncio.sleep(WINDOW)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return memory, wakeups
+
+
+async def timer(count: int) -> tuple[int, int]:
+    wakeups: int = 0
+    tracemalloc.start()
+    now: float = time.monotonic()
+    schedule: list[tuple[float, int, float]] = [
+        (now + interval, user_id, interval)
+        for user_id, interval in enumerate(intervals(count))
+    ]
+    heapq.heapify(schedule)
+    memory: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    deadline: float = now + WINDOW
+    while time.monotonic() < deadline:
+        await asyncio.sleep(DAY / TICKS_PER_DAY)
+        wakeups += 1
+        current: float = time.monotonic()
+        while schedule and schedule[0][0] <= current:
+            for _ in range(min(ADVICE_SCHEDULER_BATCH_SIZE, len(schedule))):
+                if schedule[0][0] > current:
+                    break
+                due, user_id, interval = heapq.heappop(schedule)
+                due += interval * ((current - due) // interval + 1)  # no drift
+                heapq.heappush(schedule, (due, user_id, interval))
+    return memory, wakeups
+
+
+async def main() -> None:
+    print(f"day compressed to {DAY}s, observed window {WINDOW}s")
+    for count in SUBSCRIBERS:
+        for name, variant in (("legacy", legacy), ("timer", timer)):
+            memory, wakeups = await variant(count)
+            print(
+                f"{name:<7} {count:>7} subscribers   "
+                f"memory {memory / 1024 / 1024:>8.2f} MiB   wake-ups {wakeups:>8}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Compares the text splitters used by process_recursive on multi-megabyte documents
+
+    before  - RecursiveCharacterTextSplitter(length_function=tiktoken_len), re-counts tokens of candidate pieces
+    after   - TokenWindowSplitter, tokenizes the document once and cuts on token offsets
+
+Both split into chunks of 900 tokens with 200 tokens of overlap. The report shows the time, the number of
+chunks and their token sizes; the old splitter is skipped for documents larger than BEFORE_MAX_MB.
+
+Usage:
+    python -m benchmarks.splitter
+"""
+
+import random
+import statistics
+import time
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from tgbot.services.prompts import count_tokens
+from tgbot.services.splitter import TokenWindowSplitter
+
+SIZES_MB: tuple[float, ...] = (0.5, 1, 4, 8)
+BEFORE_MAX_MB: float = 4
+WORDS: tuple[str, ...] = (
+    "model", "training", "data", "network", "inference", "latency", "token", "vector",
+    "the", "of", "and", "a", "to", "in", "is", "for", "with", "on", "that", "by",
+)  # fmt: skip
+
+
+def document(size_mb: float, seed: int = 0) -> str:
+    """Builds a document of paragraphs of lines of words, about size_mb megabytes long"""
+    rng: random.Random = random.Random(seed)
+    paragraphs: list[str] = []
+    size: int = 0
+    while size < size_mb * 1024 * 1024:
+        lines: list[str] = [
+            " ".join(rng.choices(WORDS, k=rng.randint(5, 30))) + "."
+            for _ in range(rng.randint(1, 8))
+        ]
+        paragraphs.append("\n".join(lines))
+        size += sum(map(len, lines)) + len(lines) + 1
+    return "\n\n".join(paragraphs)
+
+
+def run(splitter, text: str) -> tuple[float, list[str]]:
+    started: float = time.perf_counter()
+    chunks: list[str] = splitter.split_text(text)
+    return time.perf_counter() - started, chunks
+
+
+def main() -> None:
+    before = RecursiveCharacterTextSplitter(
+        chunk_size=900,
+        chunk_overlap=200,
+        length_function=count_tokens,
+        separators=["\n\n", "\n", " ", ""],
+    )
+    after: TokenWindowSplitter = TokenWindowSplitter(chunk_size=900, chunk_overlap=200)
+    for size_mb in SIZES_MB:
+        text: str = document(size_mb)
+        for name, splitter in (("before", before), ("after", after)):
+            if name == "before" and size_mb > BEFORE_MAX_MB:
+                print(f"{name:<7} {size_mb:>4} MB   skipped")
+                continue
+            elapsed, chunks = run(splitter, text)
+            sizes: list[int] = [count_tokens(chunk) for chunk in chunks]
+            print(
+                f"{name:<7} {size_mb:>4} MB   {elapsed:>8.2f} s   {len(chunks):>6} chunks   "
+                f"tokens mean {statistics.mean(sizes):>6.1f}  max {max(sizes):>4}"
+            )
+
+
+if __name__ == "__main__":
+    main()
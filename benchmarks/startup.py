@@ -0,0 +1,147 @@
+"""
+Time to first update of a cold start
+
+Starts the bot in a fresh interpreter against a fake Bot API server that delivers one /help update on the
+first getUpdates, and reports, from the moment the process is spawned:
+
+    import    - time to import main
+    build     - time to build the application
+    first     - time until the answer to the first update reaches the Bot API
+    peak RSS  - peak resident memory of the bot process
+
+The database is not used: post_init, post_shutdown and the persistence are removed from the application.
+No network access and no real tokens are needed.
+
+Usage:
+    python -m benchmarks.startup
+"""
+
+import asyncio
+import os
+import resource
+import signal
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+RUNS: int = 3
+API_PORT: int = 18082
+ENVIRONMENT: dict[str, str] = {
+    "BOT_TOKEN": "123456:STARTUP-TEST",
+    "BOT_API_URL": f"http://127.0.0.1:{API_PORT}/bot",
+    "OPENAI_API_KEY": "sk-startup-test",
+    "GOOGLE_CSE_ID": "startup-test",
+    "GOOGLE_API_KEY": "startup-test",
+    "DATABASE_URL": "postgres://startup-test",
+    "ADMINS": "1",
+}
+BOT: str = """
+import time
+
+import_started = time.perf_counter()
+import main
+
+build_started = time.perf_counter()
+application = main.build_application()
+application.post_init = None
+application.post_shutdown = None
+application.persistence = None
+print(build_started - import_started, time.perf_counter() - build_started, flush=True)
+application.run_polling(drop_pending_updates=False)
+"""
+
+
+class FakeBotApi:
+    """Delivers one /help update and records when the first answer arrives"""
+
+    def __init__(self) -> None:
+        self.delivered: bool = False
+        self.answered: asyncio.Event = asyncio.Event()
+        self.answered_at: float = 0.0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method: str = request.match_info["method"]
+        await request.read()
+        chat: dict = {"id": 1000, "type": "private"}
+        if method == "getMe":
+            result: object = {
+                "id": 123456,
+                "is_bot": True,
+                "first_name": "Startup test",
+                "username": "startup_test_bot",
+            }
+        elif method == "getUpdates":
+            if self.delivered:
+                # Long polling without updates
+                await asyncio.sleep(0.5)
+                result = []
+            else:
+                self.delivered = True
+                result = [
+                    {
+                        "update_id": 1,
+                        "message": {
+                            "message_id": 1,
+                            "date": int(time.time()),
+                            "chat": chat,
+                            "from": {"id": 1000, "is_bot": False, "first_name": "U"},
+                            "text": "/help",
+                            "entities": [
+                                {"type": "bot_command", "offset": 0, "length": 5}
+                            ],
+                        },
+                    }
+                ]
+        elif method in ("sendMessage", "sendPhoto"):
+            if not self.answered.is_set():
+                self.answered_at = time.perf_counter()
+                self.answered.set()
+            result = {"message_id": 2, "date": int(time.time()), "chat": chat}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+async def run_once() -> tuple[float, float, float]:
+    api: FakeBotApi = FakeBotApi()
+    app: web.Application = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner: web.AppRunner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+    started: float = time.perf_counter()
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        BOT,
+        env={**os.environ, **ENVIRONMENT},
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        import_time, build_time = map(float, (await bot.stdout.readline()).split())
+        await asyncio.wait_for(api.answered.wait(), timeout=120)
+        return import_time, build_time, api.answered_at - started
+    finally:
+        bot.send_signal(signal.SIGINT)
+        await bot.wait()
+        await runner.cleanup()
+
+
+async def main() -> None:
+    results: list[tuple[float, float, float]] = [await run_once() for _ in range(RUNS)]
+    # Kilobytes on Linux
+    peak_rss: int = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    import_time, build_time, first = (
+        statistics.median(column) for column in zip(*results)
+    )
+    print(
+        f"import {import_time:.2f} s   build {build_time:.2f} s   first update {first:.2f} s   "
+        f"peak RSS {peak_rss / 1024:.0f} MB   (median of {RUNS} runs)"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
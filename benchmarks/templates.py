@@ -0,0 +1,81 @@
+"""
+Compile time and render throughput of the message templates
+
+    compile cold  - compile_all() with an empty bytecode cache
+    compile warm  - compile_all() of a new renderer that loads the bytecode cache of the cold run
+    before        - the former renderer: get_template() and render_async() on an async environment per render
+    after         - render_sync() of a precompiled template
+
+Renders the welcome message of a user with a topic, the largest message the bot builds from a template.
+
+Usage:
+    python -m benchmarks.templates
+"""
+
+import asyncio
+import tempfile
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+from tgbot.config import TEMPLATES_DIR
+from tgbot.utils.templates import RenderTemplate
+
+RENDERS: int = 20_000
+KEYS: list[str] = ["NAME", "TOPIC", "DESCRIPTION", "FREQUENCY", "PERSONA", "LEVEL"]
+PREFERENCES: dict[str, str] = {
+    "NAME": "Bench",
+    "TOPIC": "AI",
+    "DESCRIPTION": "Language models & <tools>",
+    "FREQUENCY": "2",
+    "PERSONA": "Female",
+    "LEVEL": "Beginner",
+}
+DATA: dict = {
+    "username": "Bench",
+    "preferences": PREFERENCES,
+    "keys": KEYS,
+    "data": PREFERENCES,
+}
+
+
+def compile_time(cache_dir: str) -> tuple[float, RenderTemplate]:
+    renderer: RenderTemplate = RenderTemplate(
+        path_to_templates=TEMPLATES_DIR, path_to_cache=cache_dir
+    )
+    started: float = time.perf_counter()
+    renderer.compile_all()
+    return time.perf_counter() - started, renderer
+
+
+async def before() -> float:
+    env: Environment = Environment(
+        loader=FileSystemLoader(searchpath=TEMPLATES_DIR), enable_async=True
+    )
+    started: float = time.perf_counter()
+    for _ in range(RENDERS):
+        await env.get_template(name="welcome.jinja2").render_async(**DATA)
+    return time.perf_counter() - started
+
+
+def after(renderer: RenderTemplate) -> float:
+    started: float = time.perf_counter()
+    for _ in range(RENDERS):
+        renderer.render_sync(template_name="welcome.jinja2", data=DATA)
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold, _ = compile_time(cache_dir)
+        warm, renderer = compile_time(cache_dir)
+    print(f"compile  cold {cold * 1000:>7.1f} ms   warm {warm * 1000:>7.1f} ms")
+    for name, elapsed in (
+        ("before", asyncio.run(before())),
+        ("after", after(renderer)),
+    ):
+        print(f"{name:<7} {RENDERS / elapsed:>10.0f} renders/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Load test of the webhook serving mode
+
+Starts a fake Bot API server and a WebhookServer whose workers answer every text message with sendMessage,
+posts synthetic updates from many chats to the webhook and reports:
+
+    accepted  - updates/sec acknowledged by the webhook server
+    handled   - updates/sec answered by the workers, measured by the sendMessage calls received
+
+No network access and no bot token are needed.
+
+Usage:
+    python -m benchmarks.webhook
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, ContextTypes, MessageHandler, filters
+
+from tgbot.services.webhook import SECRET_HEADER, WebhookServer
+
+WORKERS: tuple[int, ...] = (1, 2, 4)
+UPDATES: int = 5000
+CHATS: int = 500
+CONCURRENCY: int = 64
+API_PORT: int = 18081
+WEBHOOK_PORT: int = 18080
+TOKEN: str = "123456:LOAD-TEST"
+SECRET: str = "load-test-secret"
+
+
+async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="ok")
+
+
+def build_application(worker: int) -> Application:
+    application: Application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"http://127.0.0.1:{API_PORT}/bot")
+        .updater(None)
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, echo, block=False))
+    return application
+
+
+def serve(workers: int) -> None:
+    WebhookServer(
+        build=build_application,
+        workers=workers,
+        url=f"http://127.0.0.1:{WEBHOOK_PORT}/telegram",
+        secret=SECRET,
+        port=WEBHOOK_PORT,
+        host="127.0.0.1",
+    ).run()
+
+
+class FakeBotApi:
+    """Answers getMe and counts sendMessage"""
+
+    def __init__(self) -> None:
+        self.sent: int = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method: str = request.match_info["method"]
+        if method == "getMe":
+            result: dict = {
+                "id": 123456,
+                "is_bot": True,
+                "first_name": "Load test",
+                "username": "load_test_bot",
+            }
+        else:
+            self.sent += 1
+            result = {
+                "message_id": self.sent,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+                "text": "ok",
+            }
+        return web.json_response({"ok": True, "result": result})
+
+
+def synthetic_update(update_id: int) -> dict:
+    chat_id: int = 1000 + update_id % CHATS
+    user: dict = {"id": chat_id, "is_bot": False, "first_name": "User"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": user,
+            "text": f"question {update_id}",
+        },
+    }
+
+
+async def wait_until_ready(session: aiohttp.ClientSession) -> None:
+    for _ in range(200):
+        try:
+            async with session.get(f"http://127.0.0.1:{WEBHOOK_PORT}/healthz"):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The webhook server did not start")
+
+
+async def load(workers: int, api: FakeBotApi) -> None:
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=serve, args=(workers,))
+    server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_ready(session)
+            # Let the workers initialize their applications
+            await asyncio.sleep(3)
+            api.sent = 0
+            semaphore: asyncio.Semaphore = asyncio.Semaphore(CONCURRENCY)
+
+            async def post(update_id: int) -> None:
+                async with semaphore:
+                    async with session.post(
+                        f"http://127.0.0.1:{WEBHOOK_PORT}/telegram",
+                        json=synthetic_update(update_id),
+                        headers={SECRET_HEADER: SECRET},
+                    ) as response:
+                        response.raise_for_status()
+
+            started: float = time.perf_counter()
+            await asyncio.gather(*(post(update_id) for update_id in range(UPDATES)))
+            accepted: float = time.perf_counter() - started
+            while api.sent < UPDATES and time.perf_counter() - started < 120:
+                await asyncio.sleep(0.05)
+            handled: float = time.perf_counter() - started
+        print(
+            f"{workers} worker(s)   accepted {UPDATES / accepted:>8.1f} updates/s   "
+            f"handled {api.sent / handled:>8.1f} updates/s ({api.sent} of {UPDATES})"
+        )
+    finally:
+        os.kill(server.pid, signal.SIGINT)
+        server.join(timeout=60)
+
+
+async def main() -> None:
+    # Workers beyond the CPUs only compete for them, see env.get_web_concurrency()
+    print(f"{len(os.sched_getaffinity(0))} CPU(s) available")
+    api: FakeBotApi = FakeBotApi()
+    app: web.Application = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner: web.AppRunner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+    try:
+        for workers in WORKERS:
+            await load(workers, api)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,74 @@
 """Launches the bot"""
 
+import asyncio
+import sys
+
 from telegram.constants import ParseMode
-from telegram.ext import AIORateLimiter, Application, Defaults
+from telegram.ext import Application, Defaults
 
+from tgbot.config import (
+    LOOP_GUARD,
+    LOOP_GUARD_STRICT,
+    METRICS_LOG_INTERVAL,
+    RATE_LIMIT_GLOBAL,
+)
 from tgbot.handlers import HANDLERS
+from tgbot.handlers.commands import send_advice
+from tgbot.handlers.messages import (
+    advice_buffer,
+    category_index,
+    close_embeddings,
+    memory_store,
+    preload,
+)
 from tgbot.handlers.db_init import init_db
 from tgbot.handlers.errors import error_handler
+from tgbot.services.database import db
+from tgbot.services.executors import blocking_io
+from tgbot.services.llm_client import llm_client
+from tgbot.services.persistence import persistence
+from tgbot.services.rate_limiter import PriorityRateLimiter
+from tgbot.services.scheduler import advice_scheduler
+from tgbot.services.search_cache import search_cache
+from tgbot.services.vector_index import vector_indexes
 from tgbot.utils.bot_commands import set_default_commands
 from tgbot.utils.environment import env
 from tgbot.utils.logger import logger
+from tgbot.utils.loop_guard import install_loop_guard
+from tgbot.utils.metrics import log_metrics
+from tgbot.utils.startup import profile_startup
+from tgbot.utils.templates import template
 
 
 async def on_startup(application: Application) -> None:
     """
     The function that runs when the bot starts, before the application.run_polling()
-    In this example, the function sets the default commands for the bot
+    Compiles the message templates, opens the database connection pool and the session of the LLM client and sets
+    the default commands for the bot
     """
+    if LOOP_GUARD:
+        install_loop_guard(strict=LOOP_GUARD_STRICT)
+    template.compile_all()
+    await db.connect()
+    await llm_client.start()
+    await init_db()
+    await advice_scheduler.init_schema()
+    await memory_store.init_schema()
+    await category_index.init_schema()
     await set_default_commands(application=application)
+    # Heavy dependencies are imported in the background, the bot already receives updates
+    application.create_task(asyncio.to_thread(preload))
+
+
+async def on_shutdown(application: Application) -> None:
+    """The function that runs after the bot stops, spills the memories and closes the pools and caches"""
+    await memory_store.flush()
+    await db.close()
+    await llm_client.close()
+    search_cache.close()
+    vector_indexes.save()
+    close_embeddings()
+    blocking_io.shutdown()
 
 
 # def install_playwright_browsers():
@@ -36,26 +88,73 @@ def register_all_handlers(application: Application) -> None:
     application.add_error_handler(callback=error_handler)
 
 
-def start_bot() -> None:
-    init_db()
-    """Launches the bot"""
+def build_application(worker: int | None = None) -> Application:
+    """
+    Builds the application
+
+    :param worker: index of the webhook worker process the application runs in, None when polling
+    """
+
+    # The global limit of Telegram is per bot, every webhook worker gets an equal share of it
+    workers: int = env.get_web_concurrency() if worker is not None else 1
+    rate_limiter = PriorityRateLimiter(global_rate=RATE_LIMIT_GLOBAL / workers)
 
     # Create the Application and pass it your bot's token.
-    application: Application = (
+    builder = (
         Application.builder()
         .token(token=env.get_bot_token())
+        .base_url(base_url=env.get_bot_api_url())
         .defaults(defaults=Defaults(parse_mode=ParseMode.HTML, block=False))
-        .rate_limiter(rate_limiter=AIORateLimiter(max_retries=3))
+        .rate_limiter(rate_limiter=rate_limiter)
         .post_init(post_init=on_startup)
-        .build()
+        .post_shutdown(post_shutdown=on_shutdown)
+        .persistence(persistence=persistence)
     )
+    if worker is not None:
+        # Updates are received by the webhook server, not fetched with getUpdates
+        builder = builder.updater(updater=None)
+    application: Application = builder.build()
 
     register_all_handlers(application=application)
+    # Scheduled deliveries run in one process only
+    if not worker:
+        advice_scheduler.start(job_queue=application.job_queue, deliver=send_advice)
+        advice_buffer.start(
+            job_queue=application.job_queue,
+            upcoming=advice_scheduler.upcoming_profiles,
+        )
+    persistence.start(job_queue=application.job_queue)
+    application.job_queue.run_repeating(
+        callback=log_metrics, interval=METRICS_LOG_INTERVAL, name="log_metrics"
+    )
+    return application
+
+
+def start_bot() -> None:
+    """Launches the bot"""
+    if env.get_bot_mode() == "webhook":
+        # aiohttp is only needed to serve the webhook
+        from tgbot.services.webhook import WebhookServer
+
+        WebhookServer(
+            build=build_application,
+            workers=env.get_web_concurrency(),
+            url=env.get_webhook_url(),
+            secret=env.get_webhook_secret(),
+            port=env.get_port(),
+            token=env.get_bot_token(),
+            base_url=env.get_bot_api_url(),
+        ).run()
+        return
 
-    application.run_polling(drop_pending_updates=True)
+    # Updates sent while the bot was restarting are processed, not dropped
+    build_application().run_polling(drop_pending_updates=False)
 
 
 if __name__ == "__main__":
+    if "--profile-startup" in sys.argv[1:]:
+        profile_startup(code="import main; main.build_application()")
+        sys.exit()
     try:
         logger.info("Starting bot")
         start_bot()
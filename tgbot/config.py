@@ -13,3 +13,157 @@ BOT_LOGO: str = normpath(join(_BASE_DIR, "tgbot/assets/img/bot_logo.png"))
 ENV_FILE: str = normpath(join(_BASE_DIR, ".env"))
 LOG_FILE: str = normpath(join(_BASE_DIR, "tgbot.log"))
 TEMPLATES_DIR: str = normpath(join(_BASE_DIR, "tgbot/templates"))
+SEARCH_CACHE_FILE: str = normpath(join(_BASE_DIR, "search_cache.sqlite3"))
+VECTOR_INDEX_DIR: str = normpath(join(_BASE_DIR, "vector_indexes"))
+EMBEDDING_CACHE_DIR: str = normpath(join(_BASE_DIR, "embedding_cache"))
+TEMPLATE_CACHE_DIR: str = normpath(join(_BASE_DIR, "template_cache"))
+
+# Cache of user preferences read from the database
+PREFERENCES_CACHE_SIZE: int = 10_000
+# Seconds a profile is served from the cache
+PREFERENCES_CACHE_TTL: int = 15 * 60
+
+# Advice scheduler
+# Seconds between two checks for due subscriptions
+ADVICE_SCHEDULER_TICK: int = 30
+# Subscriptions claimed by one query
+ADVICE_SCHEDULER_BATCH_SIZE: int = 100
+# Seconds during which a cohort shares one generated advice
+ADVICE_COHORT_WINDOW: int = 15 * 60
+
+# Subcategories of user profiles kept in process, they are stored in the database
+CATEGORY_CACHE_SIZE: int = 10_000
+# Seconds the subcategories of a profile are kept in process
+CATEGORY_CACHE_TTL: int = 24 * 3600
+
+# Advices generated ahead of their due time
+# Ready advices kept per cohort
+ADVICE_BUFFER_DEPTH: int = 2
+# Seconds after which a buffered advice is discarded
+ADVICE_BUFFER_MAX_AGE: int = 6 * 3600
+# Seconds ahead of the due time the buffer is filled
+ADVICE_BUFFER_LOOKAHEAD: int = 60 * 60
+# Seconds between two refills
+ADVICE_BUFFER_REFILL_INTERVAL: int = 5 * 60
+# Advices generated at once by a refill
+ADVICE_BUFFER_CONCURRENCY: int = 2
+
+# Cache of web search results
+# Seconds during which a result is fresh
+SEARCH_CACHE_TTL: int = 6 * 3600
+# Seconds a stale result is served while it is refreshed
+SEARCH_CACHE_STALE_TTL: int = 24 * 3600
+SEARCH_CACHE_MAX_ENTRIES: int = 50_000
+# Seconds a write waits for a lock held by another process
+SEARCH_CACHE_BUSY_TIMEOUT: float = 5.0
+# Hits whose access times are written together
+SEARCH_CACHE_ACCESS_BATCH: int = 100
+
+# Thread pool for blocking calls to external services
+BLOCKING_IO_THREADS: int = 32
+# Concurrent calls per provider, at most BLOCKING_IO_THREADS in total, so that slow network calls
+# never hold every thread while the cache writes wait
+BLOCKING_IO_PROVIDER_LIMITS: dict[str, int] = {
+    "google": 12,
+    "openai": 15,
+    "search_cache": 1,
+    "embedding_cache": 4,
+}
+# Seconds a Google search may take
+GOOGLE_SEARCH_TIMEOUT: int = 20
+
+# LLM prompts
+# Maximum number of tokens in a prompt built by PromptBuilder, for chats with the template and the memory
+PROMPT_TOKEN_BUDGET: int = 3000
+# Maximum number of tokens of the entities and the recent turns of the memory in a chat prompt
+MEMORY_PROMPT_TOKENS: int = 1000
+
+# Semantic cache of chat answers
+# Minimum cosine similarity of two queries sharing an answer
+SEMANTIC_CACHE_THRESHOLD: float = 0.95
+# Answers kept per (topic, level, persona)
+SEMANTIC_CACHE_MAX_ENTRIES: int = 1000
+# Partitions (topic, level, persona) kept, the least recently used one is dropped
+SEMANTIC_CACHE_MAX_PARTITIONS: int = 500
+# Seconds a cached answer is served
+SEMANTIC_CACHE_TTL: int = 24 * 3600
+
+# Embeddings
+EMBEDDING_MODEL: str = "text-embedding-ada-002"
+# Texts sent in one request
+EMBEDDING_BATCH_SIZE: int = 256
+# Tokens sent in one request
+EMBEDDING_BATCH_TOKENS: int = 100_000
+# Requests sent at once
+EMBEDDING_CONCURRENCY: int = 4
+# Vectors kept in the cache files, the oldest half is dropped when they are full
+EMBEDDING_CACHE_MAX_ROWS: int = 100_000
+# Vectors of queries kept in process, queries are not written to the cache files
+EMBEDDING_QUERY_CACHE_SIZE: int = 1_000
+# Seconds the vector of a query is kept in process
+EMBEDDING_QUERY_CACHE_TTL: int = 3600
+
+# Chat history kept in context.user_data
+CHAT_HISTORY_MAX_MESSAGES: int = 20
+CHAT_HISTORY_MAX_TOKENS: int = 4000
+# Summary of the messages that left the history
+CHAT_HISTORY_SUMMARY_TOKENS: int = 500
+
+# Per-user conversation memory
+# Memories kept in process, the rest is spilled to the database
+MEMORY_MAX_USERS: int = 1000
+# Seconds of inactivity after which a memory is spilled
+MEMORY_IDLE_TTL: int = 30 * 60
+# Entities remembered per user
+MEMORY_MAX_ENTITIES: int = 50
+
+# Streaming of chat answers into Telegram
+STREAM_ANSWERS: bool = True
+# Minimum seconds between two edits of a streamed message
+STREAM_EDIT_INTERVAL: float = 1.0
+
+# Persistence of user_data, chat_data and bot_data
+# Seconds between two hand-overs of changed data by the application
+PERSISTENCE_UPDATE_INTERVAL: int = 30
+# Seconds between two batched writes to the database
+PERSISTENCE_FLUSH_INTERVAL: int = 30
+
+# Outbound messages, the limits of the Bot API
+# Messages per second to all chats
+RATE_LIMIT_GLOBAL: float = 30
+# Messages per second of scheduled advices, spread evenly
+RATE_LIMIT_BROADCAST: float = 20
+# Messages per second to one private chat
+RATE_LIMIT_PRIVATE_CHAT: float = 1
+# Messages per second to one group or channel
+RATE_LIMIT_GROUP_CHAT: float = 20 / 60
+# Messages that can be sent to one chat at once
+RATE_LIMIT_CHAT_BURST: int = 3
+# Retries of a request after a 429 answer
+RATE_LIMIT_MAX_RETRIES: int = 3
+# Chats waiting after a 429 answer at once, from which the flood limit is taken as the global one
+RATE_LIMIT_GLOBAL_FLOOD_CHATS: int = 3
+
+# Requests to the OpenAI API
+# Requests in flight at once, also the size of the connection pool
+LLM_CONCURRENCY: int = 16
+# Seconds of one attempt of a request
+LLM_REQUEST_TIMEOUT: int = 60
+# Retries of a request after a timeout, a 429 or a 5xx answer
+LLM_MAX_RETRIES: int = 4
+# Upper bound in seconds of the wait before the first retry, doubled by each retry
+LLM_BACKOFF_BASE: float = 0.5
+# Upper bound in seconds of the wait before any retry
+LLM_BACKOFF_MAX: float = 20
+# Seconds an idle connection is kept open
+LLM_KEEPALIVE_TIMEOUT: int = 60
+
+# Synchronous network calls made on the event loop
+# Report them in the log and the metrics, once per call site
+LOOP_GUARD: bool = True
+# Make them fail instead, for tests and load tests
+LOOP_GUARD_STRICT: bool = False
+
+# Metrics
+# Seconds between two dumps of the metrics into the log
+METRICS_LOG_INTERVAL: int = 15 * 60
@@ -10,12 +10,12 @@ Note:
     Handlers are imported into the __init__.py package handlers,
     where a tuple of HANDLERS is assembled for further registration in the application
 """
-import asyncio
 import time
+from functools import partial
+from typing import Awaitable, Callable
 
 # TODO: Do a data collection like in WeList bot
 #   Fix bug (during first round level is not set correctly (NA)
-#   Stress Test it with commands
 
 from telegram import (
     Update,
@@ -32,20 +32,23 @@ from telegram.ext import (
     filters,
 )
 
-from tgbot.config import BOT_LOGO
+from tgbot.config import BOT_LOGO, STREAM_ANSWERS
 from tgbot.handlers.db_init import store_user_data, get_user_preferences
-from tgbot.handlers.messages import create_advice, get_conversation
+from tgbot.handlers.messages import (
+    category_index,
+    cohort_advice,
+    get_conversation,
+    stream_conversation,
+)
+from tgbot.services.history import ChatHistory
+from tgbot.services.rate_limiter import BROADCAST
+from tgbot.services.scheduler import advice_scheduler
+from tgbot.services.streaming import MessageStreamer
 from tgbot.utils.filters import is_admin_filter
+from tgbot.utils.metrics import metrics, scope
 from tgbot.utils.templates import template
 
-# New questions and options
-USER_QUESTIONS = [
-    "Which topic are you interested in?",
-    "Can you give a brief description what what advices on that topic you want to get?",
-    "How often do you need advice per day?",
-    "Which personality do you prefer for the bot?",
-    "What's your current level on the chosen topic?",
-]
+# The questionnaire asks for the keys in this order, the questions are in question.jinja2
 KEYS = ["NAME", "TOPIC", "DESCRIPTION", "FREQUENCY", "PERSONA", "LEVEL"]
 
 TOPIC_OPTIONS = [
@@ -62,38 +65,27 @@ ADVICE_FREQUENCY_OPTIONS = [
 PERSONALITY_OPTIONS = [["Male", "Female"]]
 
 LEVEL_OPTIONS = [["Beginner", "Intermediate", "Advanced"]]
-# Mapping questions to their options
+# Mapping keys to the options of their questions
 QUESTION_OPTIONS = {
-    "Which topic are you interested in?": TOPIC_OPTIONS,
-    "How often do you need advice per day?": ADVICE_FREQUENCY_OPTIONS,
-    "Which personality do you prefer for the bot?": PERSONALITY_OPTIONS,
-    "What's your current level on the chosen topic?": LEVEL_OPTIONS,
+    "TOPIC": TOPIC_OPTIONS,
+    "FREQUENCY": ADVICE_FREQUENCY_OPTIONS,
+    "PERSONA": PERSONALITY_OPTIONS,
+    "LEVEL": LEVEL_OPTIONS,
 }
 
 
-# TODO: Add one more button Add Topics that will start QA from beginning
-async def start_cmd_from_admin(update: Update, context: CallbackContext) -> None:
-    """Handles command /start from the user"""
-
+async def send_welcome(update: Update, context: CallbackContext) -> None:
+    """Greets the user with the summary of their data and the menu"""
     user_id = update.message.from_user.id
     username: str = update.message.from_user.first_name
 
     # Retrieve user preferences from the database
-    user_preferences = get_user_preferences(user_id)
-
-    welcome_message = (
-        f"👋 Hello, {username if username else 'user'}! What would you like to do?"
-    )
+    user_preferences = await get_user_preferences(user_id)
 
     if user_preferences:
         # Store the user preferences in context.user_data['data']
         context.user_data["data"] = user_preferences
-        summary = "\n".join(
-            [f"{key}: {context.user_data['data'].get(key, 'N/A')}" for key in KEYS]
-        )
-
         # User has already added a topic, so show the topic name and summary
-        topic_summary = f"Current Topic: {user_preferences['TOPIC']}\nDescription: {user_preferences['DESCRIPTION']}"
         buttons = [
             [
                 InlineKeyboardButton(
@@ -104,61 +96,49 @@ async def start_cmd_from_admin(update: Update, context: CallbackContext) -> None
             [InlineKeyboardButton(text="Confirm", callback_data="confirm_data")],
             [InlineKeyboardButton(text="Add Topic", callback_data="add_topic")],
         ]
-        welcome_message += (
-            f"\n\n{topic_summary}\nHere's the summary of your data:\n\n{summary}"
-        )
     else:
         # No topic added yet, show the Add Topic button
         buttons = [[InlineKeyboardButton(text="Add Topic", callback_data="add_topic")]]
 
+    welcome_message = template.render_sync(
+        template_name="welcome.jinja2",
+        data={
+            "username": username,
+            "preferences": user_preferences,
+            "keys": KEYS,
+            "data": user_preferences,
+        },
+    )
     keyboard = InlineKeyboardMarkup(buttons)
     await update.message.reply_text(text=welcome_message, reply_markup=keyboard)
     context.user_data["conversation_state"] = "idle"
 
 
-# TODO: Adjust
-async def start_cmd_from_user(update: Update, context: CallbackContext) -> None:
-    """Handles command /start from the user"""
-
-    user_id = update.message.from_user.id
-    username: str = update.message.from_user.first_name
-
-    # Retrieve user preferences from the database
-    user_preferences = get_user_preferences(user_id)
-
-    welcome_message = (
-        f"👋 Hello, {username if username else 'user'}! What would you like to do?"
+async def ask_question(context: CallbackContext, chat_id: int, key: str) -> None:
+    """Sends the question of the questionnaire about the key, with its options if it has any"""
+    options = QUESTION_OPTIONS.get(key)
+    keyboard = (
+        ReplyKeyboardMarkup(options, one_time_keyboard=True, resize_keyboard=True)
+        if options
+        else None
+    )
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=template.render_sync(template_name="question.jinja2", data={"key": key}),
+        reply_markup=keyboard,
     )
 
-    if user_preferences:
-        # Store the user preferences in context.user_data['data']
-        context.user_data["data"] = user_preferences
-        summary = "\n".join(
-            [f"{key}: {context.user_data['data'].get(key, 'N/A')}" for key in KEYS]
-        )
 
-        # User has already added a topic, so show the topic name and summary
-        topic_summary = f"Current Topic: {user_preferences['TOPIC']}\nDescription: {user_preferences['DESCRIPTION']}"
-        buttons = [
-            [
-                InlineKeyboardButton(
-                    text=f"Edit Topic: {user_preferences['TOPIC']}",
-                    callback_data="edit_data",
-                )
-            ],
-            [InlineKeyboardButton(text="Confirm", callback_data="confirm_data")],
-            [InlineKeyboardButton(text="Add Topic", callback_data="add_topic")],
-        ]
-        welcome_message += (
-            f"\n\n{topic_summary}\nHere's the summary of your data:\n\n{summary}"
-        )
-    else:
-        # No topic added yet, show the Add Topic button
-        buttons = [[InlineKeyboardButton(text="Add Topic", callback_data="add_topic")]]
+# TODO: Add one more button Add Topics that will start QA from beginning
+async def start_cmd_from_admin(update: Update, context: CallbackContext) -> None:
+    """Handles command /start from the user"""
+    await send_welcome(update, context)
 
-    keyboard = InlineKeyboardMarkup(buttons)
-    await update.message.reply_text(text=welcome_message, reply_markup=keyboard)
-    context.user_data["conversation_state"] = "idle"
+
+# TODO: Adjust
+async def start_cmd_from_user(update: Update, context: CallbackContext) -> None:
+    """Handles command /start from the user"""
+    await send_welcome(update, context)
 
 
 CONFIRM_DATA = "confirm_data"
@@ -172,10 +152,6 @@ async def display_summary(update: Update, context: CallbackContext) -> None:
         if update.message
         else update.callback_query.message.chat_id
     )
-    summary = "\n".join(
-        [f"{key}: {context.user_data['data'].get(key, 'N/A')}" for key in KEYS]
-    )
-
     buttons = [
         [
             InlineKeyboardButton(text="Confirm", callback_data=CONFIRM_DATA),
@@ -186,7 +162,10 @@ async def display_summary(update: Update, context: CallbackContext) -> None:
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Here's the summary of your data:\n\n{summary}",
+        text=template.render_sync(
+            template_name="summary.jinja2",
+            data={"keys": KEYS, "data": context.user_data["data"]},
+        ),
         reply_markup=keyboard,
     )
 
@@ -198,7 +177,7 @@ async def edit_data_selection(update: Update, context: CallbackContext) -> None:
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text="Which data would you like to edit?",
+        text=template.render_sync(template_name="edit_selection.jinja2"),
         reply_markup=keyboard,
     )
 
@@ -210,168 +189,147 @@ async def edit_data_input(update: Update, context: CallbackContext, key: str) ->
         else update.message.chat_id
     )
     context.user_data["editing_key"] = key
+    await ask_question(context, chat_id, key)
 
-    question_index = KEYS.index(key) - 1 if key != "NAME" else KEYS.index(key)
-    print(question_index)
-    question = USER_QUESTIONS[question_index]
-    print(question)
-    options = QUESTION_OPTIONS.get(question)
-    print(options)
-    if options and key != "NAME":
-        keyboard = ReplyKeyboardMarkup(
-            options, one_time_keyboard=True, resize_keyboard=True
-        )
-        await context.bot.send_message(
-            chat_id=chat_id, text=USER_QUESTIONS[question_index], reply_markup=keyboard
-        )
-    elif key == "NAME":
-        await context.bot.send_message(
-            chat_id=chat_id, text="What nickname or name should I use to address you?:"
+
+async def handle_qa_message(update: Update, context: CallbackContext) -> None:
+    """
+    Handles a message in the 'qa_conv' state, generating responses using GPT.
+    The only state that needs the preferences of the user, they are loaded here.
+    """
+    chat_id = update.message.chat_id
+    user_id = update.message.from_user.id
+    user_message = update.message.text
+    user_preferences = await get_user_preferences(user_id)
+    # Generate a response using GPT
+    chat_history = context.user_data.setdefault("chat_history", ChatHistory())
+    chat_history.append(role="user", content=user_message)
+    if STREAM_ANSWERS:
+        # Show the response while it is being generated
+        response = await MessageStreamer(bot=context.bot, chat_id=chat_id).stream(
+            chunks=stream_conversation(user_id, user_preferences, user_message)
         )
     else:
+        response = await get_conversation(user_id, user_preferences, user_message)
+        # Send the response to the user, in several messages if it is too long
+        await MessageStreamer(bot=context.bot, chat_id=chat_id).send(response)
+    # An empty answer was replaced by an apology, it is not part of the conversation
+    if response.strip():
+        chat_history.append(role="assistant", content=response)
+
+
+async def handle_idle_message(update: Update, context: CallbackContext) -> None:
+    """Handles a message in the 'idle' state, it is either an edited value or a stray message"""
+    chat_id = update.message.chat_id
+    await context.bot.send_message(
+        chat_id=chat_id, text=template.render_sync(template_name="idle.jinja2")
+    )
+    editing_key = context.user_data.get("editing_key")
+    if editing_key:
+        # Store the edited value
+        context.user_data["data"][editing_key] = update.message.text
+        # Reset editing_key
+        context.user_data["editing_key"] = None
+        # Display the summary again
+        await display_summary(update, context)
+
+
+async def handle_topic_message(update: Update, context: CallbackContext) -> None:
+    """Handles a message in the 'topic' state: stores the answer and sends the next question to the user"""
+    chat_id = update.message.chat_id
+    # Get the current question index from context.user_data or initialize it to 0
+    question_index = context.user_data.get(QUESTION_INDEX, 0)
+
+    editing_key = context.user_data.get("editing_key", None)
+    if editing_key:
+        # Store the edited value
+        context.user_data["data"][editing_key] = update.message.text
+        # Reset editing_key
+        context.user_data["editing_key"] = None
+        # Display the summary again
+        await display_summary(update, context)
+        return
+    if 0 <= question_index < len(KEYS):
+        context.user_data["data"][KEYS[question_index]] = update.message.text
+    # Check if we've asked all questions
+    if question_index + 1 < len(KEYS):
+        await ask_question(context, chat_id, KEYS[question_index + 1])
+        # Increment the question index for the next question
+        context.user_data[QUESTION_INDEX] = question_index + 1
+    elif question_index + 1 == len(KEYS):
+        await display_summary(update, context)
+    else:
+        # Reset the question index and inform the user that all questions have been asked
+        context.user_data[QUESTION_INDEX] = 0
         await context.bot.send_message(
-            chat_id=chat_id, text=USER_QUESTIONS[question_index]
+            chat_id=chat_id,
+            text=template.render_sync(template_name="questionnaire_done.jinja2"),
         )
 
 
-async def qa_conversation_handler(update: Update, context: CallbackContext) -> None:
+# Handlers of text messages by conversation state, a message in any other state is ignored
+STATE_HANDLERS: dict[str, Callable[[Update, CallbackContext], Awaitable[None]]] = {
+    "qa_conv": handle_qa_message,
+    "idle": handle_idle_message,
+    "topic": handle_topic_message,
+}
+
+
+async def route(name: str, handler: Callable[..., Awaitable[None]], *args) -> None:
     """
-    Handles the QA conversation state, generating responses using GPT.
+    Runs the handler of a state or a button, measures its latency and labels the database queries and LLM
+    calls it makes with its name
     """
-    chat_id = update.message.chat_id
-    user_id = (
-        update.message.from_user.id
-        if update.message
-        else update.callback_query.from_user.id
-    )
-    user_preferences = get_user_preferences(user_id)
-    user_message = update.message.text
+    token = scope.set(name)
+    started: float = time.perf_counter()
+    try:
+        await handler(*args)
+    finally:
+        metrics.histogram("handler_latency_seconds", handler=name).observe(
+            time.perf_counter() - started
+        )
+        scope.reset(token)
+
 
-    if user_message.lower() == "/exit":
+async def qa_conversation_handler(update: Update, context: CallbackContext) -> None:
+    """
+    Routes a text message to the handler of the conversation state of the user.
+    """
+    if update.message.text.lower() == "/exit":
         await exit_chat(update, context)
         return
-    print(context.user_data.get("conversation_state"))
-    # Check if the conversation state is 'qa_conv'
-    if context.user_data.get("conversation_state") == "qa_conv":
-        start = time.time()
-        # Generate a response using GPT
-        context.user_data.setdefault("chat_history", []).append(
-            {"role": "user", "content": user_message}
-        )
-        response = await get_conversation(user_preferences, user_message)
-        context.user_data["chat_history"].append(
-            {"role": "assistant", "content": response}
-        )
+    state = context.user_data.get("conversation_state")
+    handler = STATE_HANDLERS.get(state)
+    if handler is not None:
+        await route(f"state:{state}", handler, update, context)
 
-        # Send the response to the user
-        await context.bot.send_message(chat_id=chat_id, text=response)
-        end = time.time()
-        print(end - start)
-    elif context.user_data.get("conversation_state") == "idle":
-        pre_generated_message = "Please select an option from the menu to get started."
-        await context.bot.send_message(chat_id=chat_id, text=pre_generated_message)
-        editing_key = context.user_data.get("editing_key")
-        if editing_key:
-            # Store the edited value
-            context.user_data["data"][editing_key] = user_message
-            # Reset editing_key
-            context.user_data["editing_key"] = None
-            # Display the summary again
-            await display_summary(update, context)
-            return
-        return
-    elif context.user_data.get("conversation_state") == "topic":
-        question_index = context.user_data.get(QUESTION_INDEX, 0)
-        """Send the next question to the user."""
-        chat_id = (
-            update.message.chat_id
-            if update.message
-            else update.callback_query.message.chat_id
-        )
-        if context.user_data.get("conversation_state") == "qa_conv":
-            await qa_conversation_handler(update, context)
-            return
-
-        # Get the current question index from context.user_data or initialize it to 0
-
-        editing_key = context.user_data.get("editing_key", None)
-        if editing_key:
-            # Store the edited value
-            context.user_data["data"][editing_key] = update.message.text
-            # Debugging statement
-            print(f"Editing key: {editing_key}, Value: {update.message.text}")
-            # Reset editing_key
-            context.user_data["editing_key"] = None
-            # Display the summary again
-            await display_summary(update, context)
-            return
-        if (
-            update.message
-            and 0 <= question_index < len(KEYS)
-            and context.user_data["conversation_state"] == "topic"
-        ):
-            context.user_data["data"][KEYS[question_index]] = update.message.text
-        # Check if we've asked all questions
-        if question_index < len(USER_QUESTIONS):
-            current_question = USER_QUESTIONS[question_index]
-            options = QUESTION_OPTIONS.get(current_question)
-            print(options)
-            if options:
-                keyboard = ReplyKeyboardMarkup(
-                    options, one_time_keyboard=True, resize_keyboard=True
-                )
-                await context.bot.send_message(
-                    chat_id=chat_id, text=current_question, reply_markup=keyboard
-                )
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=current_question)
-
-            # Increment the question index for the next question
-            context.user_data[QUESTION_INDEX] = question_index + 1
-        elif question_index == len(USER_QUESTIONS):
-            await display_summary(update, context)
-            return
-        else:
-            # Reset the question index and inform the user that all questions have been asked
-            context.user_data[QUESTION_INDEX] = 0
-            await context.bot.send_message(
-                chat_id=chat_id, text="Thank you for answering all the questions!"
-            )
-
-
-async def send_advice(context, chat_id, user_id):
+
+async def send_advice(bot, chat_id, user_id):
     """
-    Sends advice to the user based on the frequency.
+    Sends one piece of advice to the user, called by the advice scheduler when the user is due.
     """
-    user_preferences = get_user_preferences(user_id)
+    # The scheduler runs in one process, the profile may have been edited in another one
+    user_preferences = await get_user_preferences(user_id, use_cache=False)
     if not user_preferences:
-        # Assuming you have a way to send messages, replace with your method
-        await context.bot.send_message(chat_id, "Could not retrieve your preferences.")
+        await bot.send_message(
+            chat_id,
+            template.render_sync(template_name="no_preferences.jinja2"),
+            rate_limit_args={"lane": BROADCAST},
+        )
+        await advice_scheduler.unsubscribe(user_id)
         return
 
-    frequency = int(user_preferences["FREQUENCY"])
-    interval = 24 * 3600 / frequency  # Convert frequency to interval in seconds
-
-    # Send the first piece of advice immediately
-    advice = await create_advice(
+    advice = await cohort_advice.get(
         user_preferences["TOPIC"],
         user_preferences["DESCRIPTION"],
         user_preferences["LEVEL"],
     )
-    await context.bot.send_message(chat_id, f"Here's your advice!\n{advice}")
-
-    # Then start the loop to send advice at regular intervals
-    while True:
-        # Wait for the next advice based on frequency
-        await asyncio.sleep(interval)
-
-        # Generate and send the next piece of advice
-        advice = await create_advice(
-            user_preferences["TOPIC"],
-            user_preferences["DESCRIPTION"],
-            user_preferences["LEVEL"],
-        )
-        await context.bot.send_message(chat_id, f"Here's your advice!\n{advice}")
+    await bot.send_message(
+        chat_id,
+        template.render_sync(template_name="advice.jinja2", data={"advice": advice}),
+        # Scheduled advices wait behind the replies to users
+        rate_limit_args={"lane": BROADCAST},
+    )
 
 
 async def get_data_from_user(update, context):
@@ -389,46 +347,55 @@ async def get_data_from_user(update, context):
     print(data)
     # Set the conversation state to 'qa_conv'
     # Store data in the database
-    store_user_data(user_id, data)
-    #
-    # # Start the advice loop
-    asyncio.create_task(send_advice(context, chat_id, user_id))
+    await store_user_data(user_id, data)
+    # Generate the subcategories of a new or edited profile before its first advice is due
+    context.application.create_task(
+        category_index.ensure(data["TOPIC"], data["DESCRIPTION"], data["LEVEL"])
+    )
+    # Schedule the advices, the first one is sent on the next tick of the scheduler
+    await advice_scheduler.subscribe(user_id, chat_id, data["FREQUENCY"])
 
     # Send a message to the user with further instructions
-    message = (
-        f"Now, advice will come to you with a frequency of {data['FREQUENCY']} times per day.\n"
-        "To ask a question about the topic, use the command `/ask`.\n"
-        "To get a random piece of advice on the topic, use the command `/advice`."
+    message = template.render_sync(
+        template_name="advice_scheduled.jinja2", data={"frequency": data["FREQUENCY"]}
     )
     await context.bot.send_message(chat_id, message)
 
 
 async def add_topic(update: Update, context: CallbackContext) -> None:
-    """Handles the 'Add Topic' command."""
+    """Handles the 'Add Topic' button, starts the questionnaire"""
     query = update.callback_query
-    await query.answer()
-    if query.data == "add_topic":
-        context.user_data["conversation_state"] = "topic"
-        # Initialize question index and data dictionary
-        context.user_data[QUESTION_INDEX] = 0
-        context.user_data["data"] = {}
-        context.user_data["asking_questions"] = True  # Set the flag
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="What nickname or name should I use to address you?:",
-        )
-    elif query.data == CONFIRM_DATA:
-        context.user_data["conversation_state"] = "qa_conv"
-        await get_data_from_user(update, context)
+    context.user_data["conversation_state"] = "topic"
+    # Initialize question index and data dictionary
+    context.user_data[QUESTION_INDEX] = 0
+    context.user_data["data"] = {}
+    context.user_data["asking_questions"] = True  # Set the flag
+    await ask_question(context, query.message.chat_id, "NAME")
+
+
+async def confirm_data(update: Update, context: CallbackContext) -> None:
+    """Handles the 'Confirm' button, stores the data and schedules the advices"""
+    context.user_data["conversation_state"] = "qa_conv"
+    await get_data_from_user(update, context)
+
+
+# Handlers of the inline buttons by callback data
+CALLBACK_HANDLERS: dict[str, Callable[[Update, CallbackContext], Awaitable[None]]] = {
+    "add_topic": add_topic,
+    CONFIRM_DATA: confirm_data,
+    EDIT_DATA: edit_data_selection,
+    **{key: partial(edit_data_input, key=key) for key in KEYS},
+}
 
-    elif query.data == EDIT_DATA:
-        await edit_data_selection(update, context)
 
-    elif query.data in KEYS:
-        await edit_data_input(update, context, query.data)
-    else:
-        await qa_conversation_handler(update, context)
+async def callback_query_handler(update: Update, context: CallbackContext) -> None:
+    """Routes a press of an inline button to the handler of its callback data"""
+    query = update.callback_query
     # Always answer the callback query to prevent the "loading" animation on the button
+    await query.answer()
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler is not None:
+        await route(f"callback:{query.data}", handler, update, context)
 
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -444,14 +411,14 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "author_profile_url": "https://www.instagram.com/rexxar.ai/",
         "author_email": "riharex420@gmail.com",
     }
-    caption: str = await template.render(template_name="help_cmd.jinja2", data=data)
+    caption: str = template.render_sync(template_name="help_cmd.jinja2", data=data)
     await update.message.reply_photo(photo=BOT_LOGO, caption=caption)
 
 
 async def exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Exit the chat and return to the main menu."""
     await update.message.reply_text(
-        text="Exiting the chat. Returning to the main menu."
+        text=template.render_sync(template_name="exit_chat.jinja2")
     )
     # Set the conversation state to 'idle'
     context.user_data["conversation_state"] = "idle"
@@ -473,4 +440,4 @@ qa_conv_handler: MessageHandler = MessageHandler(
     filters.TEXT & ~filters.COMMAND, qa_conversation_handler
 )
 
-button_handler: CallbackQueryHandler = CallbackQueryHandler(add_topic)
+button_handler: CallbackQueryHandler = CallbackQueryHandler(callback_query_handler)
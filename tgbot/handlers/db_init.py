@@ -1,40 +1,67 @@
-import os
-
-import psycopg2
+from dataclasses import dataclass
 
+from tgbot.config import PREFERENCES_CACHE_SIZE, PREFERENCES_CACHE_TTL
+from tgbot.services.cache import MISSING, TTLCache
+from tgbot.services.database import db
 from tgbot.utils.logger import logger
 
-DATABASE_URL = os.environ.get("DATABASE_URL")
-
-
-def init_db():
-    conn = psycopg2.connect(DATABASE_URL, sslmode="require")
-    with conn.cursor() as cursor:
-        # Create a table to store user data
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id INTEGER PRIMARY KEY,
-                name TEXT,
-                topic TEXT,
-                description TEXT,
-                frequency TEXT,
-                persona TEXT,
-                level TEXT
-            )
+# Read-through cache of user preferences, profiles change only in store_user_data
+preferences_cache: TTLCache = TTLCache(
+    max_size=PREFERENCES_CACHE_SIZE, ttl=PREFERENCES_CACHE_TTL
+)
+
+
+@dataclass
+class _Fill:
+    """Reads of one user's preferences that are in flight, generation counts the invalidations meanwhile"""
+
+    pending: int = 0
+    generation: int = 0
+
+
+# A read that started before an invalidation may return the old row, it is not cached
+_fills: dict[int, _Fill] = {}
+
+SELECT_USER_PREFERENCES = """
+    SELECT name, topic, description, frequency, persona, level FROM user_data WHERE user_id = $1
+"""
+
+UPSERT_USER_DATA = """
+    INSERT INTO user_data (user_id, name, topic, description, frequency, persona, level)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (user_id) DO UPDATE
+    SET name = EXCLUDED.name,
+        topic = EXCLUDED.topic,
+        description = EXCLUDED.description,
+        frequency = EXCLUDED.frequency,
+        persona = EXCLUDED.persona,
+        level = EXCLUDED.level
+"""
+
+
+async def init_db():
+    # Create a table to store user data
+    await db.execute(
         """
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            topic TEXT,
+            description TEXT,
+            frequency TEXT,
+            persona TEXT,
+            level TEXT
         )
-
-    conn.commit()
+    """
+    )
     logger.info("Database initialized and table created if not exists.")
-    conn.close()
 
 
-def store_user_data(user_id, data):
+async def store_user_data(user_id, data):
     """
     Stores or updates user data in the database.
 
-    This function connects to the PostgreSQL database using psycopg2 and either inserts new user data
+    This function takes a connection from the shared asyncpg pool and either inserts new user data
     or updates existing data if the user_id already exists in the database. It uses an UPSERT operation
     (INSERT ... ON CONFLICT DO UPDATE) to achieve this.
 
@@ -48,69 +75,60 @@ def store_user_data(user_id, data):
         - "PERSONA": The type of persona the user has chosen for interaction.
         - "LEVEL": The level of expertise or depth of content the user has requested.
 
-    The function commits the transaction and closes the connection to the database after the operation is complete.
+    The statement runs in autocommit mode and the connection is returned to the pool afterwards.
+    The cached preferences of the user are invalidated once the write succeeded.
     """
-
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(DATABASE_URL, sslmode="require")
-
-    with conn.cursor() as cursor:
-        # Perform an UPSERT operation: insert new data or update existing data based on user_id
-        cursor.execute(
-            """
-            INSERT INTO user_data (user_id, name, topic, description, frequency, persona, level)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE 
-            SET name = EXCLUDED.name,
-                topic = EXCLUDED.topic,
-                description = EXCLUDED.description,
-                frequency = EXCLUDED.frequency,
-                persona = EXCLUDED.persona,
-                level = EXCLUDED.level
-        """,
-            (
-                user_id,
-                data["NAME"],
-                data["TOPIC"],
-                data["DESCRIPTION"],
-                data["FREQUENCY"],
-                data["PERSONA"],
-                data["LEVEL"],
-            ),
-        )
-
-    # Commit the transaction and close the database connection
-    conn.commit()
-    conn.close()
-
-
-def get_user_preferences(user_id):
+    await db.execute(
+        UPSERT_USER_DATA,
+        user_id,
+        data["NAME"],
+        data["TOPIC"],
+        data["DESCRIPTION"],
+        data["FREQUENCY"],
+        data["PERSONA"],
+        data["LEVEL"],
+    )
+    preferences_cache.invalidate(user_id)
+    if user_id in _fills:
+        _fills[user_id].generation += 1
+
+
+async def get_user_preferences(user_id, use_cache=True):
     """
     Retrieves user preferences from the database based on user_id.
+
+    Results, including the absence of a profile, are served from preferences_cache when possible.
+    With use_cache=False the database is always read, for callers in a process that may not see the
+    invalidations (e.g. the scheduler in webhook worker 0, while the profile is edited in another worker).
+    A copy is returned, so callers are free to modify it.
     """
-    conn = psycopg2.connect(DATABASE_URL, sslmode="require")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            """
-            SELECT name, topic, description, frequency, persona, level FROM user_data WHERE user_id = %s
-        """,
-            (user_id,),
-        )  # Use %s as the placeholder
-
-        user_preferences = cursor.fetchone()
-
-        if user_preferences:
-            return {
-                "NAME": user_preferences[0],
-                "TOPIC": user_preferences[1],
-                "DESCRIPTION": user_preferences[2],
-                "FREQUENCY": user_preferences[3],
-                "PERSONA": user_preferences[4],
-                "LEVEL": user_preferences[5],
-            }
-        else:
-            return None
-    finally:
-        cursor.close()
-        conn.close()
+    cached = preferences_cache.get(user_id, default=MISSING) if use_cache else MISSING
+    if cached is MISSING:
+        fill = _fills.setdefault(user_id, _Fill())
+        fill.pending += 1
+        generation = fill.generation
+        try:
+            cached = await _fetch_user_preferences(user_id)
+        finally:
+            fill.pending -= 1
+            if not fill.pending:
+                del _fills[user_id]
+        if fill.generation == generation:
+            preferences_cache.set(user_id, cached)
+    return dict(cached) if cached is not None else None
+
+
+async def _fetch_user_preferences(user_id):
+    user_preferences = await db.fetchrow(SELECT_USER_PREFERENCES, user_id)
+
+    if user_preferences:
+        return {
+            "NAME": user_preferences["name"],
+            "TOPIC": user_preferences["topic"],
+            "DESCRIPTION": user_preferences["description"],
+            "FREQUENCY": user_preferences["frequency"],
+            "PERSONA": user_preferences["persona"],
+            "LEVEL": user_preferences["level"],
+        }
+    else:
+        return None
@@ -9,40 +9,73 @@ Note:
     where a tuple of HANDLERS is assembled for further registration in the application
 """
 import asyncio
-import os
-from typing import Any
-
-import openai
-import tiktoken
-from langchain.chains import ConversationChain
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.memory import ConversationEntityMemory
-from langchain.memory.prompt import ENTITY_MEMORY_CONVERSATION_TEMPLATE
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.tools import Tool
-from langchain.utilities import GoogleSearchAPIWrapper
-from langchain.vectorstores import FAISS
-
+from functools import cache, partial
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+from tgbot.config import (
+    ADVICE_BUFFER_CONCURRENCY,
+    ADVICE_BUFFER_DEPTH,
+    ADVICE_BUFFER_MAX_AGE,
+    ADVICE_COHORT_WINDOW,
+    CATEGORY_CACHE_SIZE,
+    CATEGORY_CACHE_TTL,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MODEL,
+    GOOGLE_SEARCH_TIMEOUT,
+    LLM_REQUEST_TIMEOUT,
+    MEMORY_IDLE_TTL,
+    MEMORY_MAX_ENTITIES,
+    MEMORY_MAX_USERS,
+    MEMORY_PROMPT_TOKENS,
+    PROMPT_TOKEN_BUDGET,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_MAX_PARTITIONS,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
+)
+from tgbot.services.advice_queue import AdviceBuffer
+from tgbot.services.categories import CategoryIndex
+from tgbot.services.cohorts import (
+    CohortAdviceGenerator,
+    normalize,
+    record_pipeline_call,
+)
+from tgbot.services.executors import blocking_io
+from tgbot.services.llm_client import get_openai, llm_client
+from tgbot.services.memory import ConversationMemoryStore
+from tgbot.services.prompts import PromptBuilder, count_tokens, get_encoding
+from tgbot.services.search_cache import normalize_query, search_cache
+from tgbot.services.semantic_cache import OTHER_TOPIC, SemanticAnswerCache
+from tgbot.services.singleflight import SingleFlight, request_key
+from tgbot.services.vector_index import content_hash, vector_indexes
 from tgbot.utils.environment import env
+from tgbot.utils.metrics import metrics, scope
+
+# openai, langchain and FAISS take seconds to import and are not needed to receive the first update,
+# they are imported on first use, or in the background by preload() once the bot has started
+if TYPE_CHECKING:
+    from langchain.chains import LLMChain
+    from langchain.memory import ConversationEntityMemory
+    from langchain.tools import Tool
+    from langchain.vectorstores import FAISS
 
-GOOGLE_CSE_ID = os.environ["GOOGLE_CSE_ID"]
-GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
-openai.api_key = env.get_openai_api()
+    from tgbot.services.embeddings import EmbeddingService
 
 
-def init_conversation():
+@cache
+def get_llm() -> "LLMChain":
     """
-    Initialize a conversation for a given chat_id.
+    Initialize the conversation chain shared by all users, each user's memory is kept in memory_store.
     """
-    llm = ChatOpenAI(temperature=0)  # Assuming OpenAI has an async interface
-    conversation = ConversationChain(
-        llm=llm,
-        prompt=ENTITY_MEMORY_CONVERSATION_TEMPLATE,
-        memory=ConversationEntityMemory(
-            llm=llm, k=10
-        ),  # Assuming ConversationEntityMemory has an async interface
-    )
+    from langchain.chains import LLMChain
+    from langchain.chat_models import ChatOpenAI
+    from langchain.memory.prompt import ENTITY_MEMORY_CONVERSATION_TEMPLATE
+
+    # The answer is streamed token by token
+    llm = ChatOpenAI(temperature=0, streaming=True, request_timeout=LLM_REQUEST_TIMEOUT)
+    conversation = LLMChain(llm=llm, prompt=ENTITY_MEMORY_CONVERSATION_TEMPLATE)
     return conversation
     # vectorstore = Chroma(
     #     embedding_function=OpenAIEmbeddings(), persist_directory="./chroma_db_oai"
@@ -59,7 +92,27 @@ def init_conversation():
     # return qa_chain
 
 
-llm = init_conversation()
+@cache
+def get_memory_llm():
+    """Returns the model of the entity memories, it makes its own, non-streaming calls"""
+    from langchain.chat_models import ChatOpenAI
+
+    return ChatOpenAI(temperature=0, request_timeout=LLM_REQUEST_TIMEOUT)
+
+
+def create_memory() -> "ConversationEntityMemory":
+    """Creates the entity memory of a user"""
+    from langchain.memory import ConversationEntityMemory
+
+    return ConversationEntityMemory(llm=get_memory_llm(), k=10)
+
+
+memory_store = ConversationMemoryStore(
+    create_memory=create_memory,
+    max_users=MEMORY_MAX_USERS,
+    idle_ttl=MEMORY_IDLE_TTL,
+    max_entities=MEMORY_MAX_ENTITIES,
+)
 prompt_template_male = """
 Character: John, analytical and curious, often tackles {user_topic}-related challenges methodically.
 Occupation & Background: [Derived from {user_topic}]
@@ -71,41 +124,254 @@ Occupation & Background: [Derived from {user_topic}]
 """
 personality = {"Male": prompt_template_male, "Female": prompt_template_female}
 
+# Concurrent identical requests to OpenAI and to Google share one call
+llm_requests = SingleFlight(name="openai")
+search_requests = SingleFlight(name="google")
+
+
+@cache
+def get_embeddings() -> "EmbeddingService":
+    """Returns the embedding service, it is created once and reused"""
+    from langchain.embeddings import OpenAIEmbeddings
+
+    from tgbot.services.embeddings import EmbeddingService, embedding_cache
+
+    return EmbeddingService(
+        client=OpenAIEmbeddings(model=EMBEDDING_MODEL),
+        model=EMBEDDING_MODEL,
+        cache=embedding_cache,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        batch_tokens=EMBEDDING_BATCH_TOKENS,
+        concurrency=EMBEDDING_CONCURRENCY,
+        # The async requests share the session and the concurrency limit of the chat calls
+        slot=llm_client.slot,
+    )
+
+
+def close_embeddings() -> None:
+    """Closes the embedding cache, if the embedding service has been used"""
+    if get_embeddings.cache_info().currsize:
+        from tgbot.services.embeddings import embedding_cache
+
+        embedding_cache.close()
+
+
+# Answers to near-identical first questions on the same topic are reused, they know nothing about the user
+answer_cache = SemanticAnswerCache(
+    embed=lambda text: get_embeddings().aembed_query(text),
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl=SEMANTIC_CACHE_TTL,
+    max_partitions=SEMANTIC_CACHE_MAX_PARTITIONS,
+)
+
+
+@cache
+def get_topic_labels() -> frozenset[str]:
+    """Returns the topics offered by the questionnaire, the only topics named in the metrics"""
+    from tgbot.handlers.commands import TOPIC_OPTIONS
+
+    return frozenset(normalize(topic) for row in TOPIC_OPTIONS for topic in row)
+
+
+def topic_label(topic) -> str:
+    topic = normalize(topic)
+    return topic if topic in get_topic_labels() else OTHER_TOPIC
+
 
-async def get_conversation(user_data, query):
+async def lookup_answer(user_data, query):
+    return await answer_cache.lookup(
+        user_data["TOPIC"],
+        user_data["LEVEL"],
+        user_data["PERSONA"],
+        query,
+        label=topic_label(user_data["TOPIC"]),
+    )
+
+
+@cache
+def get_template_tokens() -> int:
+    """Returns the number of tokens of the conversation template without its variables"""
+    from langchain.memory.prompt import ENTITY_MEMORY_CONVERSATION_TEMPLATE
+
+    return count_tokens(
+        ENTITY_MEMORY_CONVERSATION_TEMPLATE.format(entities="", history="", input="")
+    )
+
+
+def fit_memory(variables: dict) -> tuple[dict, int]:
     """
-    Get the conversation output for a given chat_id and query.
+    Trims the entities and the history loaded from the memory to MEMORY_PROMPT_TOKENS,
+    the entity summaries first and then the oldest turns. Returns the variables and the tokens they take.
+    """
+    entities = "\n".join(
+        f"{name}: {summary}" for name, summary in variables["entities"].items()
+    )
+    builder = (
+        PromptBuilder(budget=MEMORY_PROMPT_TOKENS)
+        .add(entities, priority=1)
+        .add(variables["history"], priority=2, keep_end=True)
+    )
+    entities, history = builder.build_parts()
+    return {"entities": entities, "history": history}, builder.token_count
+
+
+def has_history(memory) -> bool:
+    """Whether the memory of the user holds turns or entities, the answers then depend on the user"""
+    return bool(
+        memory.chat_memory.messages or getattr(memory.entity_store, "store", None)
+    )
+
+
+async def build_conversation_prompt(
+    user_data, query, budget=PROMPT_TOKEN_BUDGET, personal=True
+):
+    """
+    Build the conversation prompt for the user's query, grounded in Google search results.
+    With personal=False the name and the description of the user are left out, so the answer can be shared.
     """
-    # Initialize the conversation if it doesn't exist for the chat_id
     # Choose the correct prompt based on the persona
     selected_prompt = (
         personality[user_data["PERSONA"]]
         if user_data["PERSONA"] in personality
         else None
     )
+    name = user_data["NAME"] if personal else "the user"
+    description = user_data["DESCRIPTION"] if personal else user_data["TOPIC"]
     google_search = await search_token(f"{query}. Topic: {user_data['TOPIC']}")
-    # Run the conversation and get the output
-    prompt = f"""
-    As the Daily Advisor AI, your role is to be a knowledgeable and friendly companion to {user_data["NAME"]}. 
+    # Search results are trimmed first, then the description and the query, to fit the token budget
+    prompt = (
+        PromptBuilder(budget=budget)
+        .add(
+            f"""
+    As the Daily Advisor AI, your role is to be a knowledgeable and friendly companion to {name}. 
     You're tasked with providing accurate, reliable answers about {user_data["TOPIC"]}—a topic described as 
-    {user_data["DESCRIPTION"]}. Your responses should be grounded in verifiable facts to ensure trustworthiness.
+    """
+        )
+        .add(description, priority=2)
+        .add(
+            f""". Your responses should be grounded in verifiable facts to ensure trustworthiness.
 
     Embody the character traits assigned to you, maintaining this persona consistently to build rapport with the user. 
     Your character is defined as follows: {selected_prompt.format(user_topic=user_data["TOPIC"])}. 
 
-    Above all, your goal is to support {user_data["NAME"]}'s curiosity and learning about {user_data["TOPIC"]} with 
+    Above all, your goal is to support {name}'s curiosity and learning about {user_data["TOPIC"]} with 
     engaging and informative dialogue. You responses have to be professional and cosine. Answer only based on subject 
     with no additional info.\n    
-    Google Search results: {google_search}
+    Google Search results: """
+        )
+        .add(google_search, priority=1)
+        .add(
+            """
+
+    User query: """
+        )
+        .add(query, priority=3)
+        .add("\n    ")
+        .build()
+    )
+    return prompt
+
+
+async def prepare_conversation(memory, user_data, query, personal=True):
+    """
+    Returns the prompt and the memory variables of the conversation chain, they share PROMPT_TOKEN_BUDGET with
+    the template: the memory takes up to MEMORY_PROMPT_TOKENS and the prompt is trimmed to the rest.
+    With personal=False neither the memory nor the profile of the user go into the prompt.
+    """
+    if personal:
+        # The entity memory is synchronous and calls the LLM, keep it off the event loop
+        variables = await blocking_io.run(
+            "openai", memory.load_memory_variables, {"input": query}
+        )
+        variables, memory_tokens = fit_memory(variables)
+    else:
+        variables, memory_tokens = {"entities": "", "history": ""}, 0
+    prompt = await build_conversation_prompt(
+        user_data,
+        query,
+        budget=PROMPT_TOKEN_BUDGET - get_template_tokens() - memory_tokens,
+        personal=personal,
+    )
+    return prompt, variables
+
 
-    User query: {query}
+async def prepare_answer(entry, user_data, query):
     """
-    # response = llm({"question": query})
-    # output = response["answer"]
-    output = await llm.arun(input=prompt)  # Assuming run is an async method
+    Returns the lookup in answer_cache and the prompt and the variables of the chain, or None for them on a hit.
+    Only a user without history is served from answer_cache, and gets an answer that can be stored there;
+    the lookup is None once the answers depend on the user.
+    """
+    if has_history(entry.memory):
+        return None, await prepare_conversation(entry.memory, user_data, query)
+    cached = await lookup_answer(user_data, query)
+    if cached.answer is not None:
+        return cached, None
+    return cached, await prepare_conversation(
+        entry.memory, user_data, query, personal=False
+    )
+
+
+async def get_conversation(user_id, user_data, query):
+    """
+    Get the conversation output for a given user and query.
+    The first question of a user may be answered from answer_cache, the turn is remembered either way.
+    """
+    entry = await memory_store.acquire(user_id)
+    try:
+        cached, request = await prepare_answer(entry, user_data, query)
+        if request is None:
+            output = cached.answer
+        else:
+            prompt, variables = request
+            metrics.counter("llm_calls", scope=scope.get()).inc()
+            async with llm_client.slot():
+                output = await get_llm().arun(input=prompt, **variables)
+    except BaseException:
+        memory_store.release(entry)
+        raise
+    memory_store.remember(entry, {"input": query}, {"output": output})
+    if cached is not None and request is not None and output.strip():
+        answer_cache.store(cached, output)
     return output
 
 
+async def stream_conversation(user_id, user_data, query) -> AsyncIterator[str]:
+    """
+    Same as get_conversation, but yields the answer token by token as the model produces it.
+    """
+    entry = await memory_store.acquire(user_id)
+    try:
+        cached, request = await prepare_answer(entry, user_data, query)
+        if request is None:
+            output = cached.answer
+            yield output
+        else:
+            prompt, variables = request
+            from langchain.callbacks import AsyncIteratorCallbackHandler
+
+            handler = AsyncIteratorCallbackHandler()
+            metrics.counter("llm_calls", scope=scope.get()).inc()
+            async with llm_client.slot():
+                run = asyncio.create_task(
+                    get_llm().arun(input=prompt, callbacks=[handler], **variables)
+                )
+                # Stop iterating also if the chain fails before the model starts
+                run.add_done_callback(lambda _: handler.done.set())
+                try:
+                    async for token in handler.aiter():
+                        yield token
+                    output = await run
+                finally:
+                    run.cancel()
+    except BaseException:
+        memory_store.release(entry)
+        raise
+    memory_store.remember(entry, {"input": query}, {"output": output})
+    if cached is not None and request is not None and output.strip():
+        answer_cache.store(cached, output)
+
+
 async def generate_category(topic, description, level):
     prompt = f"""
     Based on the main topic of '{topic}', which is briefly described as '{description}', and considering the user's 
@@ -122,6 +388,14 @@ async def generate_category(topic, description, level):
     return category.strip()
 
 
+# The subcategories of a profile are generated once and stored under a hash of the profile
+category_index = CategoryIndex(
+    generate=generate_category,
+    cache_size=CATEGORY_CACHE_SIZE,
+    cache_ttl=CATEGORY_CACHE_TTL,
+)
+
+
 async def search_google_for_data(category, topic):
     search_query = f"Recent developments in {category} related to {topic}"
     search_results = await search_token(search_query)
@@ -129,22 +403,37 @@ async def search_google_for_data(category, topic):
 
 
 async def generate_advice(user_data, google_data):
-    prompt = f"""
-Given the user's specific interests and needs as outlined in their profile: {user_data}, and incorporating the 
-latest findings and data obtained from recent Google searches: {google_data}, formulate a piece of advice. This 
+    # Search results are trimmed before the profile to fit the token budget
+    prompt = (
+        PromptBuilder(budget=PROMPT_TOKEN_BUDGET)
+        .add(
+            """
+Given the user's specific interests and needs as outlined in their profile: """
+        )
+        .add(user_data, priority=2)
+        .add(
+            """, and incorporating the 
+latest findings and data obtained from recent Google searches: """
+        )
+        .add(google_data, priority=1)
+        .add(
+            """, formulate a piece of advice. This 
 advice should be actionable, insightful, and tailored to the user's context. It should leverage the depth of 
 knowledge available within the AI's database as well as the freshness and relevance of the information sourced 
 from the web. Ensure that the guidance provided is coherent, directly applicable to the user's situation, and 
 reflects the most current understanding of the topic at hand.
 """
+        )
+        .build()
+    )
 
     advice = await generate_chat_completion(prompt)
     return advice
 
 
 async def create_advice(topic, description, level):
-    # Step 1: Generate a category from the topic
-    category = await generate_category(topic, description, level)
+    # Step 1: Pick a category from the stored subcategories of the profile
+    category = await category_index.pick(topic, description, level)
 
     # Step 2: Google search for data about the category
     google_data = await search_google_for_data(category, topic)
@@ -161,17 +450,80 @@ async def create_advice(topic, description, level):
     return advice
 
 
-async def search_token(prompt: str) -> Any:
-    search = GoogleSearchAPIWrapper()
+# Advices for cohorts that will be due soon are generated ahead of time by a background job
+advice_buffer = AdviceBuffer(
+    generate=create_advice,
+    depth=ADVICE_BUFFER_DEPTH,
+    max_age=ADVICE_BUFFER_MAX_AGE,
+    concurrency=ADVICE_BUFFER_CONCURRENCY,
+)
+
+# Users sharing a (topic, description, level) profile share one advice per delivery window
+cohort_advice = CohortAdviceGenerator(
+    generate=advice_buffer.take, window=ADVICE_COHORT_WINDOW
+)
 
-    tool = Tool(
+
+@cache
+def get_search_tool() -> "Tool":
+    """Returns the Google search tool, the API client is built once and reused"""
+    from langchain.tools import Tool
+    from langchain.utilities import GoogleSearchAPIWrapper
+
+    search = GoogleSearchAPIWrapper(
+        google_api_key=env.get_google_api(), google_cse_id=env.get_google_cse()
+    )
+    endpoint = env.get_google_api_endpoint()
+    if endpoint is not None:
+        from googleapiclient.discovery import build
+
+        # The wrapper always builds a client of the public API
+        search.search_engine = build(
+            "customsearch",
+            "v1",
+            developerKey=env.get_google_api(),
+            client_options={"api_endpoint": endpoint},
+        )
+
+    return Tool(
         name="Google Search",
         description="Search Google for recent results.",
         func=search.run,  # Synchronous method
     )
 
-    # Run the synchronous code in a thread pool executor
-    return await asyncio.get_event_loop().run_in_executor(None, tool.run, prompt)
+
+async def google_search(prompt: str) -> Any:
+    record_pipeline_call("search")
+    # Run the synchronous code in the dedicated pool for blocking I/O
+    return await blocking_io.run(
+        "google", get_search_tool().run, prompt, timeout=GOOGLE_SEARCH_TIMEOUT
+    )
+
+
+async def coalesced_google_search(prompt: str) -> Any:
+    # Identical searches that miss the cache at the same time are sent once
+    return await search_requests.do(
+        request_key(normalize_query(prompt)), partial(google_search, prompt)
+    )
+
+
+async def search_token(prompt: str) -> Any:
+    return await search_cache.get_or_fetch(query=prompt, fetch=coalesced_google_search)
+
+
+async def create_chat_completion(data: dict) -> str:
+    metrics.counter("llm_calls", scope=scope.get()).inc()
+    record_pipeline_call("llm")
+    response = await llm_client.chat_completion(**data)
+    return response["choices"][0]["message"]["content"]
+
+
+async def create_completion(data: dict) -> str:
+    metrics.counter("llm_calls", scope=scope.get()).inc()
+    record_pipeline_call("llm")
+    response = await llm_client.completion(**data)
+    # Extract the bot's response from the generated text
+    return response["choices"][0]["text"]
 
 
 async def generate_chat_completion(input_data):
@@ -192,11 +544,10 @@ async def generate_chat_completion(input_data):
         "frequency_penalty": 1.5,
         "presence_penalty": 1,
     }
-    response = await openai.ChatCompletion.acreate(**data)
-
-    responses = response["choices"][0]["message"]["content"]
-
-    return responses
+    # The request is deterministic, identical requests in flight at the same time are sent once
+    return await llm_requests.do(
+        request_key("ChatCompletion", data), partial(create_chat_completion, data)
+    )
 
 
 async def generate_chat(input_data, message):
@@ -216,11 +567,10 @@ async def generate_chat(input_data, message):
         "frequency_penalty": 1.5,
         "presence_penalty": 1,
     }
-    response = await openai.ChatCompletion.acreate(**data)
-
-    responses = response["choices"][0]["message"]["content"]
-
-    return responses
+    # The request is deterministic, identical requests in flight at the same time are sent once
+    return await llm_requests.do(
+        request_key("ChatCompletion", data), partial(create_chat_completion, data)
+    )
 
 
 async def generate_completion(query: str) -> str:
@@ -234,10 +584,10 @@ async def generate_completion(query: str) -> str:
         "presence_penalty": 0.35,
         "best_of": 2,
     }
-    response = await openai.Completion.acreate(**data)
-    # Extract the bot's response from the generated text
-    answer = response["choices"][0]["text"]
-    return answer
+    # The request is deterministic, identical requests in flight at the same time are sent once
+    return await llm_requests.do(
+        request_key("Completion", data), partial(create_completion, data)
+    )
 
 
 def ask_question(qa, question: str, chat_history):
@@ -256,10 +606,13 @@ def ask_question(qa, question: str, chat_history):
 async def generate_response(query: str, vectorstore) -> str:
     knowledge = []
     # TODO: Test different things like similarity
-    for doc in vectorstore.max_marginal_relevance_search(query, k=10):
+    # The search embeds the query, keep it off the event loop
+    for doc in await blocking_io.run(
+        "openai", vectorstore.max_marginal_relevance_search, query, k=10
+    ):
         knowledge.append(doc)
 
-    response = openai.ChatCompletion.create(
+    response = await llm_client.chat_completion(
         model="gpt-4",
         messages=[
             {"role": "system", "content": ()},
@@ -277,26 +630,52 @@ async def generate_response(query: str, vectorstore) -> str:
 
 
 def tiktoken_len(text: str) -> int:
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    tokens = tokenizer.encode(text, disallowed_special=())
-    return len(tokens)
+    return count_tokens(text)
+
 
+def process_recursive(documents, doc_id=None) -> "FAISS":
+    from tgbot.services.splitter import TokenWindowSplitter
 
-def process_recursive(documents) -> FAISS:
-    text_splitter = RecursiveCharacterTextSplitter(
+    # Tokenizes the document once, chunks are cut on token offsets
+    text_splitter = TokenWindowSplitter(
         chunk_size=900,
         chunk_overlap=200,
-        length_function=tiktoken_len,
-        separators=["\n\n", "\n", " ", ""],
+        separators=("\n\n", "\n", " "),
     )
-    embeddings = OpenAIEmbeddings()
     text_chunks = text_splitter.split_text(documents)
-    db = FAISS.from_texts(texts=text_chunks, embedding=embeddings)
-    return db
+    return get_vectorstore(text_chunks, doc_id=doc_id or content_hash(documents))
 
 
 # Create a vector store indexes from the pdfs
-def get_vectorstore(text_chunks: list[str]) -> FAISS:
-    embeddings = OpenAIEmbeddings()
-    vectorstore = FAISS.from_texts(texts=text_chunks, embedding=embeddings)
-    return vectorstore
+def get_vectorstore(
+    text_chunks: list[str], doc_id: str | None = None, index_name: str = "documents"
+) -> "FAISS":
+    """
+    Adds the chunks to the persistent vector index as one document and returns a vector store over the index.
+    Only the chunks that are not indexed yet are embedded; passing the doc_id of an indexed document replaces it.
+    """
+    index = vector_indexes.get(index_name, embeddings=get_embeddings())
+    index.add_document(doc_id or content_hash("\n".join(text_chunks)), text_chunks)
+    index.save()
+    return index.as_vectorstore()
+
+
+def preload() -> None:
+    """
+    Imports the heavy dependencies and builds the shared clients, so the first question after a start does not
+    wait for them. Run in a thread once the bot has started.
+    """
+    # With a cold cache tiktoken downloads the encoding with blocking requests, every chat needs it first
+    get_encoding()
+
+    from langchain.callbacks import AsyncIteratorCallbackHandler  # noqa: F401
+    from langchain.schema.messages import messages_from_dict  # noqa: F401
+
+    import faiss  # noqa: F401
+
+    get_openai()
+    get_llm()
+    get_memory_llm()
+    # The wrapper imports googleapiclient and builds the Custom Search client from its discovery document
+    get_search_tool()
+    get_embeddings()
@@ -1,4 +1,27 @@
 """
 In this package, you can implement modules that are responsible for the business logic of the application,
 such as database operation, mass mailing, etc.
+
+Modules:
+    advice_queue.py   - advices generated ahead of their due time for every cohort
+    cache.py          - in-process LRU cache with a time to live for its entries
+    categories.py     - persistent index of subcategories of user profiles
+    cohorts.py        - advice generation shared by users with the same profile
+    database.py       - asynchronous pool of connections to the PostgreSQL database
+    embeddings.py     - batched embeddings with a content-addressed, memory-mapped cache
+    executors.py      - dedicated thread pool for blocking calls to external services
+    history.py        - bounded, token-aware chat history with a compact binary format
+    llm_client.py     - shared client of the OpenAI API with a connection pool and retries
+    memory.py         - per-user conversation memory spilled to the database when idle
+    persistence.py    - persistence of user, chat and bot data in the database
+    prompts.py        - token-budgeted assembly of LLM prompts
+    rate_limiter.py   - rate limiting of outbound messages with priority lanes
+    scheduler.py      - durable scheduler of advice deliveries
+    search_cache.py   - persistent cache of web search results
+    semantic_cache.py - semantic cache of chat answers
+    singleflight.py   - coalescing of identical concurrent requests
+    splitter.py       - single-pass, token-aware text splitter
+    streaming.py      - streaming of LLM answers into a Telegram message
+    vector_index.py   - persistent, incremental FAISS indexes of text chunks
+    webhook.py        - webhook server that shards updates between worker processes
 """
@@ -0,0 +1,152 @@
+"""
+Pre-generated advice
+Contains the AdviceBuffer class and the buffer of ready advices kept for every cohort
+
+A background job looks ahead at the subscriptions that will be due soon and generates advices for their
+cohorts ahead of time, a few at a time, so that generation load is spread out instead of peaking on the
+schedule boundaries. When a subscription becomes due, its advice is taken from the buffer and sent at once;
+only if the buffer is empty is the advice generated on the spot. Advices older than `max_age` are discarded.
+
+Example:
+    Create the buffer around the advice pipeline and register the refill job:
+        advice_buffer = AdviceBuffer(generate=create_advice, depth=2, max_age=6 * 3600, concurrency=2)
+        advice_buffer.start(job_queue=application.job_queue, upcoming=advice_scheduler.upcoming_profiles)
+
+    Take an advice when it is due:
+        advice: str = await advice_buffer.take(topic, description, level)
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from telegram.ext import CallbackContext, JobQueue
+
+from tgbot.config import ADVICE_BUFFER_LOOKAHEAD, ADVICE_BUFFER_REFILL_INTERVAL
+from tgbot.services.cohorts import CohortKey, cohort_key
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+Profile = tuple[str, str, str]
+Generate = Callable[[str, str, str], Awaitable[str]]
+
+
+class AdviceBuffer:
+    """Keeps a few ready advices for every cohort that will be due soon"""
+
+    def __init__(
+        self,
+        generate: Generate,
+        depth: int,
+        max_age: float,
+        concurrency: int,
+        timer: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param generate: the advice pipeline: generate(topic, description, level) -> advice
+        :type generate: Generate
+        :param depth: how many advices are kept ready for each cohort
+        :type depth: int
+        :param max_age: seconds after which a buffered advice is considered stale and discarded
+        :type max_age: float
+        :param concurrency: how many advices are generated at once by the refill job
+        :type concurrency: int
+        :param timer: source of the current time
+        :type timer: Callable[[], float]
+        """
+        self._generate: Generate = generate
+        self._depth: int = depth
+        self._max_age: float = max_age
+        self._concurrency: int = concurrency
+        self._timer: Callable[[], float] = timer
+        self._buffers: dict[CohortKey, deque[tuple[float, str]]] = {}
+        self._upcoming: Callable[[float], Awaitable[list[Profile]]] | None = None
+
+    def depth(self, key: CohortKey) -> int:
+        return len(self._buffers.get(key, ()))
+
+    def _update_depth_metric(self) -> None:
+        metrics.gauge("advice_buffer_depth").set(
+            sum(len(buffer) for buffer in self._buffers.values())
+        )
+
+    def _drop_stale(self, key: CohortKey) -> deque[tuple[float, str]]:
+        buffer: deque[tuple[float, str]] = self._buffers.setdefault(key, deque())
+        now: float = self._timer()
+        expired: int = 0
+        while buffer and now - buffer[0][0] > self._max_age:
+            buffer.popleft()
+            expired += 1
+        if expired:
+            metrics.counter("advice_buffer_expired").inc(expired)
+            self._update_depth_metric()
+        return buffer
+
+    async def take(self, topic: str, description: str, level: str) -> str:
+        """Returns a ready advice for the cohort, or generates one if the buffer is empty"""
+        key: CohortKey = cohort_key(topic, description, level)
+        buffer: deque[tuple[float, str]] = self._drop_stale(key)
+        if buffer:
+            generated_at, advice = buffer.popleft()
+            metrics.counter("advice_buffer_hits").inc()
+            metrics.histogram(
+                "advice_buffer_staleness_seconds",
+                buckets=(60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400),
+            ).observe(self._timer() - generated_at)
+            self._update_depth_metric()
+            return advice
+        metrics.counter("advice_buffer_misses").inc()
+        return await self._generate(topic, description, level)
+
+    async def refill(self, profiles: list[Profile]) -> None:
+        """Generates advices for the cohorts of the profiles until every buffer has `depth` advices"""
+        wanted: dict[CohortKey, Profile] = {}
+        for topic, description, level in profiles:
+            key: CohortKey = cohort_key(topic, description, level)
+            if len(self._drop_stale(key)) < self._depth:
+                wanted.setdefault(key, (topic, description, level))
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def fill(key: CohortKey, profile: Profile) -> None:
+            while self.depth(key) < self._depth:
+                async with semaphore:
+                    try:
+                        advice: str = await self._generate(*profile)
+                    except Exception as exc:
+                        logger.warning("Failed to pre-generate advice: %s", repr(exc))
+                        return
+                self._buffers[key].append((self._timer(), advice))
+                self._update_depth_metric()
+
+        await asyncio.gather(*(fill(key, profile) for key, profile in wanted.items()))
+        # Cohorts that are no longer due soon do not need their (now empty) buffers
+        for key in [key for key, buffer in self._buffers.items() if not buffer]:
+            del self._buffers[key]
+
+    def start(
+        self,
+        job_queue: JobQueue,
+        upcoming: Callable[[float], Awaitable[list[Profile]]],
+    ) -> None:
+        """
+        Registers the refill job in the job queue of the application
+
+        :param job_queue: job queue of the application
+        :type job_queue: JobQueue
+        :param upcoming: coroutine function that returns the profiles due within the given number of seconds
+        :type upcoming: Callable[[float], Awaitable[list[Profile]]]
+        """
+        self._upcoming = upcoming
+        job_queue.run_repeating(
+            callback=self._tick,
+            interval=ADVICE_BUFFER_REFILL_INTERVAL,
+            first=ADVICE_BUFFER_REFILL_INTERVAL,
+            name="advice_buffer_refill",
+            job_kwargs={"max_instances": 1, "coalesce": True},
+        )
+
+    async def _tick(self, context: CallbackContext) -> None:
+        await self.refill(await self._upcoming(ADVICE_BUFFER_LOOKAHEAD))
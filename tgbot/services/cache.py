@@ -0,0 +1,104 @@
+"""
+In-process caches used in front of slow data sources
+Contains the TTLCache class, a size-bounded LRU cache whose entries expire after a fixed time to live
+
+Example:
+    Create a cache and use it in front of a database query:
+        cache: TTLCache = TTLCache(max_size=10_000, ttl=300)
+        value = cache.get(key, default=MISSING)
+        if value is MISSING:
+            value = await fetch_from_database(key)
+            cache.set(key, value)
+
+    Invalidate an entry when the data changes:
+        cache.invalidate(key)
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+MISSING: Any = object()
+
+
+class TTLCache:
+    """Least recently used cache with a time to live for every entry"""
+
+    def __init__(
+        self, max_size: int, ttl: float, timer: Callable[[], float] = time.monotonic
+    ) -> None:
+        """
+        Initializing a class
+
+        :param max_size: maximum number of entries, the least recently used entry is evicted when it is exceeded
+        :type max_size: int
+        :param ttl: time to live of an entry in seconds
+        :type ttl: float
+        :param timer: source of the current time, monotonic clock by default
+        :type timer: Callable[[], float]
+        """
+        self._max_size: int = max_size
+        self._ttl: float = ttl
+        self._timer: Callable[[], float] = timer
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, default=MISSING, count=False) is not MISSING
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        """
+        Returns the cached value or default if the key is absent or expired
+
+        :param key: cache key
+        :param default: the value returned on a miss
+        :param count: whether the lookup is taken into account in the hit/miss counters
+        """
+        entry: tuple[float, Any] | None = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self._timer():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Stores the value, evicting the least recently used entries if the cache is full"""
+        self._data[key] = (self._timer() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Removes the entry, if any"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes all entries"""
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups: int = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, float]:
+        """Returns the counters of the cache"""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
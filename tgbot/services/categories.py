@@ -0,0 +1,139 @@
+"""
+Persistent index of subcategories of user profiles
+Contains the CategoryIndex class, which generates the subcategories of a profile once and stores them
+
+The subcategories of a (topic, description, level) profile do not change, so they are generated once, when the
+profile is created or edited, and stored in the category_index table under a hash of the normalized profile.
+Every advice run then picks one of the stored subcategories locally instead of calling the completion model.
+A changed profile has a different hash, so it never sees the subcategories of its previous version.
+
+Example:
+    Build the index of a profile in the background after it was stored:
+        context.application.create_task(category_index.ensure(topic, description, level))
+
+    Pick a subcategory for an advice:
+        category: str = await category_index.pick(topic, description, level)
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+from typing import Awaitable, Callable
+
+from tgbot.services.cache import MISSING, TTLCache
+from tgbot.services.cohorts import cohort_key
+from tgbot.services.database import db
+from tgbot.utils.metrics import metrics
+
+# Numbering, bullets and quotes around the items of a generated list
+_LIST_ITEM = re.compile(r"""^\s*(?:[-*•]|\d+[.)])?\s*["'“]?(.*?)["'”]?[.,;]?\s*$""")
+
+
+def profile_hash(topic: str, description: str, level: str) -> str:
+    """Returns the key of the profile in the index, equal for profiles that belong to one cohort"""
+    return hashlib.sha256(
+        "\x1f".join(cohort_key(topic, description, level)).encode()
+    ).hexdigest()
+
+
+def parse_categories(text: str) -> list[str]:
+    """Splits a generated list into its items, one item per line or comma-separated"""
+    lines: list[str] = [line for line in text.splitlines() if line.strip()]
+    if len(lines) == 1:
+        lines = lines[0].split(",")
+    categories: list[str] = []
+    for line in lines:
+        item: str = _LIST_ITEM.match(line).group(1).strip()
+        # A heading such as "Subcategories:" is not a category
+        if item and not item.endswith(":") and item not in categories:
+            categories.append(item)
+    return categories
+
+
+class CategoryIndex:
+    """Generates the subcategories of every profile once and keeps them in the database"""
+
+    def __init__(
+        self,
+        generate: Callable[[str, str, str], Awaitable[str]],
+        cache_size: int,
+        cache_ttl: float,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param generate: generates the list of subcategories: generate(topic, description, level) -> text
+        :type generate: Callable[[str, str, str], Awaitable[str]]
+        :param cache_size: maximum number of profiles whose subcategories are kept in process
+        :type cache_size: int
+        :param cache_ttl: time to live of the subcategories kept in process in seconds
+        :type cache_ttl: float
+        """
+        self._generate: Callable[[str, str, str], Awaitable[str]] = generate
+        self._cache: TTLCache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self._building: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    async def init_schema() -> None:
+        """Creates the table of the index"""
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS category_index (
+                profile_hash TEXT PRIMARY KEY,
+                categories JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """
+        )
+
+    async def get(self, topic: str, description: str, level: str) -> list[str]:
+        """Returns the subcategories of the profile, generating and storing them if the profile is new"""
+        key: str = profile_hash(topic, description, level)
+        categories: list[str] = self._cache.get(key, default=MISSING)
+        if categories is not MISSING:
+            return categories
+        row = await db.fetchrow(
+            "SELECT categories FROM category_index WHERE profile_hash = $1", key
+        )
+        if row is not None:
+            categories = json.loads(row["categories"])
+        else:
+            # Concurrent requests for a new profile wait for one generation
+            task: asyncio.Task | None = self._building.get(key)
+            if task is None:
+                task = asyncio.create_task(self._build(key, topic, description, level))
+                self._building[key] = task
+                task.add_done_callback(lambda _: self._building.pop(key, None))
+            categories = await asyncio.shield(task)
+        self._cache.set(key, categories)
+        return categories
+
+    async def _build(
+        self, key: str, topic: str, description: str, level: str
+    ) -> list[str]:
+        metrics.counter("category_index_builds").inc()
+        categories: list[str] = parse_categories(
+            await self._generate(topic, description, level)
+        )
+        await db.execute(
+            """
+            INSERT INTO category_index (profile_hash, categories)
+            VALUES ($1, $2::jsonb)
+            ON CONFLICT (profile_hash) DO UPDATE SET categories = EXCLUDED.categories
+        """,
+            key,
+            json.dumps(categories),
+        )
+        return categories
+
+    async def ensure(self, topic: str, description: str, level: str) -> None:
+        """Builds the index of the profile if it does not exist yet, called when a profile is stored"""
+        await self.get(topic, description, level)
+
+    async def pick(self, topic: str, description: str, level: str) -> str:
+        """Returns a random subcategory of the profile, or the topic itself if none were generated"""
+        categories: list[str] = await self.get(topic, description, level)
+        metrics.counter("category_index_picks").inc()
+        return random.choice(categories) if categories else topic
@@ -0,0 +1,120 @@
+"""
+Cohort-level advice generation
+Contains the CohortAdviceGenerator class, which runs the advice pipeline once per cohort and delivery window
+
+Users whose profiles normalize to the same (topic, description, level) key form a cohort. Within one delivery
+window every member of the cohort receives the result of a single pipeline run, and members that become due
+while the run is still in flight wait for it instead of starting their own.
+
+The pipeline reports the network calls it makes with record_pipeline_call, a run counts them in its own
+context, so the calls saved by sharing it are the calls it actually made: none when the advice came from a
+buffer of ready advices.
+
+Example:
+    Create a generator around the pipeline:
+        cohort_advice = CohortAdviceGenerator(generate=create_advice, window=900)
+
+    Get an advice for a user:
+        advice: str = await cohort_advice.get(topic, description, level)
+"""
+
+import asyncio
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+from tgbot.utils.metrics import metrics
+
+CohortKey = tuple[str, str, str]
+
+# Network calls of the pipeline run of the current task, by kind ("llm", "search")
+_pipeline_calls: ContextVar[Counter | None] = ContextVar("pipeline_calls", default=None)
+
+
+def record_pipeline_call(kind: str) -> None:
+    """Counts a network call of the kind in the pipeline run of the current task, if there is one"""
+    calls: Counter | None = _pipeline_calls.get()
+    if calls is not None:
+        calls[kind] += 1
+
+
+def normalize(value: str | None) -> str:
+    """Collapses whitespace and case, so that trivially different answers fall into one cohort"""
+    return " ".join(str(value or "").split()).casefold()
+
+
+def cohort_key(topic: str, description: str, level: str) -> CohortKey:
+    """Returns the key of the cohort the profile belongs to"""
+    return normalize(topic), normalize(description), normalize(level)
+
+
+class CohortAdviceGenerator:
+    """Shares one advice pipeline run between all members of a cohort within a delivery window"""
+
+    def __init__(
+        self,
+        generate: Callable[[str, str, str], Awaitable[str]],
+        window: float,
+        timer: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param generate: the advice pipeline: generate(topic, description, level) -> advice
+        :type generate: Callable[[str, str, str], Awaitable[str]]
+        :param window: length of the delivery window in seconds
+        :type window: float
+        :param timer: source of the current time
+        :type timer: Callable[[], float]
+        """
+        self._generate: Callable[[str, str, str], Awaitable[str]] = generate
+        self._window: float = window
+        self._timer: Callable[[], float] = timer
+        self._runs: dict[CohortKey, tuple[int, asyncio.Task]] = {}
+
+    async def _run(
+        self, topic: str, description: str, level: str
+    ) -> tuple[str, Counter]:
+        """Runs the pipeline in its own task and returns the advice with the network calls it made"""
+        calls: Counter = Counter()
+        _pipeline_calls.set(calls)
+        return await self._generate(topic, description, level), calls
+
+    def _current_window(self) -> int:
+        return int(self._timer() // self._window)
+
+    def _prune(self, window: int) -> None:
+        """Forgets the results of past windows"""
+        for key in [
+            key for key, (run_window, _) in self._runs.items() if run_window < window
+        ]:
+            del self._runs[key]
+
+    async def get(self, topic: str, description: str, level: str) -> str:
+        """Returns the advice of the cohort for the current window, running the pipeline if needed"""
+        key: CohortKey = cohort_key(topic, description, level)
+        window: int = self._current_window()
+        metrics.counter("advice_requests").inc()
+
+        run: tuple[int, asyncio.Task] | None = self._runs.get(key)
+        if run is not None and run[0] == window:
+            metrics.counter("advice_cohort_shared").inc()
+            advice, calls = await asyncio.shield(run[1])
+            metrics.counter("advice_llm_calls_saved").inc(calls["llm"])
+            metrics.counter("advice_search_calls_saved").inc(calls["search"])
+            return advice
+
+        self._prune(window)
+        task: asyncio.Task = asyncio.create_task(self._run(topic, description, level))
+        self._runs[key] = (window, task)
+        task.add_done_callback(lambda done: self._forget_failed(key, done))
+        metrics.counter("advice_pipeline_runs").inc()
+        advice, _ = await asyncio.shield(task)
+        return advice
+
+    def _forget_failed(self, key: CohortKey, task: asyncio.Task) -> None:
+        """A failed run is not shared, the next member of the cohort starts a new one"""
+        if task.cancelled() or task.exception() is not None:
+            if self._runs.get(key, (None, None))[1] is task:
+                del self._runs[key]
@@ -0,0 +1,112 @@
+"""
+Asynchronous access to the PostgreSQL database
+Contains the Database class, which owns a pool of connections, and db - object of the Database class
+
+The pool is opened once when the application starts and closed when it stops, so handlers never pay for
+a TLS handshake and never block the event loop. asyncpg keeps a per-connection cache of server-side
+prepared statements, so repeated queries (the preferences SELECT and the profile UPSERT) are parsed and
+planned by the server only once per connection.
+
+Example:
+    Open the pool in post_init and close it in post_shutdown:
+        await db.connect()
+        ...
+        await db.close()
+
+    Run a query from a handler:
+        row = await db.fetchrow("SELECT name FROM user_data WHERE user_id = $1", user_id)
+"""
+
+from typing import Any
+
+import asyncpg
+
+from tgbot.utils.environment import env
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics, scope
+
+
+class Database:
+    """Pool of asynchronous connections to the PostgreSQL database"""
+
+    def __init__(self, statement_cache_size: int = 100) -> None:
+        """
+        Initializing a class
+
+        :param statement_cache_size: how many prepared statements each connection keeps on the server
+        :type statement_cache_size: int
+        """
+        self._statement_cache_size: int = statement_cache_size
+        self._pool: asyncpg.Pool | None = None
+
+    @property
+    def pool(self) -> asyncpg.Pool:
+        """Returns the connection pool, failing loudly if it has not been opened yet"""
+        if self._pool is None:
+            raise RuntimeError(
+                "Database pool is not initialized, call db.connect() first"
+            )
+        return self._pool
+
+    async def connect(
+        self,
+        dsn: str | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+    ) -> None:
+        """
+        Opens the connection pool, the size of the pool is taken from the environment if not passed
+
+        :param dsn: database connection string
+        :type dsn: str | None
+        :param min_size: number of connections opened at startup
+        :type min_size: int | None
+        :param max_size: maximum number of connections in the pool
+        :type max_size: int | None
+        """
+        if self._pool is not None:
+            return
+        default_min_size, default_max_size = env.get_db_pool_size()
+        self._pool = await asyncpg.create_pool(
+            dsn=dsn or env.get_database_url(),
+            min_size=min_size or default_min_size,
+            max_size=max_size or default_max_size,
+            statement_cache_size=self._statement_cache_size,
+            ssl=env.get_database_sslmode(),
+        )
+        logger.info(
+            "Database pool opened (min_size=%s, max_size=%s)",
+            self._pool.get_min_size(),
+            self._pool.get_max_size(),
+        )
+
+    async def close(self) -> None:
+        """Closes all connections of the pool"""
+        if self._pool is None:
+            return
+        await self._pool.close()
+        self._pool = None
+        logger.info("Database pool closed")
+
+    async def execute(self, query: str, *args: Any) -> str:
+        """Executes a query and returns the status of the last command"""
+        metrics.counter("db_queries", scope=scope.get()).inc()
+        return await self.pool.execute(query, *args)
+
+    async def executemany(self, query: str, args: list[tuple]) -> None:
+        """Executes a query for each sequence of arguments"""
+        metrics.counter("db_queries", scope=scope.get()).inc()
+        await self.pool.executemany(query, args)
+
+    async def fetch(self, query: str, *args: Any) -> list[asyncpg.Record]:
+        """Executes a query and returns all rows"""
+        metrics.counter("db_queries", scope=scope.get()).inc()
+        return await self.pool.fetch(query, *args)
+
+    async def fetchrow(self, query: str, *args: Any) -> asyncpg.Record | None:
+        """Executes a query and returns the first row or None"""
+        metrics.counter("db_queries", scope=scope.get()).inc()
+        return await self.pool.fetchrow(query, *args)
+
+
+db: Database = Database()
@@ -0,0 +1,414 @@
+"""
+Batched, cached embeddings
+Contains the EmbeddingCache class, a content-addressed store of vectors in a memory-mapped file, the
+EmbeddingService class that embeds texts through it, and embedding_cache - object of the EmbeddingCache class
+
+A text is embedded once per model: its vector is kept under sha256(model, text) as float16 in a memory-mapped
+file, so indexing overlapping corpora only embeds the new chunks, also after a restart. Texts that are not
+cached are deduplicated, grouped into batches limited by size and by tokens, and the batches are sent
+concurrently up to a limit. The service is a langchain Embeddings, so it can be passed to FAISS and to
+VectorIndex directly.
+
+The async methods read and write the files in the blocking_io pool, not on the event loop. Queries are not
+written to the files, one-off questions would fill them: their vectors are kept in process for a while. The
+files hold at most EMBEDDING_CACHE_MAX_ROWS vectors, when they are full the oldest half is dropped by writing
+the newest half to files of a new generation, which replace the old ones at once by a rewrite of meta.json.
+
+Several processes (the webhook workers) can share the directory. A write holds an exclusive lock on its lock
+file, and first takes in the rows that the other processes have appended, or the files of a newer generation,
+so every row is written by one process at a time. Reads do not take the lock: rows written by other processes
+since the last write of this process are misses until then.
+
+Example:
+    Wrap the OpenAI client:
+        embeddings = EmbeddingService(client=OpenAIEmbeddings(), model="text-embedding-ada-002", cache=embedding_cache)
+        vectors: list[list[float]] = await embeddings.aembed_documents(chunks)
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from os.path import exists, getsize, join
+from typing import AsyncContextManager, BinaryIO, Callable, Iterator
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from tgbot.config import (
+    EMBEDDING_CACHE_DIR,
+    EMBEDDING_CACHE_MAX_ROWS,
+    EMBEDDING_QUERY_CACHE_SIZE,
+    EMBEDDING_QUERY_CACHE_TTL,
+)
+from tgbot.services.cache import MISSING, TTLCache
+from tgbot.services.executors import blocking_io
+from tgbot.services.prompts import count_tokens
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+KEY_SIZE: int = 32  # bytes of a sha256 digest
+# Rows added to the file of vectors when it is full
+GROWTH_ROWS: int = 4096
+
+
+def embedding_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\x00{text}".encode()).digest()
+
+
+class EmbeddingCache:
+    """Content-addressed store of float16 vectors in a memory-mapped file"""
+
+    def __init__(
+        self, directory: str, max_rows: int = EMBEDDING_CACHE_MAX_ROWS
+    ) -> None:
+        """
+        Initializing a class
+
+        :param directory: directory of the cache files, created on the first write
+        :type directory: str
+        :param max_rows: maximum number of vectors, the oldest half is dropped when it is exceeded
+        :type max_rows: int
+        """
+        self._directory: str = directory
+        self._max_rows: int = max_rows
+        self._lock: threading.Lock = threading.Lock()
+        self._rows: dict[bytes, int] | None = None
+        self._dimension: int | None = None
+        self._generation: int = 0
+        self._vectors: np.ndarray | None = None
+        self._keys: BinaryIO | None = None
+
+    def _file(self, name: str, extension: str) -> str:
+        # The first generation keeps the names of the files written before compaction existed
+        suffix: str = f".{self._generation}" if self._generation else ""
+        return join(self._directory, f"{name}{suffix}.{extension}")
+
+    @property
+    def _keys_file(self) -> str:
+        return self._file("keys", "bin")
+
+    @property
+    def _vectors_file(self) -> str:
+        return self._file("vectors", "f16")
+
+    @property
+    def _meta_file(self) -> str:
+        return join(self._directory, "meta.json")
+
+    @property
+    def _lock_file(self) -> str:
+        return join(self._directory, "lock")
+
+    def _open(self) -> dict[bytes, int]:
+        """Reads the keys and maps the vectors, on first use"""
+        if self._rows is None:
+            self._rows = {}
+            if exists(self._meta_file):
+                with open(self._meta_file, encoding="utf-8") as file:
+                    meta: dict[str, int] = json.load(file)
+                self._dimension = meta["dimension"]
+                self._generation = meta.get("generation", 0)
+                with open(self._keys_file, "rb") as file:
+                    keys: bytes = file.read()
+                # A key is only written after its vector, a torn last key is ignored
+                for row in range(len(keys) // KEY_SIZE):
+                    self._rows[keys[row * KEY_SIZE : (row + 1) * KEY_SIZE]] = row
+                self._map(getsize(self._vectors_file) // (2 * self._dimension))
+        return self._rows
+
+    def _map(self, capacity: int) -> None:
+        if capacity == 0:
+            # An empty file cannot be memory-mapped
+            self._vectors = np.zeros((0, self._dimension), dtype=np.float16)
+            return
+        self._vectors = np.memmap(
+            self._vectors_file,
+            dtype=np.float16,
+            mode="r+",
+            shape=(capacity, self._dimension),
+        )
+
+    def __len__(self) -> int:
+        return len(self._open())
+
+    @contextmanager
+    def _writing(self) -> Iterator[dict[bytes, int]]:
+        """Holds the lock of the files for the writers of all processes, yields the up to date rows"""
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self._lock_file, "ab") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self._refresh()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self) -> dict[bytes, int]:
+        """Takes in the rows that other processes have written since the files were read"""
+        rows: dict[bytes, int] = self._open()
+        if not exists(self._meta_file):
+            return rows
+        with open(self._meta_file, encoding="utf-8") as file:
+            generation: int = json.load(file).get("generation", 0)
+        if self._dimension is None or generation != self._generation:
+            # The files were created or compacted by another process
+            self._release()
+            self._rows = None
+            return self._open()
+        with open(self._keys_file, "rb") as file:
+            file.seek(len(rows) * KEY_SIZE)
+            keys: bytes = file.read()
+        for offset in range(0, len(keys) - KEY_SIZE + 1, KEY_SIZE):
+            rows[keys[offset : offset + KEY_SIZE]] = len(rows)
+        capacity: int = getsize(self._vectors_file) // (2 * self._dimension)
+        if capacity > self._vectors.shape[0]:
+            self._release()
+            self._map(capacity)
+        return rows
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, list[float]]:
+        """Returns the cached vectors of the keys that are in the cache"""
+        with self._lock:
+            rows: dict[bytes, int] = self._open()
+            return {
+                key: self._vectors[rows[key]].astype(np.float32).tolist()
+                for key in keys
+                if key in rows
+            }
+
+    def put_many(self, items: dict[bytes, list[float]]) -> None:
+        """Stores the vectors, keys that are already cached are skipped"""
+        with self._lock, self._writing() as rows:
+            items = {key: vector for key, vector in items.items() if key not in rows}
+            if not items:
+                return
+            if self._dimension is None:
+                self._create(len(next(iter(items.values()))))
+            if len(rows) + len(items) > self._max_rows:
+                self._compact(keep=self._max_rows // 2)
+                rows = self._rows
+            needed: int = len(rows) + len(items)
+            if needed > self._vectors.shape[0]:
+                self._grow(needed + GROWTH_ROWS)
+            start: int = len(rows)
+            self._vectors[start:needed] = np.asarray(
+                list(items.values()), dtype=np.float16
+            )
+            self._vectors.flush()
+            if self._keys is None:
+                self._keys = open(self._keys_file, "ab")
+            self._keys.write(b"".join(items))
+            self._keys.flush()
+            for row, key in enumerate(items, start=start):
+                rows[key] = row
+
+    def _create(self, dimension: int) -> None:
+        self._dimension = dimension
+        open(self._vectors_file, "wb").close()
+        open(self._keys_file, "wb").close()
+        self._write_meta()
+        self._map(0)
+
+    def _write_meta(self) -> None:
+        """Replaces meta.json at once, it names the generation of the files in use"""
+        temporary: str = f"{self._meta_file}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(
+                {"dimension": self._dimension, "generation": self._generation}, file
+            )
+        os.replace(temporary, self._meta_file)
+
+    def _compact(self, keep: int) -> None:
+        """Writes the newest rows to the files of the next generation and drops the others"""
+        count: int = len(self._rows)
+        keep = min(keep, count)
+        keys: list[bytes] = list(self._rows)[count - keep :]
+        vectors: np.ndarray = np.array(self._vectors[count - keep : count])
+        self._release()
+        stale: tuple[str, str] = (self._keys_file, self._vectors_file)
+        self._generation += 1
+        vectors.tofile(self._vectors_file)
+        with open(self._keys_file, "wb") as file:
+            file.write(b"".join(keys))
+        # Until meta.json is replaced the previous generation stays in use, also after a crash
+        self._write_meta()
+        for path in stale:
+            os.remove(path)
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._map(keep)
+        metrics.counter("embedding_cache_evictions").inc(count - keep)
+        logger.info("Embedding cache compacted from %s to %s vectors", count, keep)
+
+    def _grow(self, capacity: int) -> None:
+        if isinstance(self._vectors, np.memmap):
+            self._vectors.flush()
+            del self._vectors
+        with open(self._vectors_file, "r+b") as file:
+            file.truncate(capacity * self._dimension * 2)
+        self._map(capacity)
+
+    def _release(self) -> None:
+        if isinstance(self._vectors, np.memmap):
+            self._vectors.flush()
+        if self._keys is not None:
+            self._keys.close()
+        self._vectors = self._keys = None
+
+    def close(self) -> None:
+        """Flushes the vectors and closes the files"""
+        with self._lock:
+            self._release()
+            self._rows = None
+
+
+class EmbeddingService(Embeddings):
+    """Embeds texts in concurrent batches, through a content-addressed cache"""
+
+    def __init__(
+        self,
+        client: Embeddings,
+        model: str,
+        cache: EmbeddingCache,
+        batch_size: int,
+        batch_tokens: int,
+        concurrency: int,
+        slot: Callable[[], AsyncContextManager] = nullcontext,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param client: the embedding model that is called for texts that are not cached
+        :type client: Embeddings
+        :param model: name of the model, part of the cache key
+        :type model: str
+        :param cache: cache of the vectors
+        :type cache: EmbeddingCache
+        :param batch_size: maximum number of texts sent in one request
+        :type batch_size: int
+        :param batch_tokens: maximum number of tokens sent in one request
+        :type batch_tokens: int
+        :param concurrency: maximum number of requests sent at once
+        :type concurrency: int
+        :param slot: context manager held by every async request, e.g. llm_client.slot for the shared session
+        :type slot: Callable[[], AsyncContextManager]
+        """
+        self._client: Embeddings = client
+        self._model: str = model
+        self._cache: EmbeddingCache = cache
+        self._batch_size: int = batch_size
+        self._batch_tokens: int = batch_tokens
+        self._concurrency: int = concurrency
+        self._slot: Callable[[], AsyncContextManager] = slot
+        self._queries: TTLCache = TTLCache(
+            max_size=EMBEDDING_QUERY_CACHE_SIZE, ttl=EMBEDDING_QUERY_CACHE_TTL
+        )
+
+    def _plan(
+        self, texts: list[str]
+    ) -> tuple[list[bytes], dict[bytes, list[float]], list[list[tuple[bytes, str]]]]:
+        """Returns the keys of the texts, the cached vectors and the batches of texts to embed"""
+        keys: list[bytes] = [embedding_key(self._model, text) for text in texts]
+        vectors: dict[bytes, list[float]] = self._cache.get_many(keys)
+        missing: dict[bytes, str] = {
+            key: text for key, text in zip(keys, texts) if key not in vectors
+        }
+        metrics.counter("embedding_cache_hits").inc(len(texts) - len(missing))
+        batches: list[list[tuple[bytes, str]]] = []
+        batch: list[tuple[bytes, str]] = []
+        batch_tokens: int = 0
+        for key, text in missing.items():
+            tokens: int = count_tokens(text)
+            if batch and (
+                len(batch) >= self._batch_size
+                or batch_tokens + tokens > self._batch_tokens
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append((key, text))
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return keys, vectors, batches
+
+    def _report(self, embedded: int, started_at: float) -> None:
+        if not embedded:
+            return
+        elapsed: float = time.perf_counter() - started_at
+        metrics.counter("embedding_chunks_embedded").inc(embedded)
+        metrics.gauge("embedding_chunks_per_second").set(embedded / elapsed)
+        logger.info(
+            "Embedded %s chunks in %.2f s (%.1f chunks/s)",
+            embedded,
+            elapsed,
+            embedded / elapsed,
+        )
+
+    async def _aembed(self, texts: list[str], persist: bool) -> list[list[float]]:
+        started_at: float = time.perf_counter()
+        keys, vectors, batches = await blocking_io.run(
+            "embedding_cache", self._plan, texts
+        )
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def embed(batch: list[tuple[bytes, str]]) -> None:
+            async with semaphore, self._slot():
+                result: list[list[float]] = await self._client.aembed_documents(
+                    [text for _, text in batch]
+                )
+            items: dict[bytes, list[float]] = dict(
+                zip((key for key, _ in batch), result)
+            )
+            if persist:
+                await blocking_io.run("embedding_cache", self._cache.put_many, items)
+            vectors.update(items)
+
+        await asyncio.gather(*(embed(batch) for batch in batches))
+        self._report(sum(map(len, batches)), started_at)
+        return [vectors[key] for key in keys]
+
+    def _embed(self, texts: list[str], persist: bool) -> list[list[float]]:
+        started_at: float = time.perf_counter()
+        keys, vectors, batches = self._plan(texts)
+
+        def embed(batch: list[tuple[bytes, str]]) -> dict[bytes, list[float]]:
+            result: list[list[float]] = self._client.embed_documents(
+                [text for _, text in batch]
+            )
+            items: dict[bytes, list[float]] = dict(
+                zip((key for key, _ in batch), result)
+            )
+            if persist:
+                self._cache.put_many(items)
+            return items
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            for items in executor.map(embed, batches):
+                vectors.update(items)
+        self._report(sum(map(len, batches)), started_at)
+        return [vectors[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._aembed(texts, persist=True)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(texts, persist=True)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key: bytes = embedding_key(self._model, text)
+        vector: list[float] = self._queries.get(key, default=MISSING)
+        if vector is MISSING:
+            vector = (await self._aembed([text], persist=False))[0]
+            self._queries.set(key, vector)
+        return vector
+
+    def embed_query(self, text: str) -> list[float]:
+        # Called from threads, the in-process vectors of queries are left to the event loop
+        return self._embed([text], persist=False)[0]
+
+
+embedding_cache: EmbeddingCache = EmbeddingCache(directory=EMBEDDING_CACHE_DIR)
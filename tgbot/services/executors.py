@@ -0,0 +1,136 @@
+"""
+Dedicated thread pool for blocking calls to external services
+Contains the BlockingIOPool class and blocking_io - object of the BlockingIOPool class
+
+Blocking client libraries (e.g. the Google API client) run in a named, sized thread pool instead of the
+event loop's default executor, so they do not compete for threads with everything else. Each provider has
+its own semaphore that bounds how many of its calls run at once; calls over the limit wait in line, and the
+time they wait and the length of the line are recorded in the metrics.
+
+If the awaiting task is cancelled (e.g. the update is abandoned or the bot stops) while the call is still
+waiting for a slot, the call never starts. If it is already running in a thread, its result is discarded and
+the provider's slot is freed only when the thread is done.
+
+Example:
+    Run a blocking function:
+        result = await blocking_io.run("google", search.run, query)
+"""
+
+import asyncio
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from tgbot.config import BLOCKING_IO_PROVIDER_LIMITS, BLOCKING_IO_THREADS
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+
+class BlockingIOPool:
+    """Runs blocking functions in a dedicated thread pool with a concurrency limit per provider"""
+
+    def __init__(
+        self, max_workers: int, provider_limits: dict[str, int], default_limit: int = 4
+    ) -> None:
+        """
+        Initializing a class
+
+        :param max_workers: number of threads in the pool
+        :type max_workers: int
+        :param provider_limits: maximum number of concurrent calls for each provider
+        :type provider_limits: dict[str, int]
+        :param default_limit: the limit for providers that are not listed
+        :type default_limit: int
+        """
+        if sum(provider_limits.values()) > max_workers:
+            # The calls of one provider could then wait for threads held by the others
+            logger.warning(
+                "Provider limits add up to %s, more than the %s threads of the pool",
+                sum(provider_limits.values()),
+                max_workers,
+            )
+        self._max_workers: int = max_workers
+        self._provider_limits: dict[str, int] = provider_limits
+        self._default_limit: int = default_limit
+        self._executor: ThreadPoolExecutor | None = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix="blocking-io"
+            )
+        return self._executor
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        semaphore: asyncio.Semaphore | None = self._semaphores.get(provider)
+        if semaphore is None:
+            limit: int = self._provider_limits.get(provider, self._default_limit)
+            semaphore = self._semaphores[provider] = asyncio.Semaphore(limit)
+        return semaphore
+
+    async def run(
+        self,
+        provider: str,
+        func: Callable[..., Any],
+        *args: Any,
+        timeout: float | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Runs func(*args, **kwargs) in the pool once the provider has a free slot
+
+        :param provider: name of the external service, used for the limit and the metrics
+        :type provider: str
+        :param func: blocking function
+        :type func: Callable[..., Any]
+        :param timeout: maximum time in seconds the call may run, None for no limit
+        :type timeout: float | None
+        """
+        queue_depth = metrics.gauge("blocking_io_queue_depth", provider=provider)
+        queued_at: float = time.perf_counter()
+        queue_depth.inc()
+        try:
+            await self._semaphore(provider).acquire()
+        finally:
+            queue_depth.dec()
+        started_at: float = time.perf_counter()
+        metrics.histogram("blocking_io_wait_seconds", provider=provider).observe(
+            started_at - queued_at
+        )
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        try:
+            call: Future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._semaphore(provider).release()
+            raise
+        # The slot is freed when the thread is done, not when the awaiting task gives up
+        call.add_done_callback(
+            lambda _: self._call_finished(loop, provider, started_at)
+        )
+        return await asyncio.wait_for(asyncio.wrap_future(call), timeout=timeout)
+
+    def _call_finished(
+        self, loop: asyncio.AbstractEventLoop, provider: str, started_at: float
+    ) -> None:
+        """Runs in the worker thread, hands the bookkeeping over to the event loop"""
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._release, provider, started_at)
+
+    def _release(self, provider: str, started_at: float) -> None:
+        metrics.histogram("blocking_io_run_seconds", provider=provider).observe(
+            time.perf_counter() - started_at
+        )
+        self._semaphore(provider).release()
+
+    def shutdown(self) -> None:
+        """Stops the threads, calls that have not started yet are cancelled"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+blocking_io: BlockingIOPool = BlockingIOPool(
+    max_workers=BLOCKING_IO_THREADS, provider_limits=BLOCKING_IO_PROVIDER_LIMITS
+)
@@ -0,0 +1,167 @@
+"""
+Bounded chat history of a user
+Contains the ChatHistory class, a ring buffer of chat messages limited by message count and token count
+
+When a limit is exceeded, the oldest messages leave the buffer and are folded into a short running summary
+(the first sentence of each message, clipped), which is itself kept under a token limit. The history is
+serialized into a compact zlib-compressed binary format, which is also used when the object is pickled.
+
+Example:
+    Keep the history in context.user_data:
+        history: ChatHistory = context.user_data.setdefault("chat_history", ChatHistory())
+        history.append(role="user", content=user_message)
+
+    Serialize and restore:
+        data: bytes = history.to_bytes()
+        history = ChatHistory.from_bytes(data)
+"""
+
+import re
+import struct
+import zlib
+from collections import deque
+
+from tgbot.config import (
+    CHAT_HISTORY_MAX_MESSAGES,
+    CHAT_HISTORY_MAX_TOKENS,
+    CHAT_HISTORY_SUMMARY_TOKENS,
+)
+from tgbot.services.prompts import count_tokens, encode, get_encoding
+
+FORMAT_VERSION: int = 1
+ROLES: tuple[str, ...] = ("user", "assistant", "system")
+# Tokens kept from each message that is folded into the summary
+SUMMARY_LINE_TOKENS: int = 40
+
+# version, max messages, number of messages, max tokens
+_HEADER = struct.Struct("<BHHI")
+# role, tokens, length of the content in bytes
+_MESSAGE = struct.Struct("<BII")
+_FIRST_SENTENCE = re.compile(r"^(.+?[.!?])(\s|$)", re.S)
+
+
+class ChatHistory:
+    """Ring buffer of chat messages bounded by message count and token count"""
+
+    def __init__(
+        self,
+        max_messages: int = CHAT_HISTORY_MAX_MESSAGES,
+        max_tokens: int = CHAT_HISTORY_MAX_TOKENS,
+        summary_tokens: int = CHAT_HISTORY_SUMMARY_TOKENS,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param max_messages: maximum number of messages kept verbatim
+        :type max_messages: int
+        :param max_tokens: maximum number of tokens in the messages kept verbatim
+        :type max_tokens: int
+        :param summary_tokens: maximum number of tokens in the summary of older messages
+        :type summary_tokens: int
+        """
+        self._max_messages: int = max_messages
+        self._max_tokens: int = max_tokens
+        self._summary_tokens: int = summary_tokens
+        # (role, content, tokens)
+        self._messages: deque[tuple[int, str, int]] = deque()
+        self._tokens: int = 0
+        self.summary: str = ""
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens
+
+    @property
+    def messages(self) -> list[dict[str, str]]:
+        """Messages in the format of the chat completion API, oldest first"""
+        return [
+            {"role": ROLES[role], "content": content}
+            for role, content, _ in self._messages
+        ]
+
+    def append(self, role: str, content: str) -> None:
+        """Adds a message, folding the oldest messages into the summary if a limit is exceeded"""
+        tokens: int = count_tokens(content)
+        self._messages.append((ROLES.index(role), content, tokens))
+        self._tokens += tokens
+        self._compact()
+
+    def _compact(self) -> None:
+        folded: list[str] = []
+        while len(self._messages) > 1 and (
+            len(self._messages) > self._max_messages or self._tokens > self._max_tokens
+        ):
+            role, content, tokens = self._messages.popleft()
+            self._tokens -= tokens
+            folded.append(f"{ROLES[role]}: {self._clip(content)}")
+        if folded:
+            summary: str = "\n".join(filter(None, (self.summary, *folded)))
+            tokens: list[int] = encode(summary)
+            if len(tokens) > self._summary_tokens:
+                # Keep the most recent part of the summary
+                summary = get_encoding().decode(tokens[-self._summary_tokens :])
+            self.summary = summary
+
+    @staticmethod
+    def _clip(content: str) -> str:
+        match = _FIRST_SENTENCE.match(content.strip())
+        sentence: str = match.group(1) if match else content.strip()
+        tokens: list[int] = encode(sentence)
+        if len(tokens) > SUMMARY_LINE_TOKENS:
+            return get_encoding().decode(tokens[:SUMMARY_LINE_TOKENS]) + "…"
+        return sentence
+
+    def to_bytes(self) -> bytes:
+        """Serializes the history into the compact binary format"""
+        parts: list[bytes] = [
+            _HEADER.pack(
+                FORMAT_VERSION,
+                self._max_messages,
+                len(self._messages),
+                self._max_tokens,
+            ),
+        ]
+        summary: bytes = self.summary.encode()
+        parts.append(struct.pack("<HI", self._summary_tokens, len(summary)))
+        parts.append(summary)
+        for role, content, tokens in self._messages:
+            data: bytes = content.encode()
+            parts.append(_MESSAGE.pack(role, tokens, len(data)))
+            parts.append(data)
+        return zlib.compress(b"".join(parts))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ChatHistory":
+        """Restores a history serialized with to_bytes"""
+        raw: bytes = zlib.decompress(data)
+        version, max_messages, count, max_tokens = _HEADER.unpack_from(raw)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported chat history format: {version}")
+        offset: int = _HEADER.size
+        summary_tokens, summary_length = struct.unpack_from("<HI", raw, offset)
+        offset += struct.calcsize("<HI")
+        history: ChatHistory = cls(
+            max_messages=max_messages,
+            max_tokens=max_tokens,
+            summary_tokens=summary_tokens,
+        )
+        history.summary = raw[offset : offset + summary_length].decode()
+        offset += summary_length
+        for _ in range(count):
+            role, tokens, length = _MESSAGE.unpack_from(raw, offset)
+            offset += _MESSAGE.size
+            history._messages.append(
+                (role, raw[offset : offset + length].decode(), tokens)
+            )
+            history._tokens += tokens
+            offset += length
+        return history
+
+    def __getstate__(self) -> bytes:
+        return self.to_bytes()
+
+    def __setstate__(self, state: bytes) -> None:
+        self.__dict__.update(ChatHistory.from_bytes(state).__dict__)
@@ -0,0 +1,216 @@
+"""
+Client of the OpenAI API shared by the whole bot
+Contains the LLMClient class, which sends the requests to OpenAI, and llm_client - object of the LLMClient class
+
+All requests go through one pooled keep-alive HTTP session, opened when the bot starts and closed when it stops,
+instead of a session and a TLS handshake per call. At most LLM_CONCURRENCY requests are in flight at once, the
+others wait for a free slot. A request that times out, fails to connect or is answered with 429 or 5xx is retried
+after an exponential backoff with full jitter, so the retries of concurrent requests do not arrive together;
+a Retry-After header of the answer is respected. The calls that langchain makes hold a slot and use the pooled
+session too, their retries are langchain's own.
+
+Example:
+    Open the session when the bot starts and close it when it stops:
+        await llm_client.start()
+        await llm_client.close()
+
+    Send a request:
+        response = await llm_client.chat_completion(model="gpt-3.5-turbo", messages=[...])
+
+    Make the calls of a chain share the limit and the session:
+        async with llm_client.slot():
+            output = await chain.arun(input=prompt)
+"""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from functools import cache
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+from tgbot.config import (
+    LLM_BACKOFF_BASE,
+    LLM_BACKOFF_MAX,
+    LLM_CONCURRENCY,
+    LLM_KEEPALIVE_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_REQUEST_TIMEOUT,
+)
+from tgbot.utils.environment import env
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    import aiohttp
+    from openai.error import OpenAIError
+
+
+@cache
+def get_openai():
+    """Returns the openai module, it is imported and configured once"""
+    import openai
+
+    openai.api_key = env.get_openai_api()
+    return openai
+
+
+class LLMClient:
+    """Sends the requests to OpenAI through a pooled session, with a concurrency limit and retries"""
+
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        timeout: float = LLM_REQUEST_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX,
+        keepalive_timeout: float = LLM_KEEPALIVE_TIMEOUT,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param concurrency: maximum number of requests in flight, also the size of the connection pool
+        :type concurrency: int
+        :param timeout: maximum time in seconds of one attempt of a request
+        :type timeout: float
+        :param max_retries: how many times a request is retried after a retryable failure
+        :type max_retries: int
+        :param backoff_base: upper bound in seconds of the wait before the first retry, doubled by each retry
+        :type backoff_base: float
+        :param backoff_max: upper bound in seconds of the wait before a retry
+        :type backoff_max: float
+        :param keepalive_timeout: seconds an idle connection is kept open
+        :type keepalive_timeout: float
+        """
+        self._concurrency: int = concurrency
+        self._timeout: float = timeout
+        self._max_retries: int = max_retries
+        self._backoff_base: float = backoff_base
+        self._backoff_max: float = backoff_max
+        self._keepalive_timeout: float = keepalive_timeout
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+        self._session: "aiohttp.ClientSession | None" = None
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        """Returns the pooled session, failing loudly if it has not been opened yet"""
+        if self._session is None:
+            raise RuntimeError(
+                "LLM client session is not opened, call llm_client.start() first"
+            )
+        return self._session
+
+    async def start(self) -> None:
+        """Opens the pooled session"""
+        if self._session is not None:
+            return
+        import aiohttp
+
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self._concurrency,
+                keepalive_timeout=self._keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+        )
+        logger.info("LLM client session opened (concurrency=%s)", self._concurrency)
+
+    async def close(self) -> None:
+        """Closes the pooled session, the requests in flight fail"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            logger.info("LLM client session closed")
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Holds one of the request slots, the openai calls of the current task meanwhile use the pooled session.
+        Tasks created inside the block inherit the session
+        """
+        openai = get_openai()
+        waiting_since: float = time.perf_counter()
+        async with self._semaphore:
+            metrics.histogram("llm_wait_seconds").observe(
+                time.perf_counter() - waiting_since
+            )
+            token = openai.aiosession.set(self.session)
+            try:
+                yield
+            finally:
+                openai.aiosession.reset(token)
+
+    def _retryable(self, exc: "OpenAIError") -> bool:
+        openai = get_openai()
+        if isinstance(exc, openai.error.RateLimitError):
+            # An exhausted quota does not come back by waiting
+            return exc.code != "insufficient_quota"
+        if isinstance(
+            exc,
+            (
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.TryAgain,
+            ),
+        ):
+            return True
+        return exc.http_status is not None and exc.http_status >= 500
+
+    def _backoff(self, attempt: int, exc: "OpenAIError") -> float:
+        """Returns the seconds to wait before the retry, a random share of the exponential bound"""
+        delay: float = random.uniform(
+            0, min(self._backoff_max, self._backoff_base * 2**attempt)
+        )
+        try:
+            retry_after: float = float(exc.headers.get("retry-after", 0))
+        except (TypeError, ValueError):
+            retry_after = 0.0
+        return max(delay, min(retry_after, self._backoff_max))
+
+    async def _request(self, endpoint: str, data: dict[str, Any]) -> Any:
+        openai = get_openai()
+        create = {
+            "chat_completion": openai.ChatCompletion.acreate,
+            "completion": openai.Completion.acreate,
+        }[endpoint]
+        for attempt in range(self._max_retries + 1):
+            try:
+                async with self.slot():
+                    started: float = time.perf_counter()
+                    response = await create(request_timeout=self._timeout, **data)
+            except openai.error.OpenAIError as exc:
+                status: str = str(exc.http_status or type(exc).__name__)
+                if attempt == self._max_retries or not self._retryable(exc):
+                    metrics.counter(
+                        "llm_request_errors", endpoint=endpoint, status=status
+                    ).inc()
+                    raise
+                delay: float = self._backoff(attempt, exc)
+                metrics.counter("llm_retries", endpoint=endpoint, status=status).inc()
+                logger.info(
+                    "%s failed with %s, retry %s in %.2f s",
+                    endpoint,
+                    status,
+                    attempt + 1,
+                    delay,
+                )
+                # The slot is free while waiting, other requests may go meanwhile
+                await asyncio.sleep(delay)
+                continue
+            metrics.histogram("llm_request_seconds", endpoint=endpoint).observe(
+                time.perf_counter() - started
+            )
+            return response
+
+    async def chat_completion(self, **data: Any) -> Any:
+        """Returns the answer of openai.ChatCompletion to the request"""
+        return await self._request("chat_completion", data)
+
+    async def completion(self, **data: Any) -> Any:
+        """Returns the answer of openai.Completion to the request"""
+        return await self._request("completion", data)
+
+
+llm_client: LLMClient = LLMClient()
@@ -0,0 +1,217 @@
+"""
+Per-user conversation memory
+Contains the ConversationMemoryStore class, which keeps a bounded entity memory for every active user
+
+Every user has an own ConversationEntityMemory, so users no longer share one history and no longer queue
+behind each other on one chain object. The memory of a user is compacted after every turn (only the last
+turns and a limited number of entities are kept). Users that are idle or least recently used are evicted
+from the process and their memory is spilled to the conversation_memory table, from which it is restored
+on their next message.
+
+Example:
+    Use the memory of a user for one turn:
+        entry = await memory_store.acquire(user_id)
+        try:
+            variables = entry.memory.load_memory_variables({"input": query})
+            output = await chain.arun(input=prompt, **variables)
+        except BaseException:
+            memory_store.release(entry)
+            raise
+        memory_store.remember(entry, {"input": query}, {"output": output})
+"""
+
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+from tgbot.services.database import db
+from tgbot.services.executors import blocking_io
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+# langchain is imported when a memory is first created or restored, not when the bot starts
+if TYPE_CHECKING:
+    from langchain.memory import ConversationEntityMemory
+
+
+@dataclass
+class MemoryEntry:
+    """The memory of one user and the lock that serializes the user's turns"""
+
+    user_id: int
+    memory: "ConversationEntityMemory | None" = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    used_at: float = field(default_factory=time.monotonic)
+
+
+class ConversationMemoryStore:
+    """Keeps the memories of active users in process and spills the others to the database"""
+
+    def __init__(
+        self,
+        create_memory: Callable[[], "ConversationEntityMemory"],
+        max_users: int,
+        idle_ttl: float,
+        max_entities: int,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param create_memory: factory of an empty memory
+        :type create_memory: Callable[[], ConversationEntityMemory]
+        :param max_users: maximum number of memories kept in process
+        :type max_users: int
+        :param idle_ttl: seconds after which the memory of an idle user is spilled to the database
+        :type idle_ttl: float
+        :param max_entities: maximum number of entities remembered per user
+        :type max_entities: int
+        """
+        self._create_memory: Callable[[], "ConversationEntityMemory"] = create_memory
+        self._max_users: int = max_users
+        self._idle_ttl: float = idle_ttl
+        self._max_entities: int = max_entities
+        self._entries: dict[int, MemoryEntry] = {}
+        self._spills: dict[int, asyncio.Task] = {}
+        self._saves: set[asyncio.Task] = set()
+
+    @staticmethod
+    async def init_schema() -> None:
+        """Creates the table for spilled memories"""
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_memory (
+                user_id BIGINT PRIMARY KEY,
+                payload JSONB NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def acquire(self, user_id: int) -> MemoryEntry:
+        """Returns the memory of the user with its lock held, loading it from the database if needed"""
+        entry: MemoryEntry = self._entries.pop(user_id, None) or MemoryEntry(user_id)
+        # Re-inserting keeps the dict ordered from the least to the most recently used
+        self._entries[user_id] = entry
+        entry.used_at = time.monotonic()
+        await entry.lock.acquire()
+        if entry.memory is None:
+            try:
+                entry.memory = await self._load(user_id)
+            except BaseException:
+                entry.lock.release()
+                raise
+        self._evict()
+        return entry
+
+    def release(self, entry: MemoryEntry) -> None:
+        """Compacts the memory after a turn and releases its lock"""
+        self._compact(entry.memory)
+        entry.used_at = time.monotonic()
+        entry.lock.release()
+
+    def remember(self, entry: MemoryEntry, inputs: dict, outputs: dict) -> None:
+        """
+        Saves the turn into the memory in the background and then releases its lock,
+        so the answer is not held back by the entity summarization calls of the memory
+        """
+
+        async def save() -> None:
+            try:
+                await blocking_io.run(
+                    "openai", entry.memory.save_context, inputs, outputs
+                )
+            except Exception as exc:
+                logger.error(
+                    "Failed to save the memory of user %s: %s", entry.user_id, repr(exc)
+                )
+            finally:
+                self.release(entry)
+
+        task: asyncio.Task = asyncio.create_task(save())
+        self._saves.add(task)
+        task.add_done_callback(self._saves.discard)
+
+    def _compact(self, memory: "ConversationEntityMemory") -> None:
+        messages = memory.chat_memory.messages
+        if len(messages) > memory.k * 2:
+            del messages[: len(messages) - memory.k * 2]
+        store: dict = getattr(memory.entity_store, "store", {})
+        for key in list(store)[: max(0, len(store) - self._max_entities)]:
+            del store[key]
+
+    def _evict(self) -> None:
+        """Spills the least recently used memories above the limit and the memories of idle users"""
+        now: float = time.monotonic()
+        for user_id, entry in list(self._entries.items()):
+            over_limit: bool = len(self._entries) > self._max_users
+            if not over_limit and now - entry.used_at < self._idle_ttl:
+                break
+            if entry.lock.locked() or entry.memory is None:
+                continue
+            del self._entries[user_id]
+            self._spills[user_id] = asyncio.create_task(self._spill(entry))
+            metrics.counter("memory_evictions").inc()
+        metrics.gauge("memory_users").set(len(self._entries))
+
+    @staticmethod
+    def dump(memory: "ConversationEntityMemory") -> dict:
+        from langchain.schema.messages import messages_to_dict
+
+        return {
+            "messages": messages_to_dict(memory.chat_memory.messages),
+            "entities": dict(getattr(memory.entity_store, "store", {})),
+        }
+
+    async def _spill(self, entry: MemoryEntry) -> None:
+        try:
+            await db.execute(
+                """
+                INSERT INTO conversation_memory (user_id, payload, updated_at)
+                VALUES ($1, $2::jsonb, now())
+                ON CONFLICT (user_id) DO UPDATE
+                SET payload = EXCLUDED.payload, updated_at = EXCLUDED.updated_at
+            """,
+                entry.user_id,
+                json.dumps(self.dump(entry.memory)),
+            )
+        except Exception as exc:
+            logger.error(
+                "Failed to spill the memory of user %s: %s", entry.user_id, repr(exc)
+            )
+        finally:
+            if self._spills.get(entry.user_id) is asyncio.current_task():
+                del self._spills[entry.user_id]
+
+    async def _load(self, user_id: int) -> "ConversationEntityMemory":
+        # A spill that is still running must land before the memory is read back
+        spill: asyncio.Task | None = self._spills.get(user_id)
+        if spill is not None:
+            await asyncio.shield(spill)
+        memory: "ConversationEntityMemory" = self._create_memory()
+        row = await db.fetchrow(
+            "SELECT payload FROM conversation_memory WHERE user_id = $1", user_id
+        )
+        if row is not None:
+            from langchain.schema.messages import messages_from_dict
+
+            payload: dict = json.loads(row["payload"])
+            memory.chat_memory.messages = messages_from_dict(payload["messages"])
+            for key, value in payload["entities"].items():
+                memory.entity_store.set(key, value)
+            metrics.counter("memory_restores").inc()
+        return memory
+
+    async def flush(self) -> None:
+        """Spills all memories, called when the bot stops"""
+        await asyncio.gather(*self._saves, return_exceptions=True)
+        for entry in self._entries.values():
+            if entry.memory is None:
+                continue
+            self._spills[entry.user_id] = asyncio.create_task(self._spill(entry))
+        self._entries.clear()
+        await asyncio.gather(*self._spills.values(), return_exceptions=True)
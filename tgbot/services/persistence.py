@@ -0,0 +1,279 @@
+"""
+Persistence of user, chat and bot data in PostgreSQL
+Contains the PostgresPersistence class, a BasePersistence of python-telegram-bot, and persistence - its object
+
+The data is pickled and kept in the persistence_data table, one row per user, chat, bot and conversation.
+Nothing is read when the bot starts: the data of a user or a chat is loaded on the first update that needs
+it. The application hands the data of every changed user and chat to the persistence every
+`update_interval` seconds; only the entries whose pickled form differs from what is in the database are
+staged, and staged entries are written with one batched statement by a repeating job and when the bot stops.
+
+Example:
+    Pass the persistence to the application and register the flush job:
+        application = Application.builder().token(token).persistence(persistence=persistence).build()
+        persistence.start(job_queue=application.job_queue)
+"""
+
+import asyncio
+import hashlib
+import pickle
+import time
+from collections import defaultdict
+from typing import Any
+
+from telegram.ext import BasePersistence, CallbackContext, JobQueue, PersistenceInput
+
+from tgbot.config import PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_UPDATE_INTERVAL
+from tgbot.services.database import db
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+USER: str = "user"
+CHAT: str = "chat"
+BOT: str = "bot"
+CONVERSATION: str = "conversation"
+
+Key = tuple[str, str]
+
+UPSERT_DATA = """
+    INSERT INTO persistence_data (kind, key, payload, updated_at)
+    VALUES ($1, $2, $3, now())
+    ON CONFLICT (kind, key) DO UPDATE
+    SET payload = EXCLUDED.payload, updated_at = EXCLUDED.updated_at
+"""
+
+
+def _digest(payload: bytes) -> bytes:
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+class PostgresPersistence(BasePersistence):
+    """Keeps user, chat, bot and conversation data in PostgreSQL, loaded lazily and written in batches"""
+
+    def __init__(
+        self, update_interval: float, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL
+    ) -> None:
+        """
+        Initializing a class
+
+        :param update_interval: how often, in seconds, the application hands changed data to the persistence
+        :type update_interval: float
+        :param flush_interval: how often, in seconds, the staged data is written to the database
+        :type flush_interval: float
+        """
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self._flush_interval: float = flush_interval
+        # Digests of the payloads that are in the database
+        self._written: dict[Key, bytes] = {}
+        # Payloads that differ from the database, None for entries to delete
+        self._pending: dict[Key, bytes | None] = {}
+        self._loaded: set[Key] = set()
+        self._loading: dict[Key, asyncio.Task] = {}
+        self._schema_ready: bool = False
+        self._flush_lock: asyncio.Lock = asyncio.Lock()
+
+    async def _ready(self) -> None:
+        """Opens the pool and creates the table; the application reads persistence before post_init runs"""
+        if self._schema_ready:
+            return
+        await db.connect()
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS persistence_data (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload BYTEA NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (kind, key)
+            )
+        """
+        )
+        self._schema_ready = True
+
+    async def _fetch(self, key: Key) -> Any:
+        await self._ready()
+        row = await db.fetchrow(
+            "SELECT payload FROM persistence_data WHERE kind = $1 AND key = $2", *key
+        )
+        if row is None:
+            return None
+        self._written[key] = _digest(row["payload"])
+        return pickle.loads(row["payload"])
+
+    async def _load_once(self, key: Key, data: dict) -> None:
+        """Fills data with the stored data of the key, the first time the key is used in this process"""
+        if key in self._loaded:
+            return
+        task: asyncio.Task | None = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(self._fetch(key))
+        try:
+            stored: Any = await asyncio.shield(task)
+        finally:
+            self._loading.pop(key, None)
+        if key not in self._loaded:
+            self._loaded.add(key)
+            if stored:
+                metrics.counter("persistence_rows_loaded", kind=key[0]).inc()
+                # Anything set before the data was loaded wins
+                data.update({k: v for k, v in stored.items() if k not in data})
+
+    def _stage(self, key: Key, data: Any) -> None:
+        payload: bytes = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._written.get(key) == _digest(payload):
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = payload
+
+    def _stage_delete(self, key: Key) -> None:
+        self._loaded.discard(key)
+        self._pending[key] = None
+
+    # Data is loaded on first use, so nothing is read when the application starts
+
+    async def get_user_data(self) -> dict[int, dict[Any, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> dict[int, dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> dict[Any, Any]:
+        return await self._fetch((BOT, "")) or {}
+
+    async def get_callback_data(self) -> Any:
+        return None
+
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        await self._ready()
+        rows = await db.fetch(
+            "SELECT key, payload FROM persistence_data WHERE kind = $1",
+            f"{CONVERSATION}:{name}",
+        )
+        conversations: dict[tuple, object] = {}
+        for row in rows:
+            self._written[(f"{CONVERSATION}:{name}", row["key"])] = _digest(
+                row["payload"]
+            )
+            key, state = pickle.loads(row["payload"])
+            conversations[tuple(key)] = state
+        return conversations
+
+    async def refresh_user_data(self, user_id: int, user_data: dict[Any, Any]) -> None:
+        await self._load_once((USER, str(user_id)), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict[Any, Any]) -> None:
+        await self._load_once((CHAT, str(chat_id)), chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict[Any, Any]) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict[Any, Any]) -> None:
+        self._stage((USER, str(user_id)), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict[Any, Any]) -> None:
+        self._stage((CHAT, str(chat_id)), data)
+
+    async def update_bot_data(self, data: dict[Any, Any]) -> None:
+        self._stage((BOT, ""), data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def update_conversation(
+        self, name: str, key: tuple, new_state: object | None
+    ) -> None:
+        conversation_key: Key = (f"{CONVERSATION}:{name}", repr(key))
+        if new_state is None:
+            self._stage_delete(conversation_key)
+        else:
+            self._stage(conversation_key, (key, new_state))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage_delete((USER, str(user_id)))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage_delete((CHAT, str(chat_id)))
+
+    async def write_pending(self) -> int:
+        """Writes the staged data with one batched statement per kind of change, returns the number of rows"""
+        async with self._flush_lock:
+            pending: dict[Key, bytes | None] = self._pending
+            if not pending:
+                return 0
+            self._pending = {}
+            started_at: float = time.monotonic()
+            upserts: list[tuple[str, str, bytes]] = [
+                (*key, payload)
+                for key, payload in pending.items()
+                if payload is not None
+            ]
+            deletes: list[Key] = [
+                key for key, payload in pending.items() if payload is None
+            ]
+            try:
+                await self._ready()
+                async with db.pool.acquire() as connection:
+                    async with connection.transaction():
+                        if upserts:
+                            await connection.executemany(UPSERT_DATA, upserts)
+                        if deletes:
+                            await connection.executemany(
+                                "DELETE FROM persistence_data WHERE kind = $1 AND key = $2",
+                                deletes,
+                            )
+            except Exception:
+                # Newer changes staged meanwhile win over the ones that failed to be written
+                self._pending = {**pending, **self._pending}
+                raise
+            for kind, key, payload in upserts:
+                self._written[(kind, key)] = _digest(payload)
+            for key in deletes:
+                self._written.pop(key, None)
+
+            elapsed: float = time.monotonic() - started_at
+            rows: int = len(pending)
+            metrics.histogram("persistence_flush_seconds").observe(elapsed)
+            metrics.histogram(
+                "persistence_rows_per_flush",
+                buckets=(1, 5, 10, 50, 100, 500, 1000, 5000),
+            ).observe(rows)
+            counts: dict[str, int] = defaultdict(int)
+            for kind, _ in pending:
+                counts[kind.split(":")[0]] += 1
+            for kind, count in counts.items():
+                metrics.counter("persistence_rows_written", kind=kind).inc(count)
+            logger.debug("Persistence flushed %s rows in %.3f s", rows, elapsed)
+            return rows
+
+    def start(self, job_queue: JobQueue) -> None:
+        """
+        Registers the job that writes the staged data
+
+        :param job_queue: job queue of the application
+        :type job_queue: JobQueue
+        """
+        job_queue.run_repeating(
+            callback=self._tick,
+            interval=self._flush_interval,
+            first=self._flush_interval,
+            name="persistence_flush",
+            job_kwargs={"max_instances": 1, "coalesce": True},
+        )
+
+    async def _tick(self, context: CallbackContext) -> None:
+        try:
+            await self.write_pending()
+        except Exception as exc:
+            logger.error("Failed to flush the persistence: %s", repr(exc))
+
+    async def flush(self) -> None:
+        """Called by the application when it stops, after the last update of the data"""
+        await self.write_pending()
+
+
+persistence: PostgresPersistence = PostgresPersistence(
+    update_interval=PERSISTENCE_UPDATE_INTERVAL
+)
@@ -0,0 +1,129 @@
+"""
+Token-budgeted assembly of LLM prompts
+Contains the PromptBuilder class and helpers around a single, module-level tiktoken encoder
+
+A prompt is built from segments in the order they are added. Fixed segments (instructions, the user query)
+are always kept whole; trimmable segments (search results, older history) have a priority and are cut,
+lowest priority first, until the whole prompt fits the token budget. Every segment is tokenized once.
+
+Example:
+    Build a prompt:
+        prompt: str = (
+            PromptBuilder(budget=3000)
+            .add("Answer the question using the search results below.\n")
+            .add(search_results, priority=1)
+            .add(f"\nQuestion: {question}")
+            .build()
+        )
+
+    Fill several variables of a template under one budget:
+        entities, history = (
+            PromptBuilder(budget=1000)
+            .add(entities, priority=1)
+            .add(history, priority=2, keep_end=True)
+            .build_parts()
+        )
+"""
+
+from dataclasses import dataclass, field
+from functools import cache
+
+import tiktoken
+
+ENCODING_NAME: str = "cl100k_base"
+
+
+@cache
+def get_encoding() -> tiktoken.Encoding:
+    """Returns the tokenizer, it is loaded once per process, in the thread of messages.preload() at startup"""
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def encode(text: str) -> list[int]:
+    return get_encoding().encode(text, disallowed_special=())
+
+
+def count_tokens(text: str) -> int:
+    return len(encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Returns the beginning of the text that fits into max_tokens"""
+    tokens: list[int] = encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens])
+
+
+@dataclass
+class Segment:
+    """Part of a prompt, priority None means the segment is never trimmed"""
+
+    text: str
+    priority: int | None = None
+    keep_end: bool = False
+    tokens: list[int] = field(default_factory=list)
+
+
+class PromptBuilder:
+    """Assembles a prompt from segments and trims low-priority segments to fit the token budget"""
+
+    def __init__(self, budget: int) -> None:
+        """
+        Initializing a class
+
+        :param budget: maximum number of tokens in the assembled prompt
+        :type budget: int
+        """
+        self._budget: int = budget
+        self._segments: list[Segment] = []
+
+    def add(
+        self, text: str, priority: int | None = None, keep_end: bool = False
+    ) -> "PromptBuilder":
+        """
+        Appends a segment to the prompt
+
+        :param text: text of the segment
+        :type text: str
+        :param priority: trimmable segments with a lower priority are trimmed first, None to never trim
+        :type priority: int | None
+        :param keep_end: trim from the beginning instead of the end, e.g. to keep the latest history
+        :type keep_end: bool
+        """
+        self._segments.append(
+            Segment(
+                text=str(text),
+                priority=priority,
+                keep_end=keep_end,
+                tokens=encode(str(text)),
+            )
+        )
+        return self
+
+    @property
+    def token_count(self) -> int:
+        return sum(len(segment.tokens) for segment in self._segments)
+
+    def build_parts(self) -> list[str]:
+        """Returns the texts of the segments in the order they were added, trimmed to the budget"""
+        excess: int = self.token_count - self._budget
+        trimmable: list[Segment] = sorted(
+            (segment for segment in self._segments if segment.priority is not None),
+            key=lambda segment: segment.priority,
+        )
+        for segment in trimmable:
+            if excess <= 0:
+                break
+            cut: int = min(excess, len(segment.tokens))
+            keep: int = len(segment.tokens) - cut
+            segment.tokens = (
+                segment.tokens[cut:] if segment.keep_end else segment.tokens[:keep]
+            )
+            segment.text = get_encoding().decode(segment.tokens)
+            excess -= cut
+        return [segment.text for segment in self._segments]
+
+    def build(self) -> str:
+        """Returns the prompt, trimmed to the budget"""
+        return "".join(self.build_parts())
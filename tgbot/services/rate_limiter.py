@@ -0,0 +1,287 @@
+"""
+Rate limiting of outbound messages with priority lanes
+Contains the PriorityRateLimiter class, a BaseRateLimiter of python-telegram-bot, and TokenBucket
+
+Every request that is sent to a chat waits for a token of the bucket of its chat (about one message per second
+in a private chat, 20 per minute in a group) and then for a token of the global bucket (30 messages per second
+for the whole bot). The global tokens are handed out by lane: replies to users (the interactive lane, the
+default) always go before scheduled advices (the broadcast lane), and broadcasts additionally draw from their
+own bucket without bursts, so they are spread evenly and leave room for replies. Requests that are not sent to
+a chat (e.g. answerCallbackQuery) are not limited.
+
+A 429 answer pauses only the chat of the request for the time Telegram asks for, and the request is retried,
+so a noisy chat never holds back the others. Telegram does not tell whether the limit of the chat or the
+global one was hit: when several chats are answered with 429 at once, the limit is taken as the global one and
+the global bucket is paused as well.
+
+Example:
+    Pass the rate limiter to the application:
+        application = Application.builder().token(token).rate_limiter(PriorityRateLimiter()).build()
+
+    Send a message through the broadcast lane:
+        await bot.send_message(chat_id, text, rate_limit_args={"lane": BROADCAST})
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from tgbot.config import (
+    RATE_LIMIT_BROADCAST,
+    RATE_LIMIT_CHAT_BURST,
+    RATE_LIMIT_GLOBAL,
+    RATE_LIMIT_GLOBAL_FLOOD_CHATS,
+    RATE_LIMIT_GROUP_CHAT,
+    RATE_LIMIT_MAX_RETRIES,
+    RATE_LIMIT_PRIVATE_CHAT,
+)
+from tgbot.services.cache import MISSING, TTLCache
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+INTERACTIVE: str = "interactive"
+BROADCAST: str = "broadcast"
+# Lanes in the order their requests are served
+LANES: tuple[str, ...] = (INTERACTIVE, BROADCAST)
+
+
+class TokenBucket:
+    """Tokens refill at a constant rate up to the capacity, a request takes one token"""
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param rate: tokens added per second
+        :type rate: float
+        :param capacity: maximum number of tokens, the size of a burst
+        :type capacity: float
+        :param timer: source of the current time, monotonic clock by default
+        :type timer: Callable[[], float]
+        """
+        self._rate: float = rate
+        self._capacity: float = capacity
+        self._timer: Callable[[], float] = timer
+        self._tokens: float = capacity
+        self._updated_at: float = timer()
+
+    def _refill(self) -> None:
+        now: float = self._timer()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated_at) * self._rate
+        )
+        self._updated_at = now
+
+    def delay(self) -> float:
+        """Returns the seconds until a token is available, 0 if there is one"""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def reserve(self) -> float:
+        """Takes a token ahead of time and returns the seconds to wait before using it"""
+        self.take()
+        return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+    def pause(self, seconds: float) -> None:
+        """Hands out no tokens for the given number of seconds"""
+        self._refill()
+        # The next token is available after exactly the given number of seconds
+        self._tokens = min(self._tokens, 1 - seconds * self._rate)
+
+
+class _Lane:
+    def __init__(self, name: str, bucket: TokenBucket | None) -> None:
+        self.name: str = name
+        self.bucket: TokenBucket | None = bucket
+        self.waiters: deque[asyncio.Future] = deque()
+
+
+class PriorityRateLimiter(BaseRateLimiter[dict]):
+    """Sends the requests of the interactive lane first and keeps all lanes under the limits of Telegram"""
+
+    def __init__(
+        self,
+        global_rate: float = RATE_LIMIT_GLOBAL,
+        broadcast_rate: float = RATE_LIMIT_BROADCAST,
+        private_chat_rate: float = RATE_LIMIT_PRIVATE_CHAT,
+        group_chat_rate: float = RATE_LIMIT_GROUP_CHAT,
+        chat_burst: int = RATE_LIMIT_CHAT_BURST,
+        max_retries: int = RATE_LIMIT_MAX_RETRIES,
+        global_flood_chats: int = RATE_LIMIT_GLOBAL_FLOOD_CHATS,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param global_rate: messages per second to all chats
+        :type global_rate: float
+        :param broadcast_rate: messages per second of the broadcast lane, sent without bursts
+        :type broadcast_rate: float
+        :param private_chat_rate: messages per second to one private chat
+        :type private_chat_rate: float
+        :param group_chat_rate: messages per second to one group or channel
+        :type group_chat_rate: float
+        :param chat_burst: messages that can be sent to one chat at once
+        :type chat_burst: int
+        :param max_retries: how many times a request is retried after a 429 answer
+        :type max_retries: int
+        :param global_flood_chats: chats waiting after a 429 answer at once, from which every chat waits
+        :type global_flood_chats: int
+        """
+        self._global: TokenBucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._lanes: dict[str, _Lane] = {
+            INTERACTIVE: _Lane(INTERACTIVE, bucket=None),
+            BROADCAST: _Lane(
+                BROADCAST, bucket=TokenBucket(rate=broadcast_rate, capacity=1)
+            ),
+        }
+        self._private_chat_rate: float = private_chat_rate
+        self._group_chat_rate: float = group_chat_rate
+        self._chat_burst: int = chat_burst
+        self._max_retries: int = max_retries
+        self._global_flood_chats: int = global_flood_chats
+        # chat_id -> end of the wait asked for by the last 429 answer to the chat
+        self._flooded: dict[int | str, float] = {}
+        # A bucket that is idle for a minute is full again and can be dropped
+        self._chats: TTLCache = TTLCache(max_size=100_000, ttl=60)
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket: TokenBucket = self._chats.get(chat_id, default=MISSING, count=False)
+        if bucket is MISSING:
+            # Channels and supergroups can be addressed by username
+            group: bool = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(
+                rate=self._group_chat_rate if group else self._private_chat_rate,
+                capacity=self._chat_burst,
+            )
+        self._chats.set(chat_id, bucket)
+        return bucket
+
+    def _next_lane(self, now: float) -> _Lane | None:
+        for name in LANES:
+            lane: _Lane = self._lanes[name]
+            while lane.waiters and lane.waiters[0].done():
+                # The request was cancelled while it was waiting
+                lane.waiters.popleft()
+            if lane.waiters:
+                return lane
+        return None
+
+    def _flood(
+        self, chat_id: int | str, bucket: TokenBucket, retry_after: float
+    ) -> None:
+        """Pauses the chat, and every chat if the flood limit looks global"""
+        now: float = time.monotonic()
+        bucket.pause(retry_after)
+        self._flooded = {
+            chat: until for chat, until in self._flooded.items() if until > now
+        }
+        self._flooded[chat_id] = now + retry_after
+        if len(self._flooded) >= self._global_flood_chats:
+            metrics.counter("outbound_global_flood").inc()
+            self._global.pause(retry_after)
+
+    async def _dispatch(self) -> None:
+        """Hands out the tokens of the global bucket to the waiting requests, lane by lane"""
+        while True:
+            now: float = time.monotonic()
+            lane: _Lane | None = self._next_lane(now)
+            if lane is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay: float = max(
+                self._global.delay(), lane.bucket.delay() if lane.bucket else 0.0
+            )
+            if delay > 0:
+                # A request of a lane with a higher priority may arrive meanwhile
+                await asyncio.sleep(delay)
+                continue
+            self._global.take()
+            if lane.bucket is not None:
+                lane.bucket.take()
+            lane.waiters.popleft().set_result(None)
+            metrics.gauge("outbound_queue_depth", lane=lane.name).set(len(lane.waiters))
+
+    async def _acquire(self, lane: _Lane) -> None:
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        metrics.gauge("outbound_queue_depth", lane=lane.name).set(len(lane.waiters))
+        self._wakeup.set()
+        await waiter
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | dict | list[dict]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: dict | None,
+    ) -> bool | dict | list[dict]:
+        chat_id: int | str | None = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        lane: _Lane = self._lanes[(rate_limit_args or {}).get("lane", INTERACTIVE)]
+        bucket: TokenBucket = self._chat_bucket(chat_id)
+        started: float = time.monotonic()
+        for attempt in range(self._max_retries + 1):
+            await asyncio.sleep(bucket.reserve())
+            await self._acquire(lane)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                retry_after: float = float(exc.retry_after)
+                metrics.counter("outbound_retry_after", lane=lane.name).inc()
+                if attempt == self._max_retries:
+                    logger.error(
+                        "%s to %s failed after %s retries: %s",
+                        endpoint,
+                        chat_id,
+                        attempt,
+                        repr(exc),
+                    )
+                    raise
+                logger.info(
+                    "Flood limit hit for %s in the %s lane, retrying in %s s",
+                    chat_id,
+                    lane.name,
+                    retry_after,
+                )
+                self._flood(chat_id, bucket, retry_after)
+                continue
+            metrics.histogram("outbound_send_seconds", lane=lane.name).observe(
+                time.monotonic() - started
+            )
+            return result
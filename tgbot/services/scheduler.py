@@ -0,0 +1,171 @@
+"""
+Durable scheduler of advice deliveries
+Contains the AdviceScheduler class and advice_scheduler - object of the AdviceScheduler class
+
+The next due time of every subscriber is stored in the advice_schedule table, so subscriptions survive restarts
+and a repeated subscription replaces the previous one instead of starting a duplicate loop. A single repeating
+job of the application's JobQueue claims due subscriptions in batches and moves their next due time forward
+by whole intervals counted from the previous due time, so deliveries do not drift.
+
+Example:
+    Register the timer when the application is built:
+        advice_scheduler.start(job_queue=application.job_queue, deliver=send_advice)
+
+    Subscribe a user from a handler:
+        await advice_scheduler.subscribe(user_id=user_id, chat_id=chat_id, frequency=data["FREQUENCY"])
+"""
+
+import asyncio
+from typing import Awaitable, Callable
+
+from telegram import Bot
+from telegram.ext import CallbackContext, JobQueue
+
+from tgbot.config import ADVICE_SCHEDULER_BATCH_SIZE, ADVICE_SCHEDULER_TICK
+from tgbot.services.database import db
+from tgbot.utils.logger import logger
+
+Deliver = Callable[[Bot, int, int], Awaitable[None]]
+
+CLAIM_DUE_SUBSCRIPTIONS = """
+    UPDATE advice_schedule AS s
+    SET next_due = s.next_due + make_interval(
+        secs => s.interval_seconds
+        * (floor(extract(epoch FROM now() - s.next_due) / s.interval_seconds) + 1)
+    )
+    FROM (
+        SELECT user_id FROM advice_schedule
+        WHERE next_due <= now()
+        ORDER BY next_due
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ) AS due
+    WHERE s.user_id = due.user_id
+    RETURNING s.user_id, s.chat_id
+"""
+
+UPCOMING_PROFILES = """
+    SELECT DISTINCT u.topic, u.description, u.level
+    FROM advice_schedule AS s
+    JOIN user_data AS u ON u.user_id = s.user_id
+    WHERE s.next_due <= now() + make_interval(secs => $1)
+"""
+
+
+class AdviceScheduler:
+    """Delivers advice to subscribers off a single timer"""
+
+    def __init__(self, batch_size: int, tick_interval: float) -> None:
+        """
+        Initializing a class
+
+        :param batch_size: how many due subscriptions are claimed by one query
+        :type batch_size: int
+        :param tick_interval: how often, in seconds, the timer looks for due subscriptions
+        :type tick_interval: float
+        """
+        self._batch_size: int = batch_size
+        self._tick_interval: float = tick_interval
+        self._deliver: Deliver | None = None
+
+    @staticmethod
+    async def init_schema() -> None:
+        """Creates the table of subscriptions and the index used to find due ones"""
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS advice_schedule (
+                user_id BIGINT PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                interval_seconds DOUBLE PRECISION NOT NULL,
+                next_due TIMESTAMPTZ NOT NULL
+            )
+        """
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS advice_schedule_next_due_idx ON advice_schedule (next_due)"
+        )
+
+    @staticmethod
+    def interval_from_frequency(frequency: str | int) -> float:
+        """Converts the number of advices per day into the interval between them in seconds"""
+        try:
+            per_day: int = max(1, int(frequency))
+        except (TypeError, ValueError):
+            per_day = 1
+        return 24 * 3600 / per_day
+
+    async def subscribe(self, user_id: int, chat_id: int, frequency: str | int) -> None:
+        """Creates or replaces the subscription of the user, the first advice is due immediately"""
+        await db.execute(
+            """
+            INSERT INTO advice_schedule (user_id, chat_id, interval_seconds, next_due)
+            VALUES ($1, $2, $3, now())
+            ON CONFLICT (user_id) DO UPDATE
+            SET chat_id = EXCLUDED.chat_id,
+                interval_seconds = EXCLUDED.interval_seconds,
+                next_due = EXCLUDED.next_due
+        """,
+            user_id,
+            chat_id,
+            self.interval_from_frequency(frequency),
+        )
+
+    @staticmethod
+    async def unsubscribe(user_id: int) -> None:
+        """Cancels the subscription of the user"""
+        await db.execute("DELETE FROM advice_schedule WHERE user_id = $1", user_id)
+
+    async def claim_due(self) -> list[tuple[int, int]]:
+        """Claims a batch of due subscriptions and reschedules them, returns (user_id, chat_id) pairs"""
+        rows = await db.fetch(CLAIM_DUE_SUBSCRIPTIONS, self._batch_size)
+        return [(row["user_id"], row["chat_id"]) for row in rows]
+
+    @staticmethod
+    async def upcoming_profiles(lookahead: float) -> list[tuple[str, str, str]]:
+        """Returns the distinct profiles of the subscriptions due within lookahead seconds"""
+        rows = await db.fetch(UPCOMING_PROFILES, float(lookahead))
+        return [(row["topic"], row["description"], row["level"]) for row in rows]
+
+    def start(self, job_queue: JobQueue, deliver: Deliver) -> None:
+        """
+        Registers the timer in the job queue of the application
+
+        :param job_queue: job queue of the application
+        :type job_queue: JobQueue
+        :param deliver: coroutine function that sends one advice: deliver(bot, chat_id, user_id)
+        :type deliver: Deliver
+        """
+        self._deliver = deliver
+        job_queue.run_repeating(
+            callback=self._tick,
+            interval=self._tick_interval,
+            first=self._tick_interval,
+            name="advice_scheduler",
+            job_kwargs={"max_instances": 1, "coalesce": True},
+        )
+
+    async def _tick(self, context: CallbackContext) -> None:
+        """Delivers all due advices, batch after batch, until nothing is due"""
+        while True:
+            due: list[tuple[int, int]] = await self.claim_due()
+            if not due:
+                return
+            results = await asyncio.gather(
+                *(
+                    self._deliver(context.bot, chat_id, user_id)
+                    for user_id, chat_id in due
+                ),
+                return_exceptions=True,
+            )
+            for (user_id, _), result in zip(due, results):
+                if isinstance(result, Exception):
+                    logger.error(
+                        "Failed to deliver advice to user %s: %s", user_id, repr(result)
+                    )
+            if len(due) < self._batch_size:
+                return
+
+
+advice_scheduler: AdviceScheduler = AdviceScheduler(
+    batch_size=ADVICE_SCHEDULER_BATCH_SIZE, tick_interval=ADVICE_SCHEDULER_TICK
+)
@@ -0,0 +1,281 @@
+"""
+Persistent cache of web search results
+Contains the SearchCache class and search_cache - object of the SearchCache class
+
+Results are stored in a local SQLite file keyed by the normalized query, so they survive restarts.
+Every entry has a time to live; after it expires the entry is still served for a grace period while a fresh
+result is fetched in the background (stale-while-revalidate). The least recently used entries are evicted
+when the number of entries exceeds the limit.
+
+Lookups only read on the event loop. The access times of hits are kept in memory and written in batches, and
+all writes (results, access times and evictions) run on the blocking_io pool through a connection of their own,
+which waits up to SEARCH_CACHE_BUSY_TIMEOUT for a lock held by another process instead of failing.
+
+Example:
+    Wrap a search function:
+        result: str = await search_cache.get_or_fetch(query=query, fetch=run_search)
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable
+
+from tgbot.config import (
+    SEARCH_CACHE_ACCESS_BATCH,
+    SEARCH_CACHE_BUSY_TIMEOUT,
+    SEARCH_CACHE_FILE,
+    SEARCH_CACHE_MAX_ENTRIES,
+    SEARCH_CACHE_STALE_TTL,
+    SEARCH_CACHE_TTL,
+)
+from tgbot.services.executors import blocking_io
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+Fetch = Callable[[str], Awaitable[str]]
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace and case, so that equivalent queries share one entry"""
+    return " ".join(query.split()).casefold()
+
+
+class SearchCache:
+    """SQLite-backed cache of search results with TTL, LRU eviction and background refresh"""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float,
+        stale_ttl: float,
+        max_entries: int,
+        busy_timeout: float = SEARCH_CACHE_BUSY_TIMEOUT,
+        access_batch: int = SEARCH_CACHE_ACCESS_BATCH,
+        timer: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param path: path to the SQLite file, ":memory:" keeps the cache in memory only
+        :type path: str
+        :param ttl: seconds during which an entry is fresh
+        :type ttl: float
+        :param stale_ttl: seconds after expiration during which a stale entry is served while it is refreshed
+        :type stale_ttl: float
+        :param max_entries: maximum number of stored entries
+        :type max_entries: int
+        :param busy_timeout: seconds a write waits for a lock held by another connection
+        :type busy_timeout: float
+        :param access_batch: number of hits whose access times are written together
+        :type access_batch: int
+        :param timer: source of the current time
+        :type timer: Callable[[], float]
+        """
+        self._path: str = path
+        self._ttl: float = ttl
+        self._stale_ttl: float = stale_ttl
+        self._max_entries: int = max_entries
+        self._busy_timeout: float = busy_timeout
+        self._access_batch: int = access_batch
+        self._timer: Callable[[], float] = timer
+        self._conn: sqlite3.Connection | None = None
+        self._writer: sqlite3.Connection | None = None
+        # Writes run in the threads of the pool, one at a time
+        self._write_lock: threading.Lock = threading.Lock()
+        self._accessed: dict[str, float] = {}
+        self._writes_since_eviction: int = 0
+        self._refreshing: dict[str, asyncio.Task] = {}
+        # A reference is kept so the task is not garbage collected before it is done
+        self._flushing: asyncio.Task | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection = sqlite3.connect(
+            self._path, isolation_level=None, check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(self._busy_timeout * 1000)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_results (
+                query TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS search_results_accessed_at_idx "
+            "ON search_results (accessed_at)"
+        )
+        return conn
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """Connection of the lookups, they run on the event loop"""
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    @property
+    def _write_db(self) -> sqlite3.Connection:
+        """Connection of the writes, they run in the pool"""
+        if self._path == ":memory:":
+            # Every connection to ":memory:" opens a database of its own
+            return self._db
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def lookup(self, query: str) -> tuple[str | None, bool]:
+        """
+        Returns the cached result and whether it is still fresh
+
+        :param query: normalized query
+        :type query: str
+        :return: (result, True) for a fresh entry, (result, False) for a stale one, (None, False) on a miss
+        :rtype: tuple[str | None, bool]
+        """
+        now: float = self._timer()
+        row = self._db.execute(
+            "SELECT result, created_at FROM search_results WHERE query = ?", (query,)
+        ).fetchone()
+        if row is None:
+            return None, False
+        result, created_at = row
+        age: float = now - created_at
+        if age > self._ttl + self._stale_ttl:
+            return None, False
+        # Written with the next batch
+        self._accessed[query] = now
+        return result, age <= self._ttl
+
+    def _write(
+        self,
+        accessed: dict[str, float],
+        rows: list[tuple[str, str, float, float]],
+        evict: bool,
+    ) -> None:
+        """Runs in the pool: writes the access times and the results, then evicts if asked to"""
+        with self._write_lock:
+            db: sqlite3.Connection = self._write_db
+            if accessed:
+                db.executemany(
+                    "UPDATE search_results SET accessed_at = max(accessed_at, ?) WHERE query = ?",
+                    [(accessed_at, query) for query, accessed_at in accessed.items()],
+                )
+            if rows:
+                db.executemany(
+                    "INSERT OR REPLACE INTO search_results (query, result, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+            if evict:
+                db.execute(
+                    """
+                    DELETE FROM search_results WHERE query IN (
+                        SELECT query FROM search_results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                    )
+                """,
+                    (self._max_entries,),
+                )
+
+    async def _submit(
+        self, rows: list[tuple[str, str, float, float]], evict: bool = False
+    ) -> None:
+        accessed, self._accessed = self._accessed, {}
+        await blocking_io.run("search_cache", self._write, accessed, rows, evict)
+
+    async def store(self, query: str, result: str) -> None:
+        """Stores the result of the normalized query, with the pending access times"""
+        now: float = self._timer()
+        self._writes_since_eviction += 1
+        evict: bool = self._writes_since_eviction >= max(1, self._max_entries // 100)
+        if evict:
+            self._writes_since_eviction = 0
+        await self._submit([(query, result, now, now)], evict=evict)
+
+    async def evict(self) -> None:
+        """Removes the least recently used entries above the size limit"""
+        self._writes_since_eviction = 0
+        await self._submit([], evict=True)
+
+    def _flush_accessed_in_background(self) -> None:
+        if len(self._accessed) < self._access_batch or self._flushing is not None:
+            return
+
+        async def flush() -> None:
+            try:
+                await self._submit([])
+            except Exception as exc:
+                logger.warning("Failed to write search access times: %s", repr(exc))
+            finally:
+                self._flushing = None
+
+        self._flushing = asyncio.create_task(flush())
+
+    async def get_or_fetch(self, query: str, fetch: Fetch) -> str:
+        """
+        Returns the cached result of the query, calling fetch on a miss
+
+        :param query: search query, it is normalized before the lookup
+        :type query: str
+        :param fetch: coroutine function that performs the search
+        :type fetch: Fetch
+        """
+        key: str = normalize_query(query)
+        result, fresh = self.lookup(key)
+        if result is not None:
+            metrics.counter("search_cache_hits", fresh=fresh).inc()
+            self._flush_accessed_in_background()
+            if not fresh:
+                self._refresh_in_background(key, query, fetch)
+            return result
+        metrics.counter("search_cache_misses").inc()
+        result = await fetch(query)
+        try:
+            await self.store(key, result)
+        except Exception as exc:
+            # The result is already paid for, the user gets it also if it is not cached
+            logger.warning("Failed to store search result %r: %s", key, repr(exc))
+        return result
+
+    def _refresh_in_background(self, key: str, query: str, fetch: Fetch) -> None:
+        if key in self._refreshing:
+            return
+
+        async def refresh() -> None:
+            try:
+                await self.store(key, await fetch(query))
+            except Exception as exc:
+                logger.warning("Failed to refresh search result %r: %s", key, repr(exc))
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.create_task(refresh())
+
+    def close(self) -> None:
+        """Writes the pending access times and closes the SQLite connections"""
+        for task in self._refreshing.values():
+            task.cancel()
+        if self._flushing is not None:
+            self._flushing.cancel()
+        if self._accessed and (self._conn is not None or self._writer is not None):
+            accessed, self._accessed = self._accessed, {}
+            self._write(accessed, [], evict=False)
+        with self._write_lock:
+            for conn in (self._writer, self._conn):
+                if conn is not None:
+                    conn.close()
+            self._conn = self._writer = None
+
+
+search_cache: SearchCache = SearchCache(
+    path=SEARCH_CACHE_FILE,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+)
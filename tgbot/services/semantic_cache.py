@@ -0,0 +1,197 @@
+"""
+Semantic cache of chat answers
+Contains the SemanticAnswerCache class
+
+Answers are cached per (topic, level, persona) partition. An incoming query is embedded and looked up with an
+inner-product FAISS index over the normalized embeddings of past queries of the same partition; if the most
+similar query is above the similarity threshold, its answer is returned without searching the web or calling
+the LLM. Every partition keeps at most `max_entries` answers, evicting the least recently used ones, and
+answers expire after `ttl` seconds. Topics are free text, so at most `max_partitions` partitions are kept,
+the least recently used one is dropped with its answers.
+
+An answer is shared by everyone who asks a similar question in the partition, so only answers that do not
+depend on the user (their name, description or memory) may be stored.
+
+The hits and misses are reported per topic. Topics are free text, so the caller passes the label of the
+topic, e.g. the topic itself for the topics offered to the users and "other" for the rest.
+
+Example:
+    Create a cache around an embedding function:
+        answer_cache = SemanticAnswerCache(embed=embeddings.aembed_query, threshold=0.95)
+
+    Look an answer up and store it on a miss:
+        hit: CacheLookup = await answer_cache.lookup(topic, level, persona, query, label="ai")
+        if hit.answer is None:
+            answer = await answer_the_query(query)
+            answer_cache.store(hit, answer)
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+import numpy as np
+
+from tgbot.services.cohorts import normalize
+from tgbot.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    import faiss
+
+Embed = Callable[[str], Awaitable[list[float]]]
+PartitionKey = tuple[str, str, str]
+OTHER_TOPIC: str = "other"
+
+
+@dataclass
+class CacheLookup:
+    """Result of a lookup, passed back to store() on a miss so the query is not embedded twice"""
+
+    key: PartitionKey
+    vector: np.ndarray
+    answer: str | None = None
+    similarity: float = 0.0
+
+
+@dataclass
+class _Partition:
+    index: "faiss.IndexIDMap2"
+    # id -> (answer, created_at, used_at)
+    entries: dict[int, list] = field(default_factory=dict)
+    next_id: int = 0
+
+
+class SemanticAnswerCache:
+    """Returns the answer of a past query that is similar enough to the new one"""
+
+    def __init__(
+        self,
+        embed: Embed,
+        threshold: float,
+        max_entries: int = 1000,
+        ttl: float = 24 * 3600,
+        max_partitions: int = 500,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param embed: coroutine function that embeds a query
+        :type embed: Embed
+        :param threshold: minimum cosine similarity between two queries to share an answer
+        :type threshold: float
+        :param max_entries: maximum number of answers kept per partition
+        :type max_entries: int
+        :param ttl: time to live of an answer in seconds
+        :type ttl: float
+        :param max_partitions: maximum number of partitions, the least recently used one is dropped
+        :type max_partitions: int
+        :param timer: source of the current time
+        :type timer: Callable[[], float]
+        """
+        self._embed: Embed = embed
+        self._threshold: float = threshold
+        self._max_entries: int = max_entries
+        self._ttl: float = ttl
+        self._max_partitions: int = max_partitions
+        self._timer: Callable[[], float] = timer
+        self._partitions: OrderedDict[PartitionKey, _Partition] = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(partition.entries) for partition in self._partitions.values())
+
+    @staticmethod
+    def partition_key(topic: str, level: str, persona: str) -> PartitionKey:
+        return normalize(topic), normalize(level), normalize(persona)
+
+    async def _vector(self, query: str) -> np.ndarray:
+        # FAISS is imported on first use, not when the bot starts
+        import faiss
+
+        vector: np.ndarray = np.asarray([await self._embed(query)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    async def lookup(
+        self, topic: str, level: str, persona: str, query: str, label: str = OTHER_TOPIC
+    ) -> CacheLookup:
+        """
+        Looks up the answer of the most similar past query of the partition
+
+        :param label: topic in the metrics, one of a bounded set of values
+        :type label: str
+        :return: the lookup, its answer is None on a miss
+        :rtype: CacheLookup
+        """
+        started_at: float = time.monotonic()
+        result: CacheLookup = CacheLookup(
+            key=self.partition_key(topic, level, persona),
+            vector=await self._vector(query),
+        )
+        partition: _Partition | None = self._partitions.get(result.key)
+        if partition is not None:
+            self._partitions.move_to_end(result.key)
+        if partition is not None and partition.entries:
+            similarities, ids = partition.index.search(result.vector, 1)
+            entry: list | None = partition.entries.get(int(ids[0][0]))
+            now: float = self._timer()
+            if entry is not None and now - entry[1] > self._ttl:
+                self._remove(partition, [int(ids[0][0])])
+            elif entry is not None and similarities[0][0] >= self._threshold:
+                entry[2] = now
+                result.answer = entry[0]
+                result.similarity = float(similarities[0][0])
+        hit: bool = result.answer is not None
+        metrics.counter(
+            "semantic_cache_hits" if hit else "semantic_cache_misses", topic=label
+        ).inc()
+        metrics.histogram("semantic_cache_lookup_seconds", topic=label).observe(
+            time.monotonic() - started_at
+        )
+        return result
+
+    def store(self, lookup: CacheLookup, answer: str) -> None:
+        """Caches the answer of the query of a missed lookup"""
+        partition: _Partition | None = self._partitions.get(lookup.key)
+        if partition is None:
+            import faiss
+
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(lookup.vector.shape[1]))
+            partition = self._partitions[lookup.key] = _Partition(index=index)
+            while len(self._partitions) > self._max_partitions:
+                _, dropped = self._partitions.popitem(last=False)
+                metrics.counter("semantic_cache_evictions").inc(len(dropped.entries))
+        self._partitions.move_to_end(lookup.key)
+        now: float = self._timer()
+        partition.index.add_with_ids(
+            lookup.vector, np.asarray([partition.next_id], dtype=np.int64)
+        )
+        partition.entries[partition.next_id] = [answer, now, now]
+        partition.next_id += 1
+        self._evict(partition)
+
+    def _evict(self, partition: _Partition) -> None:
+        """Removes expired answers and the least recently used answers above the limit"""
+        now: float = self._timer()
+        expired: list[int] = [
+            id_
+            for id_, entry in partition.entries.items()
+            if now - entry[1] > self._ttl
+        ]
+        excess: int = len(partition.entries) - len(expired) - self._max_entries
+        if excess > 0:
+            skip: set[int] = set(expired)
+            expired += sorted(
+                (id_ for id_ in partition.entries if id_ not in skip),
+                key=lambda id_: partition.entries[id_][2],
+            )[:excess]
+        if expired:
+            self._remove(partition, expired)
+            metrics.counter("semantic_cache_evictions").inc(len(expired))
+
+    @staticmethod
+    def _remove(partition: _Partition, ids: list[int]) -> None:
+        partition.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        for id_ in ids:
+            del partition.entries[id_]
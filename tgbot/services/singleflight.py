@@ -0,0 +1,92 @@
+"""
+Coalescing of identical concurrent requests
+Contains the SingleFlight class, which lets concurrent identical calls share one in-flight call, and request_key
+
+The OpenAI requests are deterministic (temperature=0), so when several users or cohorts send the same request at
+the same time, only the first one is sent and the others wait for its result. A call runs in its own task: the
+caller that started it can be cancelled without cancelling it for the others, and it is cancelled only when no
+caller waits for it any more. If the call fails, every waiting caller gets the error and the next identical
+request starts a new call.
+
+Example:
+    Share one completion between identical concurrent requests:
+        llm_requests = SingleFlight(name="openai")
+        answer = await llm_requests.do(request_key("completion", data), lambda: create_completion(data))
+"""
+
+import asyncio
+import hashlib
+import json
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Awaitable, Callable, TypeVar
+
+from tgbot.utils.metrics import metrics
+
+T = TypeVar("T")
+
+
+def request_key(*parts: Any) -> str:
+    """Returns a hash of the request, parts are serialized with sorted keys so equal requests get equal keys"""
+    payload: str = json.dumps(
+        parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@dataclass
+class _Flight:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, concurrent callers with the same key share its result"""
+
+    def __init__(self, name: str) -> None:
+        """
+        Initializing a class
+
+        :param name: name of the calls in the metrics
+        :type name: str
+        """
+        self._name: str = name
+        self._flights: dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Returns the result of the call in flight with the same key, or of a new call
+
+        :param key: key of the request, see request_key
+        :type key: str
+        :param call: coroutine function that makes the request
+        :type call: Callable[[], Awaitable[T]]
+        """
+        flight: _Flight | None = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(task=asyncio.create_task(call()))
+            flight.task.add_done_callback(partial(self._land, key))
+            metrics.counter("singleflight_calls", service=self._name).inc()
+        else:
+            metrics.counter("singleflight_coalesced", service=self._name).inc()
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Every caller was cancelled, nobody needs the result. Callers that come later start a new call
+                # instead of joining the one being cancelled
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def _land(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is not None and self._flights[key].task is task:
+            del self._flights[key]
+        # The error is raised to the callers, if every caller was cancelled it is not logged as unretrieved
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,110 @@
+"""
+Token-aware text splitting in a single pass
+Contains the TokenWindowSplitter class, a langchain TextSplitter that cuts chunks on token offsets
+
+A document is tokenized once. Chunks are windows of at most `chunk_size` tokens that overlap by about
+`chunk_overlap` tokens; the end of every window is moved back, and the start of the next one forward, to the
+nearest separator ("\n\n", then "\n", then " "), so chunks keep paragraphs and words whole like the recursive
+splitter did. Positions are mapped between tokens and characters with the offsets of the tokens, so splitting
+takes linear time instead of re-counting the tokens of every candidate piece.
+
+Example:
+    Split a document into chunks of 900 tokens with 200 tokens of overlap:
+        chunks: list[str] = TokenWindowSplitter(chunk_size=900, chunk_overlap=200).split_text(document)
+"""
+
+from bisect import bisect_left
+
+from langchain.text_splitter import TextSplitter
+
+from tgbot.services.prompts import count_tokens, encode, get_encoding
+
+DEFAULT_SEPARATORS: tuple[str, ...] = ("\n\n", "\n", " ")
+
+
+class TokenWindowSplitter(TextSplitter):
+    """Cuts a text into overlapping windows of tokens that end on separators"""
+
+    def __init__(
+        self,
+        chunk_size: int = 900,
+        chunk_overlap: int = 200,
+        separators: tuple[str, ...] = DEFAULT_SEPARATORS,
+        **kwargs,
+    ) -> None:
+        """
+        Initializing a class
+
+        :param chunk_size: maximum number of tokens in a chunk
+        :type chunk_size: int
+        :param chunk_overlap: number of tokens shared by two consecutive chunks
+        :type chunk_overlap: int
+        :param separators: boundaries chunks are cut on, from the most to the least preferred
+        :type separators: tuple[str, ...]
+        """
+        super().__init__(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=count_tokens,
+            **kwargs,
+        )
+        self._separators: tuple[str, ...] = separators
+
+    def split_text(self, text: str) -> list[str]:
+        tokens: list[int] = encode(text)
+        if not tokens:
+            return []
+        decoded, offsets = get_encoding().decode_with_offsets(tokens)
+        # Offsets index the decoded text, which equals the input for valid UTF-8
+        text = decoded
+        offsets.append(len(text))
+        size: int = self._chunk_size
+        overlap: int = self._chunk_overlap
+
+        chunks: list[str] = []
+        start: int = 0
+        while start < len(tokens):
+            end: int = min(start + size, len(tokens))
+            if end < len(tokens):
+                # Never shrink a chunk below half of its size to reach a separator
+                end = self._snap(
+                    text, offsets, start + max(1, size // 2), end, last=True
+                )
+            chunk: str = text[offsets[start] : offsets[end]]
+            if self._strip_whitespace:
+                chunk = chunk.strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= len(tokens):
+                break
+            next_start: int = max(end - overlap, start + 1)
+            # The overlap starts at a separator too, but never later than the end of the chunk
+            start = self._snap(
+                text,
+                offsets,
+                next_start,
+                min(next_start + overlap // 2, end),
+                last=False,
+            )
+        return chunks
+
+    def _snap(
+        self, text: str, offsets: list[int], low: int, high: int, last: bool
+    ) -> int:
+        """
+        Returns the token index in [low, high] closest to a separator, searching from high down when last
+        is True, or from low up otherwise; high or low respectively if there is no separator in between
+        """
+        fallback: int = high if last else low
+        if low >= high:
+            return fallback
+        window: str = text[offsets[low] : offsets[high]]
+        for separator in self._separators:
+            position: int = window.rfind(separator) if last else window.find(separator)
+            if position < 0:
+                continue
+            # The separator starts the next piece, as with keep_separator in the recursive splitter
+            index: int = bisect_left(offsets, offsets[low] + position, low, high + 1)
+            if low < index <= high or (not last and index == low):
+                return index
+        return fallback
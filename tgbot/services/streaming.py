@@ -0,0 +1,163 @@
+"""
+Streaming of LLM answers into a Telegram message
+Contains the MessageStreamer class, which shows an answer while it is being generated
+
+The first chunk is sent as a new message as soon as it arrives, then the same message is edited as more
+text comes in. Edits are throttled to one per `min_interval` seconds, which keeps a single chat well within
+the limits enforced by the application's rate limiter. The last edit always contains the full answer.
+
+A message holds at most 4096 characters: when the answer outgrows it, the message gets its final part, cut at
+a line break or a space, and the answer goes on in a new message. An empty answer is replaced by an apology,
+so the user is never left without a reply.
+
+Example:
+    Stream an answer into the chat and get the full text back:
+        answer: str = await MessageStreamer(bot=context.bot, chat_id=chat_id).stream(
+            chunks=stream_conversation(user_data, query)
+        )
+
+    Send a complete answer the same way:
+        await MessageStreamer(bot=context.bot, chat_id=chat_id).send(answer)
+"""
+
+import time
+from typing import AsyncIterator
+
+from telegram import Bot, Message
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest
+
+from tgbot.config import STREAM_EDIT_INTERVAL
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+from tgbot.utils.templates import template
+
+# Appended to the text while the answer is still being generated
+CURSOR: str = " ▌"
+MAX_LENGTH: int = MessageLimit.MAX_TEXT_LENGTH
+
+
+def split_text(text: str, limit: int = MAX_LENGTH) -> list[str]:
+    """Splits the text into parts of at most limit characters, at the last line break or space of a part"""
+    parts: list[str] = []
+    while len(text) > limit:
+        cut: int = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+
+class MessageStreamer:
+    """Pushes a growing answer into one message with throttled edits"""
+
+    def __init__(
+        self, bot: Bot, chat_id: int, min_interval: float = STREAM_EDIT_INTERVAL
+    ) -> None:
+        """
+        Initializing a class
+
+        :param bot: the bot that sends the message
+        :type bot: Bot
+        :param chat_id: chat to send the answer to
+        :type chat_id: int
+        :param min_interval: minimum time in seconds between two edits of the message
+        :type min_interval: float
+        """
+        self._bot: Bot = bot
+        self._chat_id: int = chat_id
+        self._min_interval: float = min_interval
+        self._message: Message | None = None
+        self._shown_at: float = 0.0
+        # Position in the answer where the text of the current message starts
+        self._offset: int = 0
+
+    async def stream(self, chunks: AsyncIterator[str]) -> str:
+        """
+        Shows the chunks in the chat as they arrive
+
+        :param chunks: asynchronous iterator over parts of the answer
+        :type chunks: AsyncIterator[str]
+        :return: the full answer
+        :rtype: str
+        """
+        started_at: float = time.monotonic()
+        text: str = ""
+        async for chunk in chunks:
+            text += chunk
+            part: str = text[self._offset :]
+            while len(part) + len(CURSOR) > MAX_LENGTH:
+                # The message is full, the answer goes on in a new one
+                head: str = split_text(part, MAX_LENGTH - len(CURSOR))[0]
+                if head.strip():
+                    await self._complete(head)
+                self._offset += len(head)
+                part = text[self._offset :]
+            if not part.strip():
+                continue
+            if self._message is None:
+                self._message = await self._bot.send_message(
+                    chat_id=self._chat_id, text=part + CURSOR, parse_mode=None
+                )
+                self._shown_at = time.monotonic()
+                if not self._offset:
+                    metrics.histogram("stream_first_token_seconds").observe(
+                        self._shown_at - started_at
+                    )
+            elif time.monotonic() - self._shown_at >= self._min_interval:
+                await self._edit(self._message, part + CURSOR, parse_mode=None)
+                self._shown_at = time.monotonic()
+        await self._finish(text)
+        return text
+
+    async def send(self, text: str) -> None:
+        """
+        Sends a complete answer, in several messages if it is too long for one
+
+        :param text: the answer
+        :type text: str
+        """
+        await self._finish(text)
+
+    @staticmethod
+    async def _edit(message: Message, text: str, **kwargs) -> None:
+        try:
+            await message.edit_text(text=text, **kwargs)
+        except BadRequest as exc:
+            # e.g. "Message is not modified", the next edit will catch up
+            logger.debug("Skipped edit of a streamed message: %s", repr(exc))
+
+    async def _finish(self, text: str) -> None:
+        """Shows the rest of the answer, or an apology if the answer is empty"""
+        if not text.strip():
+            metrics.counter("stream_empty_answers").inc()
+            await self._bot.send_message(
+                chat_id=self._chat_id,
+                text=template.render_sync(template_name="empty_answer.jinja2"),
+            )
+            return
+        for part in split_text(text[self._offset :]):
+            if part.strip():
+                await self._complete(part)
+
+    async def _complete(self, text: str) -> None:
+        """Shows the final text of the current message, formatted with the default parse mode of the bot"""
+        message: Message | None = self._message
+        self._message = None
+        try:
+            if message is None:
+                await self._bot.send_message(chat_id=self._chat_id, text=text)
+            else:
+                await message.edit_text(text=text)
+        except BadRequest:
+            # The answer is not valid HTML, show it as plain text
+            if message is None:
+                await self._bot.send_message(
+                    chat_id=self._chat_id, text=text, parse_mode=None
+                )
+            else:
+                await self._edit(message, text, parse_mode=None)
@@ -0,0 +1,261 @@
+"""
+Persistent, incremental vector indexes
+Contains the VectorIndex class, a FAISS index saved to disk, and vector_indexes - the manager of the named indexes
+
+Every index lives in its own directory: the FAISS index itself (an IndexIDMap2 over a flat index, so chunks can
+be removed by id) and a JSON file with the text, the content hash and the documents of every chunk. An index is
+opened memory-mapped and read-only and is only read into memory when it is changed for the first time, so a
+cold start needs no re-embedding. Adding a document embeds only the chunks whose content hash is not indexed yet,
+and removing a document removes only the chunks no other document refers to.
+
+Example:
+    Index a document and search the whole index:
+        index: VectorIndex = vector_indexes.get("documents", embeddings=OpenAIEmbeddings())
+        index.add_document(doc_id="faq", chunks=text_chunks)
+        index.save()
+        docs = index.as_vectorstore().similarity_search(query)
+
+    Remove a document:
+        index.delete_document("faq")
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from os.path import exists, join
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from tgbot.config import VECTOR_INDEX_DIR
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+# FAISS and langchain are imported when an index is first used, not when the bot starts
+if TYPE_CHECKING:
+    import faiss
+    from langchain.embeddings.base import Embeddings
+    from langchain.vectorstores import FAISS
+
+INDEX_FILE: str = "index.faiss"
+CHUNKS_FILE: str = "chunks.json"
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+@dataclass
+class Chunk:
+    """An indexed piece of text and the documents it belongs to"""
+
+    text: str
+    digest: str
+    doc_ids: list[str] = field(default_factory=list)
+
+
+class VectorIndex:
+    """FAISS index of text chunks that is saved to disk and changed incrementally"""
+
+    def __init__(self, path: str, embeddings: "Embeddings") -> None:
+        """
+        Initializing a class
+
+        :param path: directory of the index, it is created on the first save
+        :type path: str
+        :param embeddings: model used to embed the chunks and the queries
+        :type embeddings: Embeddings
+        """
+        self._path: str = path
+        self._embeddings: "Embeddings" = embeddings
+        self._index: "faiss.IndexIDMap2 | None" = None
+        self._mapped: bool = False
+        self._chunks: dict[int, Chunk] = {}
+        self._ids_by_hash: dict[str, int] = {}
+        self._next_id: int = 0
+        # The chunks changed since the index was loaded or saved
+        self._dirty: bool = False
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def _load(self) -> None:
+        import faiss
+
+        index_file: str = join(self._path, INDEX_FILE)
+        if not exists(index_file):
+            return
+        self._index = faiss.read_index(
+            index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        self._mapped = True
+        with open(join(self._path, CHUNKS_FILE), encoding="utf-8") as file:
+            data: dict = json.load(file)
+        self._next_id = data["next_id"]
+        for id_, chunk in data["chunks"].items():
+            self._chunks[int(id_)] = Chunk(**chunk)
+            self._ids_by_hash[chunk["digest"]] = int(id_)
+        logger.info("Loaded vector index %s with %s chunks", self._path, len(self))
+
+    def _writable(self, dimension: int) -> "faiss.IndexIDMap2":
+        """Returns the index ready to be changed, reading a memory-mapped index into memory"""
+        import faiss
+
+        self._dirty = True
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+        elif self._mapped:
+            self._index = faiss.read_index(join(self._path, INDEX_FILE))
+            self._mapped = False
+        return self._index
+
+    def add_document(self, doc_id: str, chunks: list[str]) -> int:
+        """
+        Adds or replaces a document, only chunks that are not indexed yet are embedded
+
+        :param doc_id: identifier of the document
+        :type doc_id: str
+        :param chunks: the chunks of the document
+        :type chunks: list[str]
+        :return: number of embedded chunks
+        :rtype: int
+        """
+        hashes: dict[str, str] = {content_hash(text): text for text in chunks}
+        # Chunks the new version of the document no longer contains
+        self._detach(
+            doc_id,
+            [
+                id_
+                for id_, chunk in self._chunks.items()
+                if doc_id in chunk.doc_ids and chunk.digest not in hashes
+            ],
+        )
+        new: dict[str, str] = {}
+        for digest, text in hashes.items():
+            id_: int | None = self._ids_by_hash.get(digest)
+            if id_ is None:
+                new[digest] = text
+            elif doc_id not in self._chunks[id_].doc_ids:
+                self._chunks[id_].doc_ids.append(doc_id)
+                self._dirty = True
+        metrics.counter("vector_index_chunks_skipped").inc(len(hashes) - len(new))
+        if not new:
+            return 0
+
+        vectors: np.ndarray = np.asarray(
+            self._embeddings.embed_documents(list(new.values())), dtype=np.float32
+        )
+        ids: np.ndarray = np.arange(
+            self._next_id, self._next_id + len(new), dtype=np.int64
+        )
+        self._writable(vectors.shape[1]).add_with_ids(vectors, ids)
+        for id_, (digest, text) in zip(ids.tolist(), new.items()):
+            self._chunks[id_] = Chunk(text=text, digest=digest, doc_ids=[doc_id])
+            self._ids_by_hash[digest] = id_
+        self._next_id += len(new)
+        metrics.counter("vector_index_chunks_embedded").inc(len(new))
+        return len(new)
+
+    def delete_document(self, doc_id: str) -> None:
+        """Removes the document, chunks shared with other documents stay in the index"""
+        self._detach(
+            doc_id,
+            [id_ for id_, chunk in self._chunks.items() if doc_id in chunk.doc_ids],
+        )
+
+    def _detach(self, doc_id: str, ids: list[int]) -> None:
+        orphans: list[int] = []
+        for id_ in ids:
+            chunk: Chunk = self._chunks[id_]
+            chunk.doc_ids.remove(doc_id)
+            self._dirty = True
+            if not chunk.doc_ids:
+                orphans.append(id_)
+        if not orphans:
+            return
+        self._writable(self._index.d).remove_ids(np.asarray(orphans, dtype=np.int64))
+        for id_ in orphans:
+            del self._ids_by_hash[self._chunks.pop(id_).digest]
+
+    def save(self) -> None:
+        """Writes the index to disk, replacing the files atomically"""
+        if not self._dirty:
+            return
+        import faiss
+
+        os.makedirs(self._path, exist_ok=True)
+        index_file: str = join(self._path, INDEX_FILE)
+        # A memory-mapped index has not changed, only the documents of its chunks have
+        if not self._mapped:
+            faiss.write_index(self._index, index_file + ".tmp")
+        chunks_file: str = join(self._path, CHUNKS_FILE)
+        with open(chunks_file + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "next_id": self._next_id,
+                    "chunks": {
+                        id_: chunk.__dict__ for id_, chunk in self._chunks.items()
+                    },
+                },
+                file,
+            )
+        if not self._mapped:
+            os.replace(index_file + ".tmp", index_file)
+        os.replace(chunks_file + ".tmp", chunks_file)
+        self._dirty = False
+
+    def as_vectorstore(self) -> "FAISS":
+        """Returns a langchain vector store that searches the index"""
+        from langchain.docstore.document import Document
+        from langchain.docstore.in_memory import InMemoryDocstore
+        from langchain.vectorstores import FAISS
+
+        if self._index is None:
+            raise ValueError(f"Vector index {self._path} is empty")
+        return FAISS(
+            embedding_function=self._embeddings,
+            index=self._index,
+            docstore=InMemoryDocstore(
+                {
+                    str(id_): Document(
+                        page_content=chunk.text, metadata={"doc_ids": chunk.doc_ids}
+                    )
+                    for id_, chunk in self._chunks.items()
+                }
+            ),
+            # The index returns the ids of the chunks, not their positions
+            index_to_docstore_id={id_: str(id_) for id_ in self._chunks},
+        )
+
+
+class VectorIndexManager:
+    """Opens every named index once per process"""
+
+    def __init__(self, directory: str) -> None:
+        """
+        Initializing a class
+
+        :param directory: directory that contains the directories of the indexes
+        :type directory: str
+        """
+        self._directory: str = directory
+        self._indexes: dict[str, VectorIndex] = {}
+
+    def get(self, name: str, embeddings: "Embeddings") -> VectorIndex:
+        """Returns the index with the given name, loading it from disk on first use"""
+        index: VectorIndex | None = self._indexes.get(name)
+        if index is None:
+            index = self._indexes[name] = VectorIndex(
+                path=join(self._directory, name), embeddings=embeddings
+            )
+        return index
+
+    def save(self) -> None:
+        """Saves all changed indexes"""
+        for index in self._indexes.values():
+            index.save()
+
+
+vector_indexes: VectorIndexManager = VectorIndexManager(directory=VECTOR_INDEX_DIR)
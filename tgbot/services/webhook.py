@@ -0,0 +1,222 @@
+"""
+Webhook serving mode
+Contains the WebhookServer class, an aiohttp server that receives updates from Telegram and shards them
+between worker processes by chat_id
+
+The server process only verifies the secret token of every request, reads the chat of the update and puts
+the raw update into the queue of worker chat_id % workers, so all updates of one chat, and the user_data kept
+in memory for it, stay in one process. Every worker runs its own Application without an updater and feeds the
+updates into it. The webhook is set without dropping pending updates, so updates sent while the bot was
+restarting are delivered once it is back.
+
+Handling an update costs a worker about 2 ms of CPU, mostly in python-telegram-bot (decoding the update and
+the Bot API call), while the server process only parses and forwards it, so the bot scales with the CPUs, not
+with the processes: env.get_web_concurrency() caps WEB_CONCURRENCY to the CPUs available to the bot.
+
+Polling and the webhook are exclusive: while a webhook is set Telegram answers getUpdates with 409 Conflict,
+and run_polling deletes the webhook. The Procfile runs the bot with polling as a worker process; to serve the
+webhook instead, replace its line with "web: python3 main.py" and set BOT_MODE=webhook, never run both.
+
+Example:
+    Serve the bot with 4 worker processes:
+        WebhookServer(
+            build=build_application,
+            workers=4,
+            url="https://example.com/telegram",
+            secret=env.get_webhook_secret(),
+            port=8080,
+            token=env.get_bot_token(),
+            base_url=env.get_bot_api_url(),
+        ).run()
+"""
+
+import asyncio
+import hmac
+import multiprocessing
+import signal
+from multiprocessing.queues import Queue
+from typing import Any, Callable
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+SECRET_HEADER: str = "X-Telegram-Bot-Api-Secret-Token"
+# Kinds of updates whose chat is not at update[kind]["chat"]
+_NESTED_CHAT: dict[str, tuple[str, ...]] = {
+    "callback_query": ("message", "chat"),
+    "inline_query": ("from",),
+    "chosen_inline_result": ("from",),
+    "shipping_query": ("from",),
+    "pre_checkout_query": ("from",),
+    "poll_answer": ("user",),
+}
+
+Build = Callable[[int], Application]
+
+
+def shard_key(update: dict[str, Any]) -> int:
+    """Returns the id of the chat of a raw update, or of its user if it has no chat, 0 if neither is known"""
+    for kind, payload in update.items():
+        if kind == "update_id" or not isinstance(payload, dict):
+            continue
+        for path in (_NESTED_CHAT.get(kind, ("chat",)), ("from",)):
+            value: Any = payload
+            for name in path:
+                value = value.get(name) if isinstance(value, dict) else None
+            if isinstance(value, dict) and "id" in value:
+                return int(value["id"])
+    return 0
+
+
+def run_worker(index: int, queue: Queue, build: Build) -> None:
+    """Entry point of a worker process"""
+    # The server process stops the workers through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_serve(index, queue, build))
+
+
+async def _serve(index: int, queue: Queue, build: Build) -> None:
+    application: Application = build(index)
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    await application.initialize()
+    # post_init is only called by run_polling and run_webhook, which a worker does not use
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    logger.info("Webhook worker %s started", index)
+    try:
+        while True:
+            data: dict | None = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logger.info("Webhook worker %s stopped", index)
+
+
+class WebhookServer:
+    """Receives updates over HTTP and hands them to worker processes sharded by chat_id"""
+
+    def __init__(
+        self,
+        build: Build,
+        workers: int,
+        url: str,
+        secret: str,
+        port: int,
+        host: str = "0.0.0.0",
+        token: str | None = None,
+        base_url: str = "https://api.telegram.org/bot",
+    ) -> None:
+        """
+        Initializing a class
+
+        :param build: module-level function that builds the application of a worker: build(index) -> Application
+        :type build: Build
+        :param workers: number of worker processes
+        :type workers: int
+        :param url: public HTTPS URL of the webhook, its path is the path the server listens on
+        :type url: str
+        :param secret: secret token Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+        :type secret: str
+        :param port: port the server listens on
+        :type port: int
+        :param host: interface the server listens on
+        :type host: str
+        :param token: token of the bot, the webhook is registered with Telegram on start if it is given
+        :type token: str | None
+        :param base_url: base URL of the Bot API the webhook is registered with
+        :type base_url: str
+        """
+        self._build: Build = build
+        self._workers: int = max(1, workers)
+        self._url: str = url
+        self._path: str = urlsplit(url).path or "/"
+        self._secret: str = secret
+        self._port: int = port
+        self._host: str = host
+        self._token: str | None = token
+        self._base_url: str = base_url
+        # Workers are spawned, so they do not inherit the state of the server process
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: list[Queue] = []
+        self._processes: list[multiprocessing.Process] = []
+
+    def _start_workers(self) -> None:
+        for index in range(self._workers):
+            queue: Queue = self._context.Queue()
+            process = self._context.Process(
+                target=run_worker,
+                args=(index, queue, self._build),
+                name=f"webhook-worker-{index}",
+            )
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+    def _stop_workers(self) -> None:
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                logger.warning("Terminating %s", process.name)
+                process.terminate()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Verifies the secret token and puts the update into the queue of its worker"""
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), self._secret.encode()
+        ):
+            metrics.counter("webhook_rejected").inc()
+            return web.Response(status=403)
+        try:
+            update: dict = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        shard: int = shard_key(update) % self._workers
+        self._queues[shard].put(update)
+        metrics.counter("webhook_updates", worker=shard).inc()
+        return web.Response()
+
+    @staticmethod
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    def app(self) -> web.Application:
+        app: web.Application = web.Application()
+        app.router.add_post(self._path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        return app
+
+    async def _register(self, app: web.Application) -> None:
+        async with Bot(token=self._token, base_url=self._base_url) as bot:
+            await bot.set_webhook(
+                url=self._url,
+                secret_token=self._secret,
+                allowed_updates=Update.ALL_TYPES,
+                # Updates that arrived while the bot was down are kept
+                drop_pending_updates=False,
+            )
+        logger.info("Webhook set to %s", self._url)
+
+    def run(self) -> None:
+        """Starts the workers and serves until SIGINT or SIGTERM"""
+        self._start_workers()
+        try:
+            app: web.Application = self.app()
+            if self._token:
+                app.on_startup.append(self._register)
+            web.run_app(app, host=self._host, port=self._port, print=None)
+        finally:
+            self._stop_workers()
@@ -6,5 +6,8 @@ Package structure:
     environment.py      - a module that allows you to read information from environment variables stored in .env files
     filters.py          - the module contains various filters used in handlers
     logger.py           - logging settings in the bot
+    loop_guard.py       - reporting of synchronous network calls made on the event loop
+    metrics.py          - in-process counters and latency histograms
+    startup.py          - profiling of the import time and the memory of the start of the bot
     templates.py        - a module that renders templates for display in handlers
 """
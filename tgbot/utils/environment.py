@@ -25,6 +25,17 @@ class Environment:
             sys_exit(1)
         return value
 
+    @staticmethod
+    def _get_int_env_var(var_name: str, default: int) -> int:
+        value = os.environ.get(var_name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            logger.critical(f"Invalid value for {var_name}. It should be an integer.")
+            sys_exit(1)
+
     def get_openai_api(self) -> str:
         return self._get_env_var("OPENAI_API_KEY")
 
@@ -37,6 +48,62 @@ class Environment:
     def get_google_api(self) -> str:
         return self._get_env_var("GOOGLE_API_KEY")
 
+    @staticmethod
+    def get_google_api_endpoint() -> str | None:
+        """Returns the base URL of the Google API if it is overridden, e.g. by a fake server in load tests"""
+        return os.environ.get("GOOGLE_API_ENDPOINT")
+
+    def get_database_url(self) -> str:
+        return self._get_env_var("DATABASE_URL")
+
+    def get_database_sslmode(self) -> str:
+        return os.environ.get("DATABASE_SSLMODE", "require")
+
+    def get_db_pool_size(self) -> tuple[int, int]:
+        """Returns the (min, max) size of the database connection pool"""
+        min_size = self._get_int_env_var("DB_POOL_MIN_SIZE", 2)
+        max_size = self._get_int_env_var("DB_POOL_MAX_SIZE", 10)
+        return min_size, max(min_size, max_size)
+
+    @staticmethod
+    def get_bot_mode() -> str:
+        """Returns the way updates are received: polling (the default) or webhook"""
+        return os.environ.get("BOT_MODE", "polling").lower()
+
+    @staticmethod
+    def get_bot_api_url() -> str:
+        """Returns the base URL of the Bot API, a local Bot API server or a fake one in load tests"""
+        return os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")
+
+    def get_webhook_url(self) -> str:
+        return self._get_env_var("WEBHOOK_URL")
+
+    def get_webhook_secret(self) -> str:
+        return self._get_env_var("WEBHOOK_SECRET")
+
+    def get_port(self) -> int:
+        return self._get_int_env_var("PORT", 8080)
+
+    def get_web_concurrency(self) -> int:
+        """
+        Returns the number of webhook worker processes, at most one per CPU available to the bot
+
+        A worker is CPU bound on decoding updates and calling the Bot API, so workers beyond the CPUs only
+        compete for them and the bot handles fewer updates
+        """
+        workers: int = max(1, self._get_int_env_var("WEB_CONCURRENCY", 1))
+        cpus: int = (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count() or 1
+        )
+        if workers > cpus:
+            logger.warning(
+                f"WEB_CONCURRENCY={workers} is capped to the {cpus} available CPU(s)"
+            )
+            return cpus
+        return workers
+
     def get_admin_ids_or_exit(self) -> tuple[int, ...]:
         admin_ids_str = self._get_env_var(
             "ADMINS"
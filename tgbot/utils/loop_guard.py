@@ -0,0 +1,77 @@
+"""
+The module reports synchronous network calls made on the event loop
+
+A blocking connect or DNS lookup on the event loop stops every handler of the bot until it returns. The guard is
+an audit hook (PEP 578): when a socket connects in blocking mode, or a host name is resolved, in a thread that
+is running an event loop, the call is counted in the blocking_calls_on_loop metric and its stack is logged once
+per call site. The sockets of asyncio are non-blocking and its lookups run in threads, so they are not reported.
+In strict mode the call fails with RuntimeError instead, for tests and load tests.
+
+Example:
+    Install the guard when the bot starts:
+        install_loop_guard(strict=False)
+"""
+
+import asyncio
+import socket
+import sys
+import traceback
+
+from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+_EVENTS: frozenset[str] = frozenset(
+    {
+        "socket.connect",
+        "socket.getaddrinfo",
+        "socket.gethostbyname",
+        "socket.gethostbyaddr",
+    }
+)
+_installed: bool = False
+_strict: bool = False
+_reported: set[tuple[tuple[str, int], ...]] = set()
+
+
+def _is_blocking(event: str, args: tuple) -> bool:
+    if asyncio._get_running_loop() is None:
+        return False
+    if event == "socket.connect":
+        sock = args[0]
+        # A non-blocking socket, e.g. one of asyncio, has a timeout of 0
+        return isinstance(sock, socket.socket) and sock.gettimeout() != 0.0
+    return True
+
+
+def _audit(event: str, args: tuple) -> None:
+    if event not in _EVENTS or not _is_blocking(event, args):
+        return
+    metrics.counter("blocking_calls_on_loop", event=event).inc()
+    # The frame of the hook itself is dropped
+    stack: list[traceback.FrameSummary] = traceback.extract_stack()[:-1][-8:]
+    site: tuple[tuple[str, int], ...] = tuple(
+        (frame.filename, frame.lineno or 0) for frame in stack
+    )
+    if _strict:
+        raise RuntimeError(f"Blocking {event} on the event loop")
+    if site not in _reported:
+        _reported.add(site)
+        logger.warning(
+            "Blocking %s on the event loop:\n%s",
+            event,
+            "".join(traceback.format_list(stack)),
+        )
+
+
+def install_loop_guard(strict: bool = False) -> None:
+    """
+    Installs the guard, audit hooks cannot be removed so it is installed once per process
+
+    :param strict: raise RuntimeError on a blocking call instead of reporting it
+    :type strict: bool
+    """
+    global _installed, _strict
+    _strict = strict
+    if not _installed:
+        sys.addaudithook(_audit)
+        _installed = True
@@ -0,0 +1,162 @@
+"""
+The module contains simple in-process metrics: counters and latency histograms
+
+Example:
+    Import the registry:
+        from tgbot.utils.metrics import metrics
+
+    Count events and measure durations:
+        metrics.counter("advice_pipeline_runs").inc()
+        metrics.histogram("search_latency_seconds", provider="google").observe(0.35)
+
+    The values of all metrics are written into the log periodically by the log_metrics job,
+    or can be read at any time:
+        metrics.snapshot()
+
+    Label a metric with the handler the current task serves:
+        metrics.counter("db_queries", scope=scope.get()).inc()
+"""
+
+import bisect
+from contextvars import ContextVar
+from typing import Any
+
+from telegram.ext import CallbackContext
+
+from tgbot.utils.logger import logger
+
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# Handler the current task serves, set by the update router; tasks created by a handler inherit it
+scope: ContextVar[str] = ContextVar("metrics_scope", default="background")
+
+
+class Counter:
+    """A value that only goes up"""
+
+    def __init__(self) -> None:
+        self.value: float = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class Gauge:
+    """A value that can go up and down"""
+
+    def __init__(self) -> None:
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self._buckets: tuple[float, ...] = buckets
+        self._counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Returns the upper bound of the bucket that contains the q-th percentile (0 < q <= 100)"""
+        if not self.count:
+            return 0.0
+        rank: float = self.count * q / 100
+        seen: int = 0
+        for bound, count in zip(self._buckets, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    """Creates metrics on first use and keeps them by name and labels"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict[str, Any]) -> str:
+        if not labels:
+            return name
+        return (
+            name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+        )
+
+    def _get(self, cls: type, name: str, labels: dict[str, Any], *args: Any) -> Any:
+        key: str = self._key(name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = cls(*args)
+        return metric
+
+    def counter(self, name: str, **labels: Any) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels: Any) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def histogram(
+        self, name: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: Any
+    ) -> Histogram:
+        return self._get(Histogram, name, labels, buckets)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the current values of all metrics"""
+        return {key: metric.snapshot() for key, metric in sorted(self._metrics.items())}
+
+
+metrics: MetricsRegistry = MetricsRegistry()
+
+
+async def log_metrics(context: CallbackContext) -> None:
+    """Job that writes the current values of all metrics into the log"""
+    for key, value in metrics.snapshot().items():
+        logger.info("metric %s = %s", key, value)
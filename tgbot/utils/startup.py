@@ -0,0 +1,68 @@
+"""
+Profiling of the start of the bot
+Contains the profile_startup function, which reports where the time and the memory of a cold start go
+
+The code is run in a fresh interpreter with `-X importtime`, so every module is imported for the first time,
+exactly as on a dyno that has just started. The report lists the wall time of the start, the import time of
+every top-level package and of the slowest modules, and the peak resident memory of the interpreter.
+
+Example:
+    Profile the import of the bot and the build of the application:
+        python main.py --profile-startup
+"""
+
+import re
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# import time: self [us] | cumulative | imported package
+_IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def parse_import_times(output: str) -> list[tuple[str, int, int]]:
+    """Returns (module, self, cumulative) for every module in the output of -X importtime, in microseconds"""
+    times: list[tuple[str, int, int]] = []
+    for line in output.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match:
+            times.append((match[4], int(match[1]), int(match[2])))
+    return times
+
+
+def profile_startup(code: str, top: int = 15) -> None:
+    """
+    Runs the code in a fresh interpreter and prints the startup profile
+
+    :param code: statements that start the bot, e.g. "import main; main.build_application()"
+    :type code: str
+    :param top: number of packages and modules listed in the report
+    :type top: int
+    """
+    started: float = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    elapsed: float = time.perf_counter() - started
+    if result.returncode:
+        print(result.stderr[-2000:], file=sys.stderr)
+        sys.exit(result.returncode)
+    # Kilobytes on Linux
+    peak_rss: int = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    times: list[tuple[str, int, int]] = parse_import_times(result.stderr)
+    packages: dict[str, int] = defaultdict(int)
+    for module, self_us, _ in times:
+        packages[module.split(".")[0]] += self_us
+
+    print(f"Startup of `{code}`: {elapsed:.2f} s, peak RSS {peak_rss / 1024:.0f} MB")
+    print(f"\nImport time by package (total {sum(packages.values()) / 1e6:.2f} s):")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {self_us / 1e3:>9.1f} ms  {package}")
+    print("\nSlowest modules, including their imports:")
+    for module, _, cumulative_us in sorted(times, key=lambda item: -item[2])[:top]:
+        print(f"    {cumulative_us / 1e3:>9.1f} ms  {module}")
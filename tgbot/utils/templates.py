@@ -2,14 +2,21 @@
 Module for rendering jinja2 templates used to display messages in the bot
 Contains the RenderTemplate class, which performs template rendering, and template - object of the RenderTemplate class
 
+Every text the bot sends to users is a template. All templates are compiled once when the bot starts, and the
+compiled code is kept in a bytecode cache on disk, so later starts only load it. No template needs async
+filters, so templates are rendered synchronously; the rendered values are escaped for the HTML parse mode.
+
 Example of use:
     Importing an instance of the RenderTemplate class:
         from tgbot.utils.templates import template
 
+    Compile all templates when the bot starts:
+        template.compile_all()
+
     Create a handler in the handler module:
         async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text(
-                text=await template.render(
+                text=template.render_sync(
                     template_name="start.jinja2", data={"user_name": update.message.from_user.first_name}
                 )
             )
@@ -26,30 +33,75 @@ Example of use:
 More information about jinja2: https://jinja.palletsprojects.com/en/3.1.x/
 """
 
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+import os
+import time
+
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    TemplateNotFound,
+)
 
-from tgbot.config import TEMPLATES_DIR
+from tgbot.config import TEMPLATE_CACHE_DIR, TEMPLATES_DIR
 from tgbot.utils.logger import logger
+from tgbot.utils.metrics import metrics
+
+NOT_FOUND: str = "❌ Answer template not found!"
 
 
 class RenderTemplate:
     """Returns the rendered template, based on the passed data"""
 
-    def __init__(self, path_to_templates: str) -> None:
+    def __init__(
+        self, path_to_templates: str, path_to_cache: str | None = None
+    ) -> None:
         """
         Initializing a class
 
         :param path_to_templates: path to the folder with templates
         :type path_to_templates: str
+        :param path_to_cache: path to the folder with the compiled templates, they are not kept if None
+        :type path_to_cache: str | None
         """
         self._template_loader: FileSystemLoader = FileSystemLoader(
             searchpath=path_to_templates
         )
+        bytecode_cache: FileSystemBytecodeCache | None = None
+        if path_to_cache is not None:
+            os.makedirs(path_to_cache, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(directory=path_to_cache)
         self._env: Environment = Environment(
-            loader=self._template_loader, enable_async=True
+            loader=self._template_loader,
+            bytecode_cache=bytecode_cache,
+            # Templates do not change while the bot runs
+            auto_reload=False,
+            autoescape=True,
         )
+        self._templates: dict[str, Template] = {}
 
-    async def render(self, template_name: str, data: dict | None = None) -> str:
+    def compile_all(self) -> int:
+        """
+        Compiles every template, or loads it from the bytecode cache, and returns the number of templates
+        """
+        started: float = time.perf_counter()
+        for name in self._env.list_templates(extensions=["jinja2"]):
+            self._templates[name] = self._env.get_template(name=name)
+        elapsed: float = time.perf_counter() - started
+        metrics.gauge("templates_compile_seconds").set(elapsed)
+        logger.info("Compiled %s templates in %.3f s", len(self._templates), elapsed)
+        return len(self._templates)
+
+    def _get(self, template_name: str) -> Template:
+        compiled: Template | None = self._templates.get(template_name)
+        if compiled is None:
+            compiled = self._templates[template_name] = self._env.get_template(
+                name=template_name
+            )
+        return compiled
+
+    def render_sync(self, template_name: str, data: dict | None = None) -> str:
         """
         Returns the rendered template, based on the passed data
 
@@ -60,15 +112,19 @@ class RenderTemplate:
         :return: rendered template as a string
         :rtype: str
         """
-        if data is None:
-            data = {}
         try:
-            return await self._env.get_template(name=template_name).render_async(**data)
+            return self._get(template_name).render(**(data or {}))
         except TemplateNotFound as exc:
             logger.error(
                 "Template %s for render not found: %s", template_name, repr(exc)
             )
-            return "❌ Answer template not found!"
+            return NOT_FOUND
+
+    async def render(self, template_name: str, data: dict | None = None) -> str:
+        """Same as render_sync, for the handlers that await the rendering"""
+        return self.render_sync(template_name=template_name, data=data)
 
 
-template: RenderTemplate = RenderTemplate(path_to_templates=TEMPLATES_DIR)
+template: RenderTemplate = RenderTemplate(
+    path_to_templates=TEMPLATES_DIR, path_to_cache=TEMPLATE_CACHE_DIR
+)